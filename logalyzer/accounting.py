@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# logalyzer:
+# Parses your bloated HTTP access logs to extract the info you want
+# about hits from (hopefully) real people instead of just the endless
+# stream of hackers and bots that passes for web traffic
+# nowadays. Stores the info in a relational database where you can
+# access it using all the power of SQL.
+#
+# Copyright (C) 2015, 2017, 2018 by Edwin A. Suominen,
+# http://edsuom.com/logalyzer
+#
+# See edsuom.com for API documentation as well as information about
+# Ed's background and other projects, software and otherwise.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the
+# License. You may obtain a copy of the License at
+# 
+#   http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an "AS
+# IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+
+
+
+"""
+A report of the hits and cost of each rule, and the rejections made by
+each check of L{logread.ProcessReader.makeRecord}, at the end of a
+run.
+
+The parsing workers keep count (see L{sift.RuleAccounting}) and send
+their counts to the main process along with their other counts, where
+they're added up in a L{stats.Stats} object. Rules that never match
+can be pruned, and expensive ones rewritten.
+"""
+
+from parse import MatcherManager
+
+
+# The checks of ProcessReader.makeRecord, in the order they're made
+checks = (
+    ('unparsed',  "Not a logfile line"),
+    ('blocked',   "From an IP address already blocked"),
+    ('ip',        "IP address rule (.ip)"),
+    ('secondary', "Secondary file"),
+    ('url',       "URL rule (.url)"),
+    ('ref',       "Referrer rule (.ref)"),
+    ('http',      "Excluded HTTP code"),
+    ('ua',        "User-agent rule (.ua)"),
+    ('vhost',     "Vhost rule (.vhost)"),
+    ('benign',    "Benign bot URL"),
+    ('net',       "Network rule (.net)"),
+)
+
+
+def ruleRows(rules, counts):
+    """
+    Returns a list of the hits, evaluations, evaluation seconds, and
+    text of each of the supplied I{rules} (once, if repeated), given
+    a dict of I{counts} for them from L{stats.Stats.rules}. The most
+    expensive rule comes first, with the ones that cost nothing in
+    order of hits.
+    """
+    rows = []
+    for rule in set(rules).union(counts):
+        rows.append(list(counts.get(rule, (0, 0, 0.0))) + [rule])
+    rows.sort(key=lambda x: (-x[2], -x[0], x[3]))
+    return rows
+
+
+def writeReport(filePath, stats, rules):
+    """
+    Writes a report of the hits and cost of each of the supplied
+    I{rules}, a dict of the rules for each matcher by its class name,
+    with the counts in I{stats}, to the file at I{filePath}. Also
+    reports the number of lines rejected by each check, whether or
+    not the rules were counted.
+    """
+    def line(text, *args):
+        fh.write(text.format(*args) + "\n")
+    
+    with open(filePath, 'w') as fh:
+        line("Rule hits and evaluation time for {:d} lines read\n",
+             stats.get('lines'))
+        line("Lines rejected by each check:")
+        names = [x[0] for x in checks]
+        for check, text in checks + tuple(
+                [(x[8:], x[8:]) for x in sorted(stats.counts)
+                 if x.startswith('rejects.') and x[8:] not in names]):
+            line("  {:<40s} {:>12d}", text, stats.get('rejects.' + check))
+        for name, className in MatcherManager.matcherTable:
+            counts = stats.rules.get(name, {})
+            theseRules = rules.get(className, [])
+            if not counts and not theseRules:
+                continue
+            rows = ruleRows(theseRules, counts)
+            heading = "\n{}: {:d} rules, {:d} never matched".format(
+                className, len(rows), len([x for x in rows if not x[0]]))
+            if 'lookups.' + name in stats.counts:
+                # Only a matcher with a cache has its lookups counted
+                heading += ", {:d} lookups, {:d} answered by cache".format(
+                    stats.get('lookups.' + name), stats.get('hits.' + name))
+            line(heading)
+            line("  {:>10s} {:>12s} {:>10s} {:>10s}  {}",
+                 "Hits", "Evaluations", "Seconds", "us/eval", "Rule")
+            for hits, evals, seconds, rule in rows:
+                perEval = "{:.2f}".format(1E6*seconds/evals) \
+                          if evals and seconds else "-"
+                line("  {:>10d} {:>12d} {:>10.3f} {:>10s}  {}",
+                     hits, evals, seconds, perEval, rule)
+    return filePath
@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# logalyzer:
+# Parses your bloated HTTP access logs to extract the info you want
+# about hits from (hopefully) real people instead of just the endless
+# stream of hackers and bots that passes for web traffic
+# nowadays. Stores the info in a relational database where you can
+# access it using all the power of SQL.
+#
+# Copyright (C) 2015, 2017, 2018 by Edwin A. Suominen,
+# http://edsuom.com/logalyzer
+#
+# See edsuom.com for API documentation as well as information about
+# Ed's background and other projects, software and otherwise.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the
+# License. You may obtain a copy of the License at
+# 
+#   http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an "AS
+# IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+
+
+"""
+Benchmarks of B{logalyzer} throughput, with the I{la-bench} entry
+point.
+
+Synthetic logfiles from L{synthetic.LogGenerator} get run through each
+stage of the pipeline in isolation and then all the way through
+L{logread.Reader.run}, see L{stages}. The results are saved as JSON
+so that the ones from before and after a change can be compared.
+"""
@@ -0,0 +1,332 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# logalyzer:
+# Parses your bloated HTTP access logs to extract the info you want
+# about hits from (hopefully) real people instead of just the endless
+# stream of hackers and bots that passes for web traffic
+# nowadays. Stores the info in a relational database where you can
+# access it using all the power of SQL.
+#
+# Copyright (C) 2015, 2017, 2018 by Edwin A. Suominen,
+# http://edsuom.com/logalyzer
+#
+# See edsuom.com for API documentation as well as information about
+# Ed's background and other projects, software and otherwise.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the
+# License. You may obtain a copy of the License at
+# 
+#   http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an "AS
+# IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+
+
+"""
+Timing of each stage of the pipeline in isolation, and of the whole
+thing through L{logread.Reader.run}, on a synthetic logfile. The time
+it takes a new Python interpreter just to import L{logalyzer.main} is
+timed, too.
+"""
+
+import os, os.path, sys, time, json, shutil, tempfile, platform, subprocess
+
+import pkg_resources
+from twisted.internet import reactor, defer
+
+from logalyzer import parse, sift, logread, database
+from logalyzer.main import Recorder, RuleReader
+from logalyzer.util import oops, Args
+from logalyzer.bench.synthetic import LogGenerator
+
+
+# The directory with the logalyzer package in it, for a new
+# interpreter to import it from
+PACKAGE_PARENT = os.path.dirname(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def loadRules(rulesDir=None):
+    """
+    Returns a dict of the lines of the rules in I{rulesDir}, or the
+    stock rules if it isn't specified, for each matcher.
+    """
+    if rulesDir is None:
+        rulesDir = pkg_resources.resource_filename('logalyzer', 'rules')
+    rr = RuleReader(rulesDir)
+    return dict([(x[2], rr.rules(x[1])) for x in Recorder.ruleTable])
+
+
+class Benchmark(object):
+    """
+    I time each stage of the pipeline on I{N} lines of a synthetic
+    logfile from a L{LogGenerator} constructed with any keywords you
+    supply, using a dict of the lines of I{rules} for each matcher.
+    No more than I{N_db} accepted records get written to the
+    database in the I{setRecord} stage.
+
+    The logfile that goes all the way through L{logread.Reader.run}
+    is compressed if I{gzip} is set, and parsed with I{cores}
+    workers (or the default number, if C{None}).
+    """
+    # The part of the parsed line that each matcher gets called
+    # with, along with the IP address (except for the IP matchers)
+    fields = {
+        'IPMatcher':    None,
+        'NetMatcher':   None,
+        'UAMatcher':    6,
+        'BotMatcher':   3,
+        'RefMatcher':   5,
+        'VhostMatcher': 0,
+    }
+    # Dependencies that take a while to import, which importing
+    # logalyzer.main shouldn't do. The ones a run needs get imported
+    # when it needs them.
+    heavy = ('urwid', 'sqlalchemy', 'sasync', 'ipcalc', 'pkg_resources')
+    
+    def __init__(
+            self, rules, N=100000, N_db=10000,
+            gzip=False, cores=None, verbose=False, **kw):
+        self.rules = rules
+        self.N = N
+        self.N_db = N_db
+        self.gzip = gzip
+        self.cores = cores
+        self.verbose = verbose
+        self.kw = kw
+        self.lines = list(LogGenerator(**kw).lines(N))
+        self.results = {}
+
+    def matchers(self):
+        """
+        Returns a dict of new matchers, loaded with my rules.
+        """
+        return dict([(x, getattr(sift, x)(y)) for x, y in self.rules.items()])
+        
+    def record(self, name, N, seconds):
+        """
+        Records the time in I{seconds} that the named stage took to
+        process I{N} items.
+        """
+        rate = N / seconds if seconds else None
+        self.results[name] = {'items': N, 'seconds': seconds, 'rate': rate}
+        if self.verbose:
+            print "{:<24s} {:>10d} items in {:8.3f} s, {:>12.0f}/s".format(
+                name, N, seconds, rate or 0)
+    
+    def importing(self, N=5):
+        """
+        Times the import of L{logalyzer.main} by a new Python
+        interpreter, the fastest of I{N} tries, and returns a list of
+        my I{heavy} dependencies that got imported along with it.
+        """
+        code = "; ".join([
+            "import sys, time, json", "t0 = time.time()",
+            "import logalyzer.main",
+            "print json.dumps([time.time() - t0, list(sys.modules)])"])
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(
+            [PACKAGE_PARENT] + filter(None, [env.get('PYTHONPATH')]))
+        times = []
+        for k in xrange(N):
+            seconds, modules = json.loads(subprocess.check_output(
+                [sys.executable, "-c", code], env=env))
+            times.append(seconds)
+        self.record('import main', 1, min(times))
+        imported = [x for x in self.heavy if x in modules]
+        self.results['import main']['heavy'] = imported
+        if self.verbose and imported:
+            print "{:<24s} {}".format("", ", ".join(imported))
+        return imported
+    
+    def parser(self):
+        """
+        Times L{parse.LineParser} on all the lines, returning what it
+        parsed from them.
+        """
+        p = parse.LineParser()
+        t0 = time.time()
+        parsed = [p(x) for x in self.lines]
+        self.record('LineParser', len(self.lines), time.time() - t0)
+        return [x for x in parsed if x]
+
+    def matching(self, parsed):
+        """
+        Times each matcher, with an empty cache, on the relevant part of
+        every one of the I{parsed} lines.
+        """
+        for name, matcher in sorted(self.matchers().items()):
+            k = self.fields[name]
+            t0 = time.time()
+            if k is None:
+                for stuff in parsed:
+                    matcher(stuff[1])
+            else:
+                for stuff in parsed:
+                    matcher(stuff[1], stuff[k])
+            self.record(name, len(parsed), time.time() - t0)
+
+    def makeRecord(self):
+        """
+        Times L{logread.ProcessReader.makeRecord} on all the lines,
+        returning the (dt, record) tuples of the ones it accepted.
+        """
+        pr = logread.ProcessReader(self.matchers())
+        t0 = time.time()
+        results = [pr.makeRecord(x) for x in self.lines]
+        self.record('makeRecord', len(self.lines), time.time() - t0)
+        return [x for x in results if x and not isinstance(x[0], str)]
+
+    @defer.inlineCallbacks
+    def setRecord(self, records, dirPath):
+        """
+        Times L{database.Transactor.setRecord} on up to I{N_db} of the
+        supplied accepted I{records}, written one at a time to a new
+        SQLite database in the directory at I{dirPath}.
+        """
+        records = records[:self.N_db]
+        t = database.Transactor(
+            "sqlite:///{}".format(os.path.join(dirPath, "setRecord.db")))
+        yield t.waitUntilRunning()
+        yield t.preload()
+        t0 = time.time()
+        for dt, record in records:
+            yield t.setRecord(dt, record)
+        self.record('setRecord', len(records), time.time() - t0)
+        yield t.shutdown()
+    
+    @defer.inlineCallbacks
+    def endToEnd(self, dirPath):
+        """
+        Times L{logread.Reader.run} on a logfile in the directory at
+        I{dirPath} with all my lines, loading them into a new SQLite
+        database there.
+        """
+        fileName = "access.log.gz" if self.gzip else "access.log"
+        LogGenerator(**self.kw).write(os.path.join(dirPath, fileName), self.N)
+        reader = logread.Reader(
+            self.rules,
+            "sqlite:///{}".format(os.path.join(dirPath, "endToEnd.db")),
+            cores=self.cores)
+        reader.myDir = dirPath
+        t0 = time.time()
+        yield reader.run([fileName])
+        self.record('Reader.run', self.N, time.time() - t0)
+        yield reader.shutdown()
+
+    @defer.inlineCallbacks
+    def run(self, db=True):
+        """
+        Runs all my stages, skipping the ones that use a database
+        unless I{db} is set, and returns a C{Deferred} that fires with
+        a dict of the results for each stage by name. See L{save}.
+        """
+        dirPath = tempfile.mkdtemp()
+        try:
+            self.importing()
+            self.matching(self.parser())
+            records = self.makeRecord()
+            if db:
+                yield self.setRecord(records, dirPath)
+                yield self.endToEnd(dirPath)
+        finally:
+            shutil.rmtree(dirPath)
+        defer.returnValue(self.results)
+
+    def save(self, filePath):
+        """
+        Saves my results to a JSON file at I{filePath}, along with the
+        options they were run with and some info about the platform.
+        """
+        options = dict(self.kw)
+        options.pop('start', None)
+        options.update({
+            'N': self.N, 'N_db': self.N_db,
+            'gzip': self.gzip, 'cores': self.cores})
+        with open(filePath, 'w') as fh:
+            json.dump({
+                'time': time.time(),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'options': options,
+                'stages': self.results,
+            }, fh, indent=2, sort_keys=True)
+
+
+def compare(old, new, threshold=0.1):
+    """
+    Returns a list of lines comparing the rates of each stage in the
+    I{old} and I{new} dicts loaded from saved results, with any stage
+    that got slower by more than I{threshold} flagged.
+    """
+    lines = ["{:<24s} {:>12s} {:>12s} {:>8s}".format(
+        "Stage", "Old /s", "New /s", "Ratio")]
+    for name in sorted(set(old['stages']).intersection(new['stages'])):
+        rates = [x['stages'][name]['rate'] for x in (old, new)]
+        if not all(rates):
+            continue
+        ratio = rates[1] / rates[0]
+        flag = "  SLOWER" if ratio < 1.0 - threshold else ""
+        lines.append("{:<24s} {:>12.0f} {:>12.0f} {:>8.2f}{}".format(
+            name, rates[0], rates[1], ratio, flag))
+    return lines
+
+
+args = Args(
+    "Benchmarks the throughput of each stage of logalyzer, and all of "+\
+    "them together, on a synthetic logfile. Results are saved as JSON "+\
+    "to a file you specify, and compared with the ones in another file "+\
+    "saved earlier (-c).")
+args('-n', '--lines', 100000, "Number of lines in the synthetic logfile")
+args('-b', '--bots', 0.2, "Share of lines from bots")
+args('-U', '--uas', 50, "Number of different browser user-agents")
+args('-R', '--urls', 200, "Number of different URLs")
+args('-I', '--ips', 2000, "Number of different browser IP addresses")
+args('-z', '--gzip', "Compress the logfile loaded end to end")
+args('-T', '--twisted', "Prefix lines with a Twisted web server timestamp")
+args('-s', '--seed', 0, "Seed for the pseudorandom lines")
+args('-D', '--db-lines', 10000,
+     "Maximum number of accepted records written one at a time to SQLite")
+args('-x', '--no-db',
+     "Skip the stages that use a database (setRecord and end to end)")
+args('-N', '--cores', -1,
+     "Number of worker processes for the end-to-end run, or -1 for the "+\
+     "default")
+args('-d', '--ruledir', "",
+     "Directory of rule files to use instead of the stock ones")
+args('-c', '--compare', "",
+     "JSON file of earlier results to compare the new ones with")
+args("<JSON file for the results>")
+
+
+def run():
+    if len(args) != 1:
+        print "Specify just one file for the results"
+        sys.exit(1)
+    
+    @defer.inlineCallbacks
+    def go():
+        yield b.run(db=not args.x)
+        b.save(args[0])
+        if args.c:
+            with open(args.c) as fh, open(args[0]) as gh:
+                print "\n".join(compare(json.load(fh), json.load(gh)))
+    
+    rules = loadRules(os.path.expanduser(args.d) if args.d else None)
+    b = Benchmark(
+        rules, N=args.n, N_db=args.D, gzip=args.z,
+        cores=None if args.N < 0 else args.N, verbose=True,
+        N_ua=args.U, N_url=args.R, N_ip=args.I, botShare=args.b,
+        twisted=args.T, seed=args.s)
+    reactor.callWhenRunning(
+        lambda: go().addErrback(oops).addBoth(lambda _: reactor.stop()))
+    reactor.run()
+
+
+if __name__ == "__main__":
+    run()
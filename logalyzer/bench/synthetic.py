@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# logalyzer:
+# Parses your bloated HTTP access logs to extract the info you want
+# about hits from (hopefully) real people instead of just the endless
+# stream of hackers and bots that passes for web traffic
+# nowadays. Stores the info in a relational database where you can
+# access it using all the power of SQL.
+#
+# Copyright (C) 2015, 2017, 2018 by Edwin A. Suominen,
+# http://edsuom.com/logalyzer
+#
+# See edsuom.com for API documentation as well as information about
+# Ed's background and other projects, software and otherwise.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the
+# License. You may obtain a copy of the License at
+# 
+#   http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an "AS
+# IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+
+
+"""
+Generation of realistic synthetic HTTP access logs for benchmarking.
+"""
+
+import gzip, random
+from datetime import datetime, timedelta
+
+
+class LogGenerator(object):
+    """
+    I generate lines of a synthetic HTTP access log in combined log
+    format, with a vhost in the second column, from a pseudorandom
+    sequence that's the same every time for the same I{seed}.
+
+    Most lines are from people browsing, using one of I{N_ua}
+    user-agents to request one of I{N_url} URLs. The I{botShare} of
+    lines are from bots: crawlers with user-agents that the stock
+    I{.ua} rules ignore, and hackers requesting URLs that the stock
+    I{.url} rules block, with a few logspammers that the stock
+    I{.ref} rules block.
+
+    With I{twisted} set, each line has the timestamp prefix of a
+    Twisted web server log.
+    """
+    vhosts = ("example.com", "www.example.com", "blog.example.com")
+    crawlerUAs = (
+        "Mozilla/5.0 (compatible; Googlebot/2.1; "+\
+        "+http://www.google.com/bot.html)",
+        "Mozilla/5.0 (compatible; bingbot/2.0; "+\
+        "+http://www.bing.com/bingbot.htm)",
+        "Mozilla/5.0 (compatible; YandexBot/3.0; +http://yandex.com/bots)",
+        "Mozilla/5.0 (compatible; AhrefsBot/5.2; +http://ahrefs.com/robot/)",
+    )
+    hackerURLs = (
+        "/wp-login.php", "/wp-admin/", "/xmlrpc.php",
+        "/fckeditor/editor/filemanager/", "/phpmyadmin/index.php",
+    )
+    spamRefs = (
+        "http://buttons-for-website.com", "http://make-money-online.com",
+    )
+    secondary = (".css", ".js", ".png", ".jpg", ".ico")
+    codes = (200,)*16 + (304, 304, 301, 404)
+    
+    def __init__(
+            self, N_ua=50, N_url=200, N_ip=2000, botShare=0.2,
+            twisted=False, seed=0, start=datetime(2018, 1, 1)):
+        self.r = random.Random(seed)
+        self.botShare = botShare
+        self.twisted = twisted
+        self.dt = start
+        self.ips = [self.randomIP() for k in xrange(N_ip)]
+        self.botIPs = [self.randomIP() for k in xrange(max([1, N_ip//10]))]
+        self.uas = [self.browserUA() for k in xrange(N_ua)]
+        self.urls = [self.pageURL() for k in xrange(N_url)]
+
+    def randomIP(self):
+        return ".".join([str(self.r.randint(1, 254)) for k in xrange(4)])
+
+    def browserUA(self):
+        r = self.r
+        proto = "Mozilla/5.0 ({}) AppleWebKit/{:d}.{:d} (KHTML, like Gecko) "+\
+                "Chrome/{:d}.0.{:d}.{:d} Safari/537.36"
+        return proto.format(
+            r.choice((
+                "Windows NT 10.0; Win64; x64",
+                "Macintosh; Intel Mac OS X 10_13_4",
+                "X11; Linux x86_64",
+                "iPhone; CPU iPhone OS 11_3 like Mac OS X")),
+            r.randint(500, 605), r.randint(1, 50), r.randint(50, 70),
+            r.randint(1000, 3500), r.randint(10, 200))
+
+    def pageURL(self):
+        r = self.r
+        words = ("about", "blog", "projects", "photos", "software", "notes")
+        parts = [r.choice(words) for k in xrange(r.randint(1, 3))]
+        if r.random() < 0.3:
+            return "/{}{}".format("/".join(parts), r.choice(self.secondary))
+        return "/{}/{:d}.html".format("/".join(parts), r.randint(1, 999))
+
+    def fields(self):
+        """
+        Returns the IP address, URL, referrer, and user-agent of the
+        next line.
+        """
+        r = self.r
+        if r.random() < self.botShare:
+            ip = r.choice(self.botIPs)
+            x = r.random()
+            if x < 0.6:
+                return ip, r.choice(self.urls), "-", r.choice(self.crawlerUAs)
+            if x < 0.9:
+                return ip, r.choice(self.hackerURLs), "-", r.choice(self.uas)
+            return ip, r.choice(self.urls), r.choice(self.spamRefs), \
+                r.choice(self.uas)
+        ref = "-" if r.random() < 0.5 else \
+              "http://{}{}".format(r.choice(self.vhosts), r.choice(self.urls))
+        return r.choice(self.ips), r.choice(self.urls), ref, r.choice(self.uas)
+    
+    def line(self):
+        """
+        Returns the next line, with a newline at the end.
+        """
+        r = self.r
+        self.dt += timedelta(seconds=r.randint(0, 2))
+        ip, url, ref, ua = self.fields()
+        line = '{} {} - [{}] "GET {} HTTP/1.1" {:d} {:d} "{}" "{}"\n'.format(
+            ip, r.choice(self.vhosts),
+            self.dt.strftime("%d/%b/%Y:%H:%M:%S +0000"),
+            url, r.choice(self.codes), r.randint(200, 50000), ref, ua)
+        if self.twisted:
+            line = self.dt.strftime("%Y-%m-%d %H:%M:%S+0000 [-] ") + line
+        return line
+
+    def lines(self, N):
+        """
+        Iterates over the next I{N} lines.
+        """
+        for k in xrange(N):
+            yield self.line()
+
+    def write(self, filePath, N):
+        """
+        Writes the next I{N} lines to a logfile at I{filePath},
+        compressed if its name ends with I{.gz}. Returns the number of
+        bytes written, before any compression.
+        """
+        N_bytes = 0
+        fh = gzip.open(filePath, 'wb') \
+             if filePath.endswith('.gz') else open(filePath, 'w')
+        with fh:
+            for line in self.lines(N):
+                fh.write(line)
+                N_bytes += len(line)
+        return N_bytes
@@ -29,17 +29,115 @@
 SQL database access using sAsync.
 """
 
+import struct, socket, calendar
+from hashlib import md5
+from collections import deque
+from datetime import datetime, timedelta
+
 from zope.interface import implements
 from twisted.internet import defer
 from twisted.internet.interfaces import IConsumer
 
 from asynqueue.info import showResult, whichThread
-from asynqueue.iteration import ListConsumer
 
 from sasync.database import transact, wait, SA, AccessBroker
+from sqlalchemy.dialects import mysql
 
 import util
 from sift import IPMatcher
+from hll import HyperLogLog
+
+
+def valueHash(value):
+    """
+    Returns a signed 64-bit integer hash of the supplied string value,
+    for a compact, fixed-width index of values that can be much longer
+    than it is.
+    """
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return struct.unpack('<q', md5(value).digest()[:8])[0]
+
+def nextHash(h):
+    """
+    Returns the signed 64-bit integer after hash I{h}, wrapping
+    around, for the next slot to try when a different value with the
+    same hash already has slot I{h}.
+    """
+    return -2**63 if h == 2**63-1 else h+1
+
+
+def ipToInt(ip):
+    """
+    Returns the unsigned 32-bit integer for a dotted-quad IP address.
+    """
+    return struct.unpack('!I', socket.inet_aton(ip))[0]
+
+def intToIP(N):
+    """
+    Returns the dotted-quad IP address for an unsigned 32-bit integer.
+    """
+    return socket.inet_ntoa(struct.pack('!I', N))
+
+def dtToEpoch(dt):
+    """
+    Returns integer seconds since the epoch for a naive datetime
+    object, which is taken to be UTC.
+    """
+    return calendar.timegm(dt.timetuple())
+
+def epochToDT(N):
+    """
+    Returns a naive UTC datetime object for integer seconds since the
+    epoch.
+    """
+    return datetime.utcfromtimestamp(N)
+
+
+def entriesColumns(compact=False):
+    """
+    Returns a list of columns for the I{entries} table or, if
+    I{compact} is set, for the I{entries_c} table that stores IP
+    addresses and datetimes as unsigned 32-bit integers.
+
+    The primary key is an auto-incrementing index, which can be used
+    to find out the order in which requests were made within a
+    single second.
+    """
+    if compact:
+        dtType = ipType = SA.Integer().with_variant(
+            mysql.INTEGER(unsigned=True), 'mysql')
+    else:
+        dtType, ipType = SA.DateTime, SA.String(15)
+    return [
+        SA.Column('id', SA.Integer, primary_key=True),
+        SA.Column('dt', dtType),
+        SA.Column('ip', ipType),
+        SA.Column('http', SA.SmallInteger),
+        SA.Column('was_rd', SA.Boolean),
+        SA.Column('id_vhost', SA.Integer),
+        SA.Column('id_url', SA.Integer),
+        SA.Column('id_ref', SA.Integer),
+        SA.Column('id_ua', SA.Integer),
+    ]
+
+def entriesViewSQL(engine):
+    """
+    Returns SQL for creating an I{entries} view of the I{entries_c}
+    table that presents IP addresses and datetimes the way the
+    I{entries} table does, for the supplied engine's dialect (MySQL or
+    SQLite).
+    """
+    if engine.name == 'mysql':
+        dt = "TIMESTAMPADD(SECOND, dt, CAST('1970-01-01' AS DATETIME))"
+        ip = "INET_NTOA(ip)"
+    else:
+        # The same text format SQLAlchemy uses for SQLite datetimes
+        dt = "strftime('%Y-%m-%d %H:%M:%f000', dt, 'unixepoch')"
+        ip = " || '.' || ".join([
+            "((ip >> {:d}) & 255)".format(x) for x in (24, 16, 8, 0)])
+    return "CREATE VIEW entries AS SELECT id, {} AS dt, {} AS ip, ".format(
+        dt, ip) + "http, was_rd, id_vhost, id_url, id_ref, id_ua FROM entries_c"
 
 
 class DTK(object):
@@ -112,6 +210,60 @@ class DTK(object):
                 self.N += 1
 
 
+class IDCache(object):
+    """
+    I map the values of one indexed-value table to their IDs, holding
+    on to no more than I{maxSize} of them.
+
+    When I'm full, the oldest value that hasn't been used since it was
+    last passed over gets evicted to make room for a new one. That's
+    the "second chance" approximation of evicting the least recently
+    used value, and it means a cache hit only has to note that the
+    value was used, not move it anywhere.
+    """
+    def __init__(self, maxSize):
+        self.maxSize = maxSize
+        self.x = {}
+        self.used = set()
+        self.queue = deque()
+
+    def __len__(self):
+        return len(self.x)
+
+    def __contains__(self, value):
+        return value in self.x
+
+    def __getitem__(self, value):
+        ID = self.x[value]
+        self.used.add(value)
+        return ID
+
+    def get(self, value, default=None):
+        ID = self.x.get(value, None)
+        if ID is None:
+            return default
+        self.used.add(value)
+        return ID
+    
+    def __setitem__(self, value, ID):
+        if value not in self.x:
+            if len(self.x) >= self.maxSize:
+                self._evict()
+            self.queue.append(value)
+        self.x[value] = ID
+
+    def _evict(self):
+        while True:
+            value = self.queue.popleft()
+            if value in self.used:
+                # Second chance
+                self.used.discard(value)
+                self.queue.append(value)
+                continue
+            del self.x[value]
+            return
+
+
 class PreloadConsumer(object):
     """
     I consume single-item query results, doing the specified f-args-kw
@@ -148,21 +300,6 @@ class PreloadConsumer(object):
                 self.progressCall()
 
 
-class RecordConsumer(ListConsumer):
-    """
-    I consume rows and make them into records.
-    """
-    @defer.inlineCallbacks
-    def processItem(self, row):
-        ID = row[0]
-        result = {}
-        for j, name in enumerate(self.t.directValues):
-            result[name] = row[j+1]
-        valueDict = yield self.t._getValuesFromIDs(row[4:])
-        result.update(valueDict)
-        defer.returnValue((ID, result))
-
-
 class Transactor(AccessBroker, util.Base):
     """
     I handle transactions for an efficient database of logfile
@@ -173,6 +310,28 @@ class Transactor(AccessBroker, util.Base):
 
     @ivar dtk: An instance of L{DTK} loaded (eventually) with all
       datetime values in the database.
+
+    @ivar compact: C{True} if entries are stored in the compact
+      I{entries_c} table, with IP addresses and datetimes as integers
+      and an I{entries} view of it that looks like the regular
+      table. Set with the I{compact} keyword for a new database;
+      it's set automatically for a database that has one.
+
+    @ivar idTable: A dict with an L{IDCache} for each of my
+      I{indexedValues}, preloaded with the values of the most recent
+      entries.
+
+    @ivar rollups: C{True} if I maintain per-day rollup tables of hits
+      in the same transactions as I add and purge entries: hits per
+      vhost, url and HTTP code in I{rollup_hits}, and hits per vhost
+      and IP address in I{rollup_visitors}. Set with the I{rollups}
+      keyword; it's set automatically for a database that has them.
+
+    @ivar sketches: C{True} if I maintain a I{visitor_sketches} table of
+      L{HyperLogLog} sketches of the IP addresses seen each day, for
+      each vhost (with an I{id_url} of zero) and for each url of each
+      vhost. Set with the I{sketches} keyword; it's set automatically
+      for a database that has them.
     
     """
     directValues = ['ip', 'http', 'was_rd']
@@ -180,34 +339,59 @@ class Transactor(AccessBroker, util.Base):
     colNames = directValues +\
                ["id_{}".format(x) for x in indexedValues]
 
+    # The most value IDs to keep for each indexed value
+    idCacheSize = 100000
+    
+    # The key columns of each rollup table
+    rollupKeys = {
+        'rollup_hits': ('day', 'id_vhost', 'id_url', 'http'),
+        'rollup_visitors': ('day', 'id_vhost', 'ip'),
+    }
+    
+    def __init__(
+            self, url, compact=False, rollups=False, sketches=False, **kw):
+        self.compact = compact
+        self.rollups = rollups
+        self.sketches = sketches
+        if url.startswith('sqlite:///') and ':memory:' not in url:
+            # A file-based SQLite engine doesn't use a connection
+            # pool, and won't accept a pool size
+            kw.pop('pool_size', None)
+        AccessBroker.__init__(self, url, **kw)
+
     @defer.inlineCallbacks
     def startup(self):
-        # Primary key is an auto-incrementing index, which can be used
-        # to find out the order in which requests were made within a
-        # single second.
-        yield self.table(
-            'entries',
-            SA.Column('id', SA.Integer, primary_key=True),
-            SA.Column('dt', SA.DateTime),
-            SA.Column('ip', SA.String(15)),
-            SA.Column('http', SA.SmallInteger),
-            SA.Column('was_rd', SA.Boolean),
-            SA.Column('id_vhost', SA.Integer),
-            SA.Column('id_url', SA.Integer),
-            SA.Column('id_ref', SA.Integer),
-            SA.Column('id_ua', SA.Integer),
-            index_dt=['dt'], index_ip=['ip']
-        )
+        self.compact = yield self.q.deferToThread(self._isCompact)
+        if self.compact:
+            yield self.table(
+                'entries_c', *entriesColumns(True),
+                index_c_dt=['dt'], index_c_ip=['ip'])
+            self.entries = self.entries_c
+            yield self.q.deferToThread(self._createView)
+        else:
+            yield self.table(
+                'entries', *entriesColumns(),
+                index_dt=['dt'], index_ip=['ip'])
         kw = {}
         if str(self.q.engine.url).startswith('mysql'):
             kw['collation'] = "latin1_general_cs"
+        # Values are looked up by a hash of them, which is uniquely
+        # indexed, and then by the full value. A value can be any
+        # length, which is why there's no index on it. See
+        # _lookupValues for what happens when two values have the
+        # same hash.
+        merged = False
         for name in self.indexedValues:
             yield self.table(
                 name,
                 SA.Column('id', SA.Integer, primary_key=True),
-                SA.Column('value', SA.String(255, **kw)),
-                unique_value=['value']
+                SA.Column('hash', SA.BigInteger),
+                SA.Column('value', SA.Text(**kw)),
+                **{'unique_{}_hash'.format(name): ['hash']}
             )
+            yield self.q.deferToThread(self._addHashColumn, name, kw)
+            wasMerged = yield self.q.deferToThread(self._uniqueHash, name)
+            merged = merged or wasMerged
         yield self.table(
             'files',
             SA.Column(
@@ -216,18 +400,80 @@ class Transactor(AccessBroker, util.Base):
             SA.Column('bytes', SA.Integer),
             SA.Column('records', SA.Integer),
         )
+        yield self.table(
+            'spans',
+            SA.Column(
+                'name', SA.String(255), primary_key=True),
+            SA.Column('dt', SA.DateTime),
+            SA.Column('bytes', SA.BigInteger),
+            SA.Column('first', SA.DateTime),
+            SA.Column('last', SA.DateTime),
+        )
+        yield self.table(
+            'watermarks',
+            SA.Column(
+                'source', SA.String(255), primary_key=True),
+            SA.Column('dt', SA.DateTime),
+        )
+        hadRollups = yield self.q.deferToThread(
+            lambda: 'rollup_hits' in SA.inspect(
+                self.q.engine).get_table_names())
+        if hadRollups or self.rollups:
+            self.rollups = True
+            yield self.table(
+                'rollup_hits',
+                SA.Column('day', SA.Date),
+                SA.Column('id_vhost', SA.Integer),
+                SA.Column('id_url', SA.Integer),
+                SA.Column('http', SA.SmallInteger),
+                SA.Column('hits', SA.Integer),
+                unique_rollup_hits=list(self.rollupKeys['rollup_hits']))
+            yield self.table(
+                'rollup_visitors',
+                SA.Column('day', SA.Date),
+                SA.Column('id_vhost', SA.Integer),
+                SA.Column('ip', SA.String(15)),
+                SA.Column('hits', SA.Integer),
+                unique_rollup_visitors=list(
+                    self.rollupKeys['rollup_visitors']),
+                index_rollup_visitors_ip=['ip'])
+            if hadRollups and merged:
+                # Entries were changed or deleted, see _uniqueHash
+                yield self.q.deferToThread(
+                    self._emptyTables, 'rollup_hits', 'rollup_visitors')
+            if merged or not hadRollups:
+                yield self.q.deferToThread(self._backfillRollups)
+        hadSketches = yield self.q.deferToThread(
+            lambda: 'visitor_sketches' in SA.inspect(
+                self.q.engine).get_table_names())
+        if hadSketches or self.sketches:
+            self.sketches = True
+            yield self.table(
+                'visitor_sketches',
+                SA.Column('day', SA.Date),
+                SA.Column('id_vhost', SA.Integer),
+                SA.Column('id_url', SA.Integer),
+                SA.Column('registers', SA.LargeBinary),
+                unique_visitor_sketches=['day', 'id_vhost', 'id_url'])
+            if hadSketches and merged:
+                yield self.q.deferToThread(
+                    self._emptyTables, 'visitor_sketches')
+            if merged or not hadSketches:
+                yield self.q.deferToThread(self._backfillSketches)
         self.pendingID = {}
         self.dtk = DTK()
         self.ipm = IPMatcher()
         self.idTable = {}
         for name in self.indexedValues:
-            self.idTable[name] = {}
+            self.idTable[name] = IDCache(self.idCacheSize)
 
             
     # Public API
     # -------------------------------------------------------------------------
         
-    def preload(self, progressCall=None, N_batch=10, N_progress=100):
+    def preload(
+            self, progressCall=None, N_batch=10, N_progress=100,
+            ipFilter=None):
         """
         Loads my DTK object from the database. Returns a C{Deferred} that
         fires with the number of IPs in the database.
@@ -235,7 +481,19 @@ class Transactor(AccessBroker, util.Base):
         You can use the DTK object via L{dtk} in the meantime; doing
         so will save you more and more time as the entries load from
         the database.
+
+        If I only write entries for some IP addresses, supply a
+        callable I{ipFilter} that returns C{True} for those, and my
+        IP matcher will only be loaded with them.
         """
+        def addIP(ip):
+            ip = self._ipOut(ip)
+            if ipFilter is None or ipFilter(ip):
+                self.ipm.addIP(ip)
+
+        def setDT(dt):
+            self.dtk.set(self._dtOut(dt))
+        
         def load(colName, f, **kw):
             consumer = PreloadConsumer(f, **kw)
             s = self.select([getattr(col, colName)], distinct=True)
@@ -243,13 +501,14 @@ class Transactor(AccessBroker, util.Base):
 
         @defer.inlineCallbacks
         def run():
+            # IDs of recently used values
+            yield self._preloadIDs(self.idCacheSize)
             # DTK, which we don't need to wait for
-            load('dt', self.dtk.set).addCallback(
+            load('dt', setDT).addCallback(
                 lambda _: self.dtk.isPending(False))
             # IP matcher, which we do
             yield load(
-                'ip', self.ipm.addIP,
-                progressCall=progressCall, N=N_progress)
+                'ip', addIP, progressCall=progressCall, N=N_progress)
             defer.returnValue(len(self.ipm))
 
         col = self.entries.c
@@ -267,46 +526,180 @@ class Transactor(AccessBroker, util.Base):
         
         """
         self.ipm.addIP(record['ip'])
-        # Build list of values and indexed-value IDs
-        values = [record[x] for x in self.directValues]
+        # Build list of values and indexed-value IDs, looking up any
+        # that we haven't set already in a single transaction
+        IDs, unknown = {}, {}
         for name in self.indexedValues:
-            value = record[name][:255]
-            if value in self.idTable[name]:
-                # We've set this value already
-                ID = self.idTable[name][value]
+            value = record[name]
+            ID = self.idTable[name].get(value)
+            if ID is None:
+                unknown[name] = [value]
             else:
-                ID = yield self.setNameValue(name, value, niceness=-15)
+                IDs[name] = ID
+        if unknown:
+            newIDs = yield self.valueIDs(unknown, niceness=-15)
+            for name, theseIDs in newIDs.iteritems():
+                value = record[name]
+                IDs[name] = theseIDs[value]
                 # Add to idTable for future reference, avoiding DB checks
-                self.idTable[name][value] = ID
-            values.append(ID)
+                self.idTable[name][value] = IDs[name]
+        values = [record[x] for x in self.directValues]
+        for name in self.indexedValues:
+            values.append(IDs[name])
         # With this next line commented out and result = False
         # instead, the memory leak still persists. CPU time for the
         # main process was 66% of normal.
         result = yield self.setEntry(dt, values)
         defer.returnValue(result)
 
-    @wait
+    @transact
+    def valueIDs(self, values):
+        """
+        Returns a dict with a dict of IDs of the supplied values for
+        each name in the dict I{values}, each a list of values for
+        the table of that name. The ones that aren't there yet get
+        added. It's all done in a single transaction.
+        """
+        result = {}
+        for name, theseValues in values.iteritems():
+            result[name] = self._valueIDs(name, theseValues)
+        return result
+    
+    @transact
+    def setRecords(self, records):
+        """
+        Adds all needed database entries for each of the supplied
+        (dt, record) tuples, in a single transaction.
+
+        Everything is done with the transaction's own connection, the
+        IDs of all the values that aren't in my I{idTable} are looked
+        up (or added) together, and the new entries are inserted all
+        at once. That makes this much faster than calling L{setRecord}
+        for each record.
+
+        @return: A C{Deferred} that fires with the number of new
+          entries added.
+        
+        """
+        def valueIDs(name):
+            cache = self.idTable[name]
+            result, unknown = {}, set()
+            for dt, record in records:
+                value = record[name]
+                if value in result or value in unknown:
+                    continue
+                ID = cache.get(value)
+                if ID is None:
+                    unknown.add(value)
+                else:
+                    result[value] = ID
+            if unknown:
+                for value, ID in self._valueIDs(name, unknown).iteritems():
+                    result[value] = ID
+                    cache[value] = ID
+            return result
+        
+        def isDuplicate(dt, values):
+            if (dt, tuple(values)) in newEntries:
+                return True
+            if self.dtk.isPending() or self.dtk.check(dt):
+                cols = [getattr(self.entries.c, x) for x in self.colNames]
+                s = SA.select(cols, self.entries.c.dt == self._dt(dt))
+                dbValues = [self._ip(values[0])] + values[1:]
+                for row in conn.execute(s):
+                    if list(row) == dbValues:
+                        return True
+            return False
+        
+        conn = self.connection
+        kwList = []
+        newEntries = set()
+        # The cache may not have room for all of these
+        IDs = {}
+        for name in self.indexedValues:
+            IDs[name] = valueIDs(name)
+        for dt, record in records:
+            self.ipm.addIP(record['ip'])
+            values = [record[x] for x in self.directValues]
+            for name in self.indexedValues:
+                values.append(IDs[name][record[name]])
+            if isDuplicate(dt, values):
+                continue
+            newEntries.add((dt, tuple(values)))
+            self.dtk.set(dt)
+            kw = dict(zip(self.colNames, values))
+            kw['dt'] = self._dt(dt)
+            kw['ip'] = self._ip(kw['ip'])
+            kwList.append(kw)
+        if kwList:
+            conn.execute(self.entries.insert(), kwList)
+            self._entriesAdded([
+                (dt, values[0], values[3], values[4], values[1])
+                for dt, values in newEntries])
+        return len(kwList)
+
+    @transact
     def getRecords(self, dt):
         """
         Returns a (deferred) list of all the records for the specified
         datetime, in the order they were originally written.
 
-        Note: This method requires DB connection pooling.
-        """
-        def done(null):
-            return lc().addCallback(gotList)
-        def gotList(recordList):
-            return [xy[1] for xy in sorted(recordList, key=lambda xy: xy[0])]
-        if self.singleton:
-            raise util.DatabaseError(
-                "Database must support connection pooling")
-        lc = RecordConsumer(t=self)
-        # I got into trouble ignoring the deferred returned from the
-        # transaction that fires when all iterations are done. Calling
-        # this after setRecord doesn't work unless I wait for the
-        # iterations-done deferred and ALSO (then?) call the
-        # ListConsumer. Weird.
-        return self.getEntries(dt, consumer=lc).addCallback(done)
+        The records come from a single query, with the indexed values
+        joined in from their tables.
+        """
+        s = self._recordsSelect().where(
+            self.entries.c.dt == self._dt(dt)).order_by(self.entries.c.id)
+        return [self._rowToRecord(row)[1]
+                for row in self.connection.execute(s)]
+
+    @defer.inlineCallbacks
+    def getRecordsBetween(self, dt0, dt1, f, N_chunk=1000):
+        """
+        Calls I{f} with each successive chunk of up to I{N_chunk}
+        (dt, record) tuples for the entries from datetime I{dt0} up
+        to, but not including, datetime I{dt1}, in chronological
+        order. If I{f} returns a C{Deferred}, the next chunk isn't
+        fetched until it fires.
+
+        Each chunk is fetched in its own transaction, picking up after
+        the last entry of the one before it, so a big range can be
+        exported without ever having all of it in memory.
+        
+        @return: A C{Deferred} that fires with the total number of
+          records when they have all been supplied to I{f}.
+        """
+        N, lastKey = 0, None
+        while True:
+            chunk, lastKey = yield self._recordsChunk(
+                dt0, dt1, lastKey, N_chunk)
+            if not chunk:
+                break
+            N += len(chunk)
+            yield defer.maybeDeferred(f, chunk)
+            if len(chunk) < N_chunk:
+                break
+        defer.returnValue(N)
+
+    @transact
+    def _recordsChunk(self, dt0, dt1, lastKey, N):
+        """
+        Returns a list of up to I{N} (dt, record) tuples from
+        I{dt0} to I{dt1}, after the entry with the (dt, id) of
+        I{lastKey} if it isn't C{None}, along with the (dt, id) of the
+        last one.
+        """
+        cols = self.entries.c
+        where = [cols.dt >= self._dt(dt0), cols.dt < self._dt(dt1)]
+        if lastKey is not None:
+            where.append(SA.or_(
+                cols.dt > lastKey[0],
+                SA.and_(cols.dt == lastKey[0], cols.id > lastKey[1])))
+        s = self._recordsSelect().where(
+            SA.and_(*where)).order_by(cols.dt, cols.id).limit(N)
+        rows = self.connection.execute(s).fetchall()
+        if rows:
+            lastKey = (rows[-1][1], rows[-1][0])
+        return [self._rowToRecord(row) for row in rows], lastKey
         
     @transact
     def purgeIP(self, ip, ignoreIPM=False):
@@ -320,9 +713,15 @@ class Transactor(AccessBroker, util.Base):
             # The in-database IP matcher says it's in the database so it
             # needs to be removed...
             self.ipm.removeIP(ip)
+            if self.rollups:
+                self._purgeRollups(ip)
+            if self.sketches:
+                dayVhosts = self._sketchKeysForIP(ip)
             with self.selex(self.entries.delete) as sh:
-                sh.where(self.entries.c.ip == ip)
+                sh.where(self.entries.c.ip == self._ip(ip))
                 result = sh().rowcount
+            if self.sketches:
+                self._rebuildSketches(dayVhosts)
         else:
             # No purge needed
             result = 0
@@ -335,7 +734,7 @@ class Transactor(AccessBroker, util.Base):
         """
         cols = self.entries.c
         with self.selex(SA.func.count(cols.http)) as sh:
-            sh.where(cols.ip == ip)
+            sh.where(cols.ip == self._ip(ip))
             result = sh().scalar()
         return result
 
@@ -371,9 +770,600 @@ class Transactor(AccessBroker, util.Base):
                 cols.name == SA.bindparam('name'))
         return self.s().execute(name=fileName).first()
 
+    @transact
+    def fileSpan(self, fileName, *args):
+        """
+        With just I{fileName} as an argument, returns the modification
+        datetime and size of the file when its time span was last
+        found, along with the first and last timestamps of its lines,
+        or C{None} if it hasn't been.
+
+        With four additional arguments of a modification datetime, an
+        integer file size, and the first and last timestamps, the
+        method updates or inserts an entry for the file.
+        """
+        cols = self.spans.c
+        if args:
+            kw = dict(zip(('dt', 'bytes', 'first', 'last'), args))
+            if self.fileSpan(fileName):
+                self.spans.update(cols.name == fileName).execute(**kw)
+            else:
+                self.spans.insert().execute(name=fileName, **kw)
+            return
+        s = SA.select(
+            [cols.dt, cols.bytes, cols.first, cols.last],
+            cols.name == fileName)
+        return s.execute().first()
+    
+    @transact
+    def getWatermarks(self):
+        """
+        Returns a (deferred) dict of the latest timestamp of all the
+        lines that have been parsed from each logfile source. See
+        L{logread.Reader.source}.
+        """
+        return dict(self.watermarks.select().execute().fetchall())
+
+    @transact
+    def setWatermark(self, source, dt):
+        """
+        Sets the watermark for the named logfile source to the supplied
+        datetime, unless it's already later than that.
+        """
+        cols = self.watermarks.c
+        rp = self.watermarks.update().where(
+            SA.and_(cols.source == source, cols.dt < dt)).execute(dt=dt)
+        if not rp.rowcount:
+            s = SA.select([cols.dt], cols.source == source)
+            if s.execute().first() is None:
+                self.watermarks.insert().execute(source=source, dt=dt)
+
+    def sizes(self):
+        """
+        Returns a dict of the number of items held by my big in-memory
+        structures: the timestamps in my L{DTK} (I{dtk}), the IP
+        addresses in my IP matcher (I{db.ipm}), and the values in the
+        ID caches of my I{idTable}. The structures don't exist until
+        I've started up.
+        """
+        result = {}
+        if hasattr(self, 'dtk'):
+            result['dtk'] = len(self.dtk)
+            result['db.ipm'] = len(self.ipm)
+            result['idTable'] = sum([len(x) for x in self.idTable.values()])
+        return result
+
     # More or less internal methods
     # -------------------------------------------------------------------------
 
+    def _dt(self, dt):
+        return dtToEpoch(dt) if self.compact else dt
+
+    def _dtOut(self, x):
+        return epochToDT(x) if self.compact else x
+    
+    def _ip(self, ip):
+        return ipToInt(ip) if self.compact else ip
+
+    def _ipOut(self, x):
+        return intToIP(x) if self.compact else x
+
+    def _recordsSelect(self):
+        """
+        Returns a select of the ID, datetime, and all the values of
+        my entries, with the indexed values joined in from their
+        tables.
+        """
+        cols = self.entries.c
+        cList = [cols.id, cols.dt]
+        cList += [getattr(cols, x) for x in self.directValues]
+        joined = self.entries
+        for name in self.indexedValues:
+            table = getattr(self, name)
+            cList.append(table.c.value)
+            joined = joined.join(
+                table, table.c.id == getattr(cols, "id_{}".format(name)))
+        return SA.select(cList, from_obj=[joined], use_labels=True)
+
+    def _rowToRecord(self, row):
+        """
+        Returns a (dt, record) tuple for a row from the select of
+        L{_recordsSelect}.
+        """
+        record = dict(zip(self.directValues + self.indexedValues, row[2:]))
+        record['ip'] = self._ipOut(record['ip'])
+        return self._dtOut(row[1]), record
+    
+    def _isCompact(self):
+        """
+        Returns C{True} if my entries are, or are to be, stored in the
+        compact I{entries_c} table. Runs in my thread during startup.
+        """
+        tableNames = SA.inspect(self.q.engine).get_table_names()
+        if 'entries_c' in tableNames:
+            if 'entries' not in tableNames:
+                return True
+            self.msgWarning(
+                "Database has both 'entries' and 'entries_c' tables, "+\
+                "using 'entries'. Run la-compact to finish migrating it.")
+            return False
+        if self.compact and 'entries' in tableNames:
+            self.msgWarning(
+                "Database has a regular 'entries' table. "+\
+                "Run la-compact to migrate it to the compact schema.")
+            return False
+        return self.compact
+
+    def _createView(self):
+        """
+        Creates the I{entries} view of my compact I{entries_c} table if
+        it doesn't exist yet. Runs in my thread during startup.
+        """
+        engine = self.q.engine
+        if 'entries' not in SA.inspect(engine).get_view_names():
+            engine.execute(entriesViewSQL(engine))
+    
+    def _entriesAdded(self, rows):
+        """
+        Updates my rollup tables and sketches, if I have them, for the
+        supplied rows of (dt, ip, id_vhost, id_url, http) that were
+        just added. Call in a transaction.
+        """
+        if self.rollups:
+            self._updateRollups(rows)
+        if self.sketches:
+            self._updateSketches(rows)
+    
+    def _rollupCounts(self, rows):
+        """
+        Returns dicts of hit counts for each key of my I{rollup_hits}
+        and I{rollup_visitors} tables, for the supplied rows of (dt,
+        ip, id_vhost, id_url, http).
+        """
+        hits, visitors = {}, {}
+        for dt, ip, id_vhost, id_url, http in rows:
+            day = dt.date()
+            key = (day, id_vhost, id_url, http)
+            hits[key] = hits.get(key, 0) + 1
+            key = (day, id_vhost, ip)
+            visitors[key] = visitors.get(key, 0) + 1
+        return hits, visitors
+
+    def _bumpRollup(self, name, counts, sign=1):
+        """
+        Adds (or, with a negative I{sign}, subtracts) the supplied dict
+        of hit counts to the named rollup table. Rows whose hits drop
+        to zero are deleted. Call in a transaction.
+        """
+        table = getattr(self, name)
+        keyNames = self.rollupKeys[name]
+        where = SA.and_(*[
+            getattr(table.c, x) == SA.bindparam("k_"+x) for x in keyNames])
+        s_update = table.update().where(where).values(
+            hits=table.c.hits + SA.bindparam('N'))
+        for key, N in counts.iteritems():
+            kw = {"k_"+x: key[k] for k, x in enumerate(keyNames)}
+            kw['N'] = sign*N
+            if self.connection.execute(s_update, **kw).rowcount:
+                if sign < 0:
+                    self.connection.execute(
+                        table.delete().where(SA.and_(where, table.c.hits <= 0)),
+                        **kw)
+                continue
+            if sign < 0:
+                continue
+            try:
+                self.connection.execute(
+                    table.insert(), hits=N, **dict(zip(keyNames, key)))
+            except SA.exc.IntegrityError:
+                # Another writer process just inserted it
+                self.connection.execute(s_update, **kw)
+        
+    def _updateRollups(self, rows):
+        """
+        Adds hits to my rollup tables for the supplied rows of (dt, ip,
+        id_vhost, id_url, http). Call in a transaction.
+        """
+        hits, visitors = self._rollupCounts(rows)
+        self._bumpRollup('rollup_hits', hits)
+        self._bumpRollup('rollup_visitors', visitors)
+
+    def _purgeRollups(self, ip):
+        """
+        Subtracts the entries of the supplied IP address from my rollup
+        tables. Call in a transaction, before the entries are deleted.
+        """
+        cols = self.entries.c
+        s = SA.select(
+            [cols.dt, cols.id_vhost, cols.id_url, cols.http],
+            cols.ip == self._ip(ip))
+        rows = [(self._dtOut(x[0]), ip) + tuple(x[1:])
+                for x in self.connection.execute(s)]
+        hits, visitors = self._rollupCounts(rows)
+        self._bumpRollup('rollup_hits', hits, -1)
+        self.connection.execute(
+            self.rollup_visitors.delete().where(
+                self.rollup_visitors.c.ip == ip))
+
+    def _backfillRollups(self, N_batch=10000):
+        """
+        Fills my newly created rollup tables from the entries already
+        in the database. Runs in my thread during startup.
+        """
+        cols = self.entries.c
+        s = SA.select(
+            [cols.id, cols.dt, cols.ip, cols.id_vhost, cols.id_url, cols.http]
+        ).order_by(cols.id).limit(N_batch)
+        lastID = None
+        with self.connection.begin():
+            while True:
+                if lastID is None:
+                    rows = self.connection.execute(s).fetchall()
+                else:
+                    rows = self.connection.execute(
+                        s.where(cols.id > lastID)).fetchall()
+                if not rows:
+                    break
+                if lastID is None:
+                    self.msgWarning(
+                        "Filling rollup tables from entries, please wait...")
+                lastID = rows[-1][0]
+                self._updateRollups([
+                    (self._dtOut(x[1]), self._ipOut(x[2])) + tuple(x[3:])
+                    for x in rows])
+
+    def _sketchIPs(self, rows):
+        """
+        Returns a dict of sets of IP addresses for each key of my
+        I{visitor_sketches} table, for the supplied rows of (dt, ip,
+        id_vhost, id_url).
+        """
+        result = {}
+        for row in rows:
+            day = row[0].date()
+            for key in ((day, row[2], row[3]), (day, row[2], 0)):
+                result.setdefault(key, set()).add(row[1])
+        return result
+
+    def _sketchWhere(self, key):
+        cols = self.visitor_sketches.c
+        return SA.and_(
+            cols.day == key[0], cols.id_vhost == key[1], cols.id_url == key[2])
+    
+    def _updateSketches(self, rows):
+        """
+        Adds the IP addresses of the supplied rows of (dt, ip, id_vhost,
+        id_url, ...) to my sketches. Call in a transaction.
+
+        A sketch is only written back if adding to it changed its
+        registers, which it usually doesn't for an IP address that's
+        already been seen that day.
+        """
+        table = self.visitor_sketches
+        for key, ips in self._sketchIPs(rows).iteritems():
+            where = self._sketchWhere(key)
+            s = SA.select([table.c.registers], where).with_for_update()
+            blob = self.connection.execute(s).scalar()
+            if blob is not None:
+                hll = HyperLogLog.fromBlob(blob)
+                if hll.update(ips):
+                    self.connection.execute(
+                        table.update().where(where).values(
+                            registers=hll.toBlob()))
+                continue
+            hll = HyperLogLog()
+            hll.update(ips)
+            try:
+                self.connection.execute(
+                    table.insert(), day=key[0], id_vhost=key[1],
+                    id_url=key[2], registers=hll.toBlob())
+            except SA.exc.IntegrityError:
+                # Another writer process just inserted it
+                blob = self.connection.execute(s).scalar()
+                hll.merge(HyperLogLog.fromBlob(blob))
+                self.connection.execute(
+                    table.update().where(where).values(
+                        registers=hll.toBlob()))
+
+    def _sketchKeysForIP(self, ip):
+        """
+        Returns a set of the (day, id_vhost) keys of the sketches that
+        have the supplied IP address in them. Call in a transaction,
+        before its entries are deleted.
+        """
+        cols = self.entries.c
+        s = SA.select([cols.dt, cols.id_vhost], cols.ip == self._ip(ip))
+        return set([
+            (self._dtOut(x[0]).date(), x[1])
+            for x in self.connection.execute(s)])
+
+    def _daySketches(self, day, id_vhost=None):
+        """
+        Returns a dict of new sketches for each key of my
+        I{visitor_sketches} table, built from the entries on the
+        specified day, and for just one vhost if I{id_vhost} is
+        specified.
+        """
+        cols = self.entries.c
+        dt = datetime.combine(day, datetime.min.time())
+        where = [
+            cols.dt >= self._dt(dt), cols.dt < self._dt(dt+timedelta(days=1))]
+        if id_vhost is not None:
+            where.append(cols.id_vhost == id_vhost)
+        s = SA.select(
+            [cols.dt, cols.ip, cols.id_vhost, cols.id_url], SA.and_(*where))
+        result = {}
+        rows = [(self._dtOut(x[0]), self._ipOut(x[1])) + tuple(x[2:])
+                for x in self.connection.execute(s)]
+        for key, ips in self._sketchIPs(rows).iteritems():
+            hll = result[key] = HyperLogLog()
+            hll.update(ips)
+        return result
+
+    def _insertSketches(self, sketches):
+        if sketches:
+            self.connection.execute(self.visitor_sketches.insert(), [
+                {'day': key[0], 'id_vhost': key[1], 'id_url': key[2],
+                 'registers': hll.toBlob()}
+                for key, hll in sketches.iteritems()])
+    
+    def _rebuildSketches(self, dayVhosts):
+        """
+        Rebuilds the sketches for each of the supplied (day, id_vhost)
+        keys from the remaining entries. A sketch can't have a value
+        removed from it, so this is how purged IP addresses get taken
+        out. Call in a transaction, after the entries are deleted.
+        """
+        cols = self.visitor_sketches.c
+        for day, id_vhost in dayVhosts:
+            self.connection.execute(self.visitor_sketches.delete().where(
+                SA.and_(cols.day == day, cols.id_vhost == id_vhost)))
+            self._insertSketches(self._daySketches(day, id_vhost))
+
+    def _backfillSketches(self):
+        """
+        Fills my newly created I{visitor_sketches} table from the entries
+        already in the database, one day at a time. Runs in my thread
+        during startup.
+        """
+        cols = self.entries.c
+        with self.connection.begin():
+            first, last = self.connection.execute(
+                SA.select([SA.func.min(cols.dt), SA.func.max(cols.dt)])).first()
+            if first is None:
+                return
+            self.msgWarning(
+                "Filling visitor_sketches table from entries, please wait...")
+            day, last = [self._dtOut(x).date() for x in (first, last)]
+            while day <= last:
+                self._insertSketches(self._daySketches(day))
+                day += timedelta(days=1)
+    
+    def _lookupValues(self, name, values, N_chunk=500):
+        """
+        Returns a dict of IDs for whichever of the supplied values are
+        in the named table, and a dict of the free hash slot to insert
+        each of the others into, looking them up I{N_chunk} at a
+        time. Call in a transaction.
+
+        The hash column has a unique index, so each value has its own
+        slot. That's the L{valueHash} of the value, unless a different
+        value with the same hash got there first. Then it's the first
+        slot after that one, see L{nextHash}, which isn't taken by
+        some other value.
+        """
+        table = getattr(self, name)
+        IDs, slots = {}, {}
+        values = list(values)
+        for k in xrange(0, len(values), N_chunk):
+            pending = {}
+            for value in values[k:k+N_chunk]:
+                pending[value] = valueHash(value)
+            while pending:
+                bySlot = {}
+                for value, slot in pending.iteritems():
+                    bySlot.setdefault(slot, []).append(value)
+                # The value comparison is done by the database, which
+                # may not return them exactly as they were supplied
+                s = SA.select(
+                    [table.c.id, table.c.hash, table.c.value], SA.and_(
+                        table.c.hash.in_(bySlot.keys()),
+                        table.c.value.in_(pending.keys())))
+                for ID, slot, dbValue in self.connection.execute(s):
+                    candidates = bySlot.pop(slot)
+                    value = candidates[0]
+                    if len(candidates) > 1 and dbValue in candidates:
+                        value = dbValue
+                    IDs[value] = ID
+                    del pending[value]
+                if not pending:
+                    break
+                s = SA.select([table.c.hash], table.c.hash.in_(bySlot.keys()))
+                taken = set([x[0] for x in self.connection.execute(s)])
+                for slot, candidates in bySlot.iteritems():
+                    for value in candidates:
+                        if slot in taken:
+                            pending[value] = nextHash(slot)
+                            continue
+                        slots[value] = slot
+                        taken.add(slot)
+                        del pending[value]
+        return IDs, slots
+
+    def _valueIDs(self, name, values):
+        """
+        Returns a dict of IDs for the supplied values in the named
+        table, adding the ones that aren't there yet with a single
+        multi-row insert. Call in a transaction.
+
+        If another writer process inserts some of the same values (or
+        takes their hash slots) first, the insert fails on the unique
+        hash index and the values are looked up again.
+        """
+        table = getattr(self, name)
+        result = {}
+        while values:
+            IDs, slots = self._lookupValues(name, values)
+            result.update(IDs)
+            if not slots:
+                break
+            try:
+                self.connection.execute(table.insert(), [
+                    {'hash': slot, 'value': value}
+                    for value, slot in slots.iteritems()])
+            except SA.exc.IntegrityError:
+                # Another writer process just inserted one of them
+                pass
+            values = slots.keys()
+        return result
+
+    @transact
+    def _preloadIDs(self, N):
+        """
+        Loads my I{idTable} with the IDs of the values used by the last
+        I{N} entries added. Returns the number of IDs loaded.
+        """
+        count = 0
+        cols = self.entries.c
+        for name in self.indexedValues:
+            table = getattr(self, name)
+            col = getattr(cols, "id_{}".format(name))
+            recent = SA.select([col]).order_by(
+                cols.id.desc()).limit(N).alias('recent')
+            joined = table.join(recent, table.c.id == recent.c[col.name])
+            s = SA.select(
+                [table.c.value, table.c.id], from_obj=[joined], distinct=True)
+            for value, ID in self.connection.execute(s):
+                self.idTable[name][value] = ID
+                count += 1
+        return count
+    
+    def _addHashColumn(self, name, kw):
+        """
+        Adds a hash column to the named value table, if it's from a
+        database made before there was one, and indexes it. Runs in
+        my thread during startup, before any transactions.
+
+        A MySQL value column gets changed from C{VARCHAR(255)} to
+        C{TEXT}, which first requires dropping the unique index on it.
+        """
+        engine = self.q.engine
+        inspector = SA.inspect(engine)
+        if 'hash' in [x['name'] for x in inspector.get_columns(name)]:
+            return
+        self.msgWarning(
+            "Adding hash column to '{}' table, please wait...", name)
+        table = getattr(self, name)
+        with engine.begin() as conn:
+            conn.execute("ALTER TABLE {} ADD COLUMN hash BIGINT".format(name))
+            if str(engine.url).startswith('mysql'):
+                for info in inspector.get_indexes(name):
+                    if info['column_names'] == ['value']:
+                        conn.execute("DROP INDEX {} ON {}".format(
+                            info['name'], name))
+                conn.execute(
+                    "ALTER TABLE {} MODIFY value TEXT COLLATE {}".format(
+                        name, kw['collation']))
+            rows = conn.execute(SA.select([table.c.id, table.c.value]))
+            params = [{'_id': ID, '_hash': valueHash(value)}
+                      for ID, value in rows]
+            if params:
+                conn.execute(
+                    table.update().where(
+                        table.c.id == SA.bindparam('_id')).values(
+                            hash=SA.bindparam('_hash')), params)
+
+    def _uniqueHash(self, name):
+        """
+        Gives the hash column of the named value table a unique index,
+        if it's from a database made when the index wasn't unique (or
+        there was no hash column). Runs in my thread during startup,
+        after L{_addHashColumn} and before any transactions. Returns
+        C{True} if any entries got changed or deleted.
+
+        Without a unique index, writer processes could store the same
+        value twice under different IDs. The duplicates are merged
+        into the one with the lowest ID, see L{_mergeValueID}, and any
+        different values with the same hash are moved to free hash
+        slots, see L{_lookupValues}.
+        """
+        engine = self.q.engine
+        table = getattr(self, name)
+        hashIndexes = [
+            x for x in SA.inspect(engine).get_indexes(name)
+            if x['column_names'] == ['hash']]
+        merged = False
+        if not [x for x in hashIndexes if x['unique']]:
+            self.msgWarning(
+                "Making hash index of '{}' table unique, please wait...",
+                name)
+            with engine.begin() as conn:
+                s = SA.select([table.c.hash]).group_by(
+                    table.c.hash).having(SA.func.count(table.c.id) > 1)
+                for slot, in conn.execute(s).fetchall():
+                    rows = conn.execute(SA.select(
+                        [table.c.id, table.c.value], table.c.hash == slot
+                    ).order_by(table.c.id)).fetchall()
+                    kept = []
+                    for ID, value in rows:
+                        for keptID, keptValue in kept:
+                            if value == keptValue:
+                                self._mergeValueID(conn, name, ID, keptID)
+                                merged = True
+                                break
+                        else:
+                            kept.append((ID, value))
+                    for ID, value in kept[1:]:
+                        newSlot = nextHash(slot)
+                        while conn.execute(SA.select(
+                                [table.c.id],
+                                table.c.hash == newSlot)).first():
+                            newSlot = nextHash(newSlot)
+                        conn.execute(table.update().where(
+                            table.c.id == ID).values(hash=newSlot))
+            SA.Index(
+                'unique_{}_hash'.format(name),
+                table.c.hash, unique=True).create(engine)
+        for info in hashIndexes:
+            if not info['unique']:
+                SA.Index(info['name'], table.c.hash).drop(engine)
+        return merged
+
+    def _mergeValueID(self, conn, name, ID, keptID):
+        """
+        Changes the entries that use value I{ID} of the named table to
+        use I{keptID} for the same value instead, deleting any of them
+        that would then duplicate an entry already there, and then
+        deletes the row for I{ID}. Called by L{_uniqueHash} with its
+        connection I{conn}.
+        """
+        cols = self.entries.c
+        colName = "id_{}".format(name)
+        col = getattr(cols, colName)
+        valueCols = [getattr(cols, x) for x in self.colNames]
+        s = SA.select([cols.id, cols.dt] + valueCols, col == ID)
+        for row in conn.execute(s).fetchall():
+            where = [cols.dt == row[1]]
+            for k, x in enumerate(self.colNames):
+                where.append(valueCols[k] == (
+                    keptID if x == colName else row[k+2]))
+            if conn.execute(SA.select([cols.id], SA.and_(*where))).first():
+                conn.execute(self.entries.delete().where(cols.id == row[0]))
+            else:
+                conn.execute(self.entries.update().where(
+                    cols.id == row[0]).values(**{colName: keptID}))
+        table = getattr(self, name)
+        conn.execute(table.delete().where(table.c.id == ID))
+
+    def _emptyTables(self, *names):
+        """
+        Deletes all rows of the named tables, to have them filled again
+        from the entries. Runs in my thread during startup.
+        """
+        with self.q.engine.begin() as conn:
+            for name in names:
+                conn.execute(getattr(self, name).delete())
+
     @transact
     def insertEntry(self, dt, values):
         """
@@ -385,17 +1375,19 @@ class Transactor(AccessBroker, util.Base):
 
         Returns a unique integer ID for the new entry.
         """
-        kw = {'dt': dt}
+        kw = {'dt': self._dt(dt)}
         N = [len(x) for x in (self.colNames, values)]
         if N[0] > N[1]:
             self.msgWarning("Need {:d} values entries, only got {:d}", *N)
             return
         for k, name in enumerate(self.colNames):
             kw[name] = values[k]
+        kw['ip'] = self._ip(kw['ip'])
         rp = self.entries.insert().execute(**kw)
         ID = rp.lastrowid
         # Necessary?
         rp.close()
+        self._entriesAdded([(dt, values[0], values[3], values[4], values[1])])
         return ID
 
     @defer.inlineCallbacks
@@ -444,6 +1436,7 @@ class Transactor(AccessBroker, util.Base):
             return ID
 
         ID = None
+        values = [self._ip(values[0])] + list(values[1:])
         entries = yield self.getEntries(dt, asList=True)
         for theseValues in entries:
             ID = matchingValues()
@@ -463,7 +1456,7 @@ class Transactor(AccessBroker, util.Base):
             cList = [self.entries.c.id]
             cList += [getattr(col, x) for x in self.colNames]
             self.s(cList, col.dt == SA.bindparam('dt'))
-        return self.s().execute(dt=dt)
+        return self.s().execute(dt=self._dt(dt))
 
     @transact
     def setNameValue(self, name, value):
@@ -471,15 +1464,7 @@ class Transactor(AccessBroker, util.Base):
         Get the unique ID for this value in the named table, adding a new
         entry for it there if necessary.
         """
-        table = getattr(self, name)
-        if not self.s("s_{}".format(name)):
-            self.s([table.c.id], table.c.value == SA.bindparam('value'))
-        ID = self.s().execute(value=value).scalar()
-        if ID is None:
-            rp = table.insert().execute(value=value)
-            ID = rp.lastrowid
-            rp.close()
-        return ID
+        return self._valueIDs(name, [value])[value]
        
     @transact
     def _getValuesFromIDs(self, IDs):
@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# logalyzer:
+# Parses your bloated HTTP access logs to extract the info you want
+# about hits from (hopefully) real people instead of just the endless
+# stream of hackers and bots that passes for web traffic
+# nowadays. Stores the info in a relational database where you can
+# access it using all the power of SQL.
+#
+# Copyright (C) 2015, 2017, 2018 by Edwin A. Suominen,
+# http://edsuom.com/logalyzer
+#
+# See edsuom.com for API documentation as well as information about
+# Ed's background and other projects, software and otherwise.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the
+# License. You may obtain a copy of the License at
+# 
+#   http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an "AS
+# IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+
+
+"""
+Finding the logfiles to load.
+
+Each command-line argument after the database URL is a logfile, a
+directory with logfiles in it, or a glob pattern matching either. The
+directories get listed and everything in them gets stat'ed by a pool
+of threads, one level of directories at a time, since on a network
+filesystem each of those calls waits on a round trip. What comes out
+is a work list for L{logread.Reader.run}, with the stat of each
+logfile from when it was found, so it doesn't get done again.
+"""
+
+import os, os.path, stat, glob, fnmatch
+from multiprocessing.pool import ThreadPool
+
+
+class LogFile(object):
+    """
+    I am a logfile found by L{Discovery}, with the I{name} it's known
+    by in the database and the GUI, the I{path} to it, and the result
+    of C{os.stat} on it (I{stat}) from when it was found.
+    """
+    # About how many times more bytes a compressed logfile has to be
+    # read through than it has
+    gzipRatio = 8
+    
+    def __init__(self, name, path, stat):
+        self.name = name
+        self.path = path
+        self.stat = stat
+
+    def __repr__(self):
+        return "<LogFile {}>".format(self.name)
+        
+    @property
+    def work(self):
+        """
+        An estimate of the number of bytes that parsing me will take.
+        """
+        N = self.stat.st_size
+        if self.path.endswith('.gz'):
+            N *= self.gzipRatio
+        return N
+
+
+class Discovery(object):
+    """
+    I find logfiles in the specs you call me with: the paths of
+    logfiles or of directories with logfiles in them, or glob patterns
+    matching either.
+
+    A file in one of the directories is a logfile if its name matches
+    any of my I{include} glob patterns. With I{recursive} set, so is
+    one like that in any directory under it. A file named by a spec
+    or matched by a glob pattern of one is a logfile regardless. No
+    file or directory whose name, or path relative to the L{root} of
+    the spec it was found with, matches one of my I{exclude} patterns
+    is included.
+
+    The name of each logfile is its path relative to the root of its
+    spec, so it doesn't depend on what other specs there are. It's
+    just the file name for a logfile named by a spec or in a
+    directory named by one.
+    """
+    include = ("*access.log*",)
+    N_threads = 16
+    
+    def __init__(self, include=None, exclude=(), recursive=False):
+        if include:
+            self.include = include
+        self.exclude = exclude
+        self.recursive = recursive
+
+    @staticmethod
+    def matches(name, patterns):
+        for pattern in patterns:
+            if fnmatch.fnmatch(name, pattern):
+                return True
+        return False
+
+    def isExcluded(self, path, root):
+        return self.matches(os.path.basename(path), self.exclude) or \
+            self.matches(os.path.relpath(path, root), self.exclude)
+    
+    @staticmethod
+    def root(spec):
+        """
+        Returns the directory that the names of logfiles found with the
+        supplied glob pattern I{spec} are relative to: the deepest
+        one in it without any magic.
+        """
+        parts = spec.split(os.sep)
+        for k, part in enumerate(parts):
+            if glob.has_magic(part):
+                break
+        root = os.sep.join(parts[:k])
+        if root:
+            return root
+        return os.sep if spec.startswith(os.sep) else os.curdir
+
+    @staticmethod
+    def _stat(path):
+        try:
+            return os.stat(path)
+        except OSError:
+            pass
+
+    @staticmethod
+    def _listdir(path):
+        try:
+            return os.listdir(path)
+        except OSError:
+            return []
+        
+    def expand(self, specs):
+        """
+        Returns a list of (path, root) tuples for the paths in the
+        supplied I{specs}, with any glob patterns expanded to the paths
+        they match. The root is the L{root} of a glob pattern, or
+        C{None} for a spec that isn't one.
+        """
+        paths = []
+        for spec in specs:
+            spec = os.path.expanduser(spec)
+            if glob.has_magic(spec):
+                root = self.root(spec)
+                paths.extend([(x, root) for x in sorted(glob.glob(spec))])
+            else:
+                paths.append((spec, None))
+        return paths
+    
+    def __call__(self, specs):
+        """
+        Returns a list of L{LogFile} instances for the logfiles found in
+        the supplied I{specs}, biggest job first. That way, no worker
+        is left with a big logfile at the end while the others sit
+        idle.
+
+        Raises a C{ValueError} if a spec that isn't a glob pattern
+        names something that doesn't exist, or if two different
+        logfiles would have the same name.
+        """
+        def add(path, root, st):
+            if self.isExcluded(path, root):
+                return
+            path = os.path.abspath(path)
+            if path in found:
+                return
+            name = os.path.relpath(path, root)
+            if name in names:
+                raise ValueError((
+                    "Logfiles '{}' and '{}' would both be named '{}'; "+\
+                    "find them from a directory they're both under "+\
+                    "instead").format(names[name], path, name))
+            names[name] = path
+            found[path] = LogFile(name, path, st)
+
+        found, names = {}, {}
+        pool = ThreadPool(self.N_threads)
+        try:
+            paths = self.expand(specs)
+            stats = pool.map(self._stat, [x[0] for x in paths])
+            dirs, files = [], []
+            for (path, root), st in zip(paths, stats):
+                if st is None:
+                    if root is None:
+                        raise ValueError(
+                            "No file or directory '{}' found".format(path))
+                    continue
+                if stat.S_ISDIR(st.st_mode):
+                    dirs.append((path, root or path))
+                else:
+                    files.append((
+                        path, root or os.path.dirname(path) or os.curdir, st))
+            for path, root, st in files:
+                add(path, root, st)
+            seen = set([os.path.realpath(x[0]) for x in dirs])
+            while dirs:
+                # Everything in each directory of this level, for
+                # finding more of them, or just the logfiles
+                candidates = []
+                for (dirPath, root), dirNames in zip(
+                        dirs, pool.map(self._listdir, [x[0] for x in dirs])):
+                    for name in sorted(dirNames):
+                        if self.recursive or self.matches(name, self.include):
+                            candidates.append(
+                                (os.path.join(dirPath, name), root))
+                dirs = []
+                for (path, root), st in zip(
+                        candidates,
+                        pool.map(self._stat, [x[0] for x in candidates])):
+                    if st is None:
+                        continue
+                    if stat.S_ISDIR(st.st_mode):
+                        realPath = os.path.realpath(path)
+                        if self.recursive and realPath not in seen \
+                           and not self.isExcluded(path, root):
+                            seen.add(realPath)
+                            dirs.append((path, root))
+                    elif stat.S_ISREG(st.st_mode) and \
+                         self.matches(os.path.basename(path), self.include):
+                        add(path, root, st)
+        finally:
+            pool.close()
+            pool.join()
+        return sorted(found.values(), key=lambda x: (-x.work, x.name))
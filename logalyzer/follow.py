@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# logalyzer:
+# Parses your bloated HTTP access logs to extract the info you want
+# about hits from (hopefully) real people instead of just the endless
+# stream of hackers and bots that passes for web traffic
+# nowadays. Stores the info in a relational database where you can
+# access it using all the power of SQL.
+#
+# Copyright (C) 2015, 2017, 2018 by Edwin A. Suominen,
+# http://edsuom.com/logalyzer
+#
+# See edsuom.com for API documentation as well as information about
+# Ed's background and other projects, software and otherwise.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the
+# License. You may obtain a copy of the License at
+# 
+#   http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an "AS
+# IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+
+"""
+Following logfiles as they grow, for the I{--follow} mode of I{la}.
+
+A web server keeps appending lines to its current logfile until the
+logfile gets rotated, either by being renamed and replaced with a new
+file or by being copied and then truncated in place. I notice both
+from the inode and size of the file, so nothing written to it gets
+missed or parsed twice.
+"""
+
+import os, os.path
+
+
+class Tail(object):
+    """
+    I keep track of how far the growing logfile at I{filePath} has been
+    parsed.
+
+    Supply the C{os.stat} result for the file as of when it was last
+    parsed through to its end, or through byte I{offset} if you
+    specify that. If you don't supply a stat, the file gets followed
+    from its current end.
+    """
+    def __init__(self, filePath, stat=None, offset=None):
+        self.filePath = filePath
+        if stat is None:
+            stat = os.stat(filePath)
+        self.inode = stat.st_ino
+        self.offset = stat.st_size if offset is None else offset
+
+    @staticmethod
+    def lineEnd(filePath, start, end):
+        """
+        Returns the byte offset just past the last complete line of the
+        file at I{filePath} that begins at or after byte I{start} and
+        ends before byte I{end}, or I{start} if there is no such line.
+        """
+        with open(filePath, 'rb') as fh:
+            fh.seek(start)
+            data = fh.read(end - start)
+        return start + data.rfind('\n') + 1
+
+    @staticmethod
+    def lastLineEnd(filePath, end, N=65536):
+        """
+        Returns the byte offset just past the last complete line of the
+        file at I{filePath} that ends before byte I{end}, or zero if
+        there is no such line. The file is read backwards from
+        I{end}, I{N} bytes at a time.
+        """
+        start = end
+        while start > 0:
+            start = max([0, start - N])
+            k = Tail.lineEnd(filePath, start, end)
+            if k > start:
+                return k
+        return 0
+    
+    def renamed(self):
+        """
+        Returns the path of the file in my logfile's directory that has
+        the inode my logfile used to have, or C{None} if there's no
+        such file. That's where a logfile rotated by renaming it
+        went.
+        """
+        dirPath = os.path.dirname(self.filePath) or os.curdir
+        for fileName in os.listdir(dirPath):
+            filePath = os.path.join(dirPath, fileName)
+            try:
+                if os.stat(filePath).st_ino == self.inode:
+                    return filePath
+            except OSError:
+                pass
+
+    def check(self):
+        """
+        Returns a list of (filePath, start, end) tuples, one for each
+        range of bytes of lines that have been added to my logfile
+        since the last call, and advances past them.
+
+        If my logfile has been rotated by renaming it, whatever got
+        added to the old one before the rotation comes first, if the
+        old one can still be found in the same directory. Lines get
+        followed into the new one from its beginning. If my logfile
+        has been truncated, lines get followed from its beginning,
+        too.
+
+        Only complete lines are included, except for what's left at
+        the end of an old logfile.
+        """
+        ranges = []
+        try:
+            stat = os.stat(self.filePath)
+        except OSError:
+            # Renamed, and not yet replaced
+            stat = None
+        if stat is None or stat.st_ino != self.inode:
+            oldPath = self.renamed()
+            if oldPath:
+                size = os.path.getsize(oldPath)
+                if size > self.offset:
+                    ranges.append((oldPath, self.offset, size))
+                    self.offset = size
+            if stat is None:
+                return ranges
+            self.inode = stat.st_ino
+            self.offset = 0
+        elif stat.st_size < self.offset:
+            self.offset = 0
+        end = self.lineEnd(self.filePath, self.offset, stat.st_size)
+        if end > self.offset:
+            ranges.append((self.filePath, self.offset, end))
+            self.offset = end
+        return ranges
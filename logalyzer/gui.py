@@ -30,9 +30,9 @@
 Command-line text GUI using ncurses.
 """
 
-import sys, math
+import sys, time, math
 
-from twisted.internet import reactor, defer
+from twisted.internet import reactor, defer, task
 import twisted.python.log
 
 from asynqueue.info import Info
@@ -43,8 +43,11 @@ from urwid.raw_display import Screen
 class MessageBox(u.ListBox):
     """
     I am a message box consisting of a heading and an expandable space
-    for lines you can add under the heading.
+    for lines you can add under the heading. Only the last I{maxLines}
+    of them are kept.
     """
+    maxLines = 50
+    
     def __init__(self, text):
         """Constructor"""
         self.hText = text
@@ -66,7 +69,13 @@ class MessageBox(u.ListBox):
     def add(self, text):
         self.body.append(u.Text(('message', text)))
         self.setCurrent(True)
-        self.height += 1
+        if self.height > self.maxLines:
+            # Drop the oldest line, but not any progress counter
+            k = 1
+            if self.body[k] is getattr(self, 'pcWidget', None):
+                k += 1
+            del self.body[k]
+        else: self.height += 1
 
     def progress(self, N):
         """
@@ -94,13 +103,18 @@ class Messages(u.ListBox):
     anchor for messages. Each message will be appended below the
     heading with its ID.
 
+    Only the last I{maxBoxes} headings are kept, along with their
+    messages. Messages for a heading that's been dropped are ignored.
     """
     defaultHeight = 3
+    maxBoxes = 100
     orphanHeading = ""
     
     def __init__(self):
         """Constructor"""
         self.boxes = []
+        # The highest ID of a heading that's been dropped
+        self.droppedID = 0
         body = u.SimpleFocusListWalker([])
         super(Messages, self).__init__(body)
 
@@ -117,9 +131,20 @@ class Messages(u.ListBox):
         self.boxes.append(ID)
         msgBox = self.adapt(MessageBox(text))
         self.body.append(msgBox)
+        self._trim()
+
+    def _trim(self):
+        while len(self.boxes) > self.maxBoxes:
+            ID = self.boxes.pop(0)
+            if isinstance(ID, int):
+                self.droppedID = max([self.droppedID, ID])
+            del self.body[0]
 
     def _boxerator(self, ID):
         if ID not in self.boxes:
+            if isinstance(ID, int) and ID <= self.droppedID:
+                # The heading's been dropped
+                return
             raise IndexError(
                 "No heading for ID '{}'".format(ID))
         k = self.boxes.index(ID)
@@ -146,6 +171,7 @@ class Messages(u.ListBox):
             self.boxes.append(None)
             msgBox = self.adapt(MessageBox(self.orphanHeading))
             self.body.append(msgBox)
+            self._trim()
         # Orphan or not, there should be a heading now
         for msgBox in self._boxerator(ID):
             msgBox.add(text)
@@ -161,11 +187,19 @@ class Messages(u.ListBox):
             msgText.append((label, "\n" + line.rstrip()))
         msgBox = self.adapt(MessageBox(msgText), height=height)
         self.body.append(msgBox)
+        self._trim()
 
     def progress(self, ID, N):
         for msgBox in self._boxerator(ID):
             msgBox.progress(N)
 
+    def lines(self):
+        """
+        Returns the number of lines, headings included, that I'm holding
+        on to.
+        """
+        return sum([x.original_widget.height for x in self.body])
+
 
 class ProgressText(u.Text):
     """
@@ -289,6 +323,15 @@ class Files(u.GridFlow):
         the specified file.
         """
         self._row(fileName).step()
+
+    def progress(self, fileName, textProto, *args):
+        """
+        Gives the progress indicator for the specified file a spin and
+        updates its status with the supplied text.
+        """
+        row = self._row(fileName)
+        row.step()
+        row.setStatus(textProto.format(*args))
     
     def setStatus(self, fileName, textProto, *args):
         """
@@ -302,6 +345,96 @@ class Files(u.GridFlow):
         row.setStatus(textProto.format(*args))
 
 
+class Dashboard(u.Text):
+    """
+    I show how fast things are going, from the counts and gauges of a
+    L{stats.Stats} object: Lines parsed per second, overall and by
+    each worker; records inserted and IP addresses purged per second;
+    records waiting on the database and how many times a producer got
+    paused for that; the cache hit rate of each matcher; and the
+    resident memory of the main process.
+
+    The rates are figured over at least I{interval} seconds.
+    """
+    interval = 1.0
+
+    def __init__(self):
+        """Constructor"""
+        self.t0 = None
+        super(Dashboard, self).__init__("")
+
+    def rate(self, name, counts, dt):
+        return float(counts.get(name, 0) - self.counts.get(name, 0)) / dt
+
+    def cacheRates(self, counts):
+        """
+        Returns a list of 2-tuples, each with the name of a matcher and
+        the percentage of lookups its cache has answered.
+        """
+        result = []
+        for key in sorted(counts):
+            if not key.startswith('lookups.'):
+                continue
+            name = key.split('.', 1)[1]
+            lookups = counts[key]
+            if lookups:
+                pc = 100.0 * counts.get('hits.' + name, 0) / lookups
+                result.append((name.replace('Matcher', ''), pc))
+        return result
+    
+    def lines(self, snapshot, dt):
+        """
+        Returns the two lines of my text, given a new I{snapshot} of my
+        L{stats.Stats} object from I{dt} seconds after the last one.
+        """
+        counts = snapshot['counts']
+        workerRates = []
+        for pid in sorted(snapshot['workers']):
+            N = snapshot['workers'][pid].get('lines', 0)
+            N0 = self.workers.get(pid, {}).get('lines', 0)
+            workerRates.append("{:d}".format(int(round((N-N0) / dt))))
+        line = "Lines/s: {:d}".format(
+            int(round(self.rate('lines', counts, dt))))
+        if workerRates:
+            line += " ({})".format(", ".join(workerRates))
+        result = [
+            line + "  Records/s: {:d}  Purges/s: {:d}".format(
+                *[int(round(self.rate(x, counts, dt)))
+                  for x in ('added', 'purged')])]
+        gauges = snapshot['gauges']
+        line = "DB queue: {:d}  Pauses: {:d}".format(
+            gauges.get('inFlight', 0) or 0, gauges.get('paused', 0) or 0)
+        cacheRates = self.cacheRates(counts)
+        if cacheRates:
+            line += "  Cache hits: " + ", ".join(
+                ["{} {:.0f}%".format(*x) for x in cacheRates])
+        if gauges.get('rss', None):
+            line += "  RSS: {:d} MB".format(gauges['rss'] // 2**20)
+        result.append(line)
+        return result
+    
+    def refresh(self, stats, t=None):
+        """
+        Updates my text from a new snapshot of the supplied
+        L{stats.Stats} object if I{interval} seconds have passed since
+        the last one I used, returning C{True} if I did.
+
+        Supply a time I{t} to use instead of the current time.
+        """
+        if t is None:
+            t = time.time()
+        if self.t0 is not None and t - self.t0 < self.interval:
+            return False
+        snapshot = stats.snapshot()
+        updated = self.t0 is not None
+        if updated:
+            self.set_text("\n".join(self.lines(snapshot, t - self.t0)))
+        self.t0 = t
+        self.counts = snapshot['counts']
+        self.workers = snapshot['workers']
+        return updated
+
+
 class StdSubstitute(object):
     """
     Substitute sink for stdout and stderr when the GUI is used, to
@@ -335,8 +468,14 @@ class StdSubstitute(object):
 class GUI(object):
     """
     I am the main curses interface.
+
+    Progress parsing each file is shown from the counts in a
+    L{stats.Stats} object that I sample I{sampleRate} times a second,
+    not with a display update for every record. The rates and gauges
+    in my L{Dashboard} come from the same samples.
     """
     title = "Logalyzer"
+    sampleRate = 4
     
     palette = [
         # Name
@@ -367,9 +506,10 @@ class GUI(object):
         self.screen.register_palette(self.palette)
         self.screen.set_mouse_tracking(True)
 
-    def start(self, fileNames):
+    def start(self, fileNames, stats=None):
         """
-        Constructs my widgets and starts my event loop and main loop.
+        Constructs my widgets and starts my event loop and main loop,
+        and my sampling of any L{stats.Stats} object you supply.
         """
         def possiblyQuit(key):
             if key in ('q', 'Q'):
@@ -384,7 +524,11 @@ class GUI(object):
         # The top-level widgets
         self.m = Messages()
         self.f = Files(fileNames, self._dims()[0])
-        p = u.Pile([u.Divider("=", 1, 1), self.f, u.Divider(" ")])
+        widgets = [u.Divider("=", 1, 1), self.f, u.Divider(" ")]
+        if stats is not None:
+            self.d = Dashboard()
+            widgets.extend([u.Divider("-"), self.d])
+        p = u.Pile(widgets)
         main = u.WidgetWrap(
             u.LineBox(
                 u.Padding(
@@ -402,6 +546,12 @@ class GUI(object):
         twisted.python.log.addObserver(observer)
         self.running = True
         self.loop.start()
+        if stats is not None:
+            self.stats = stats
+            stats.sizer(lambda: {'messages': self.m.lines()})
+            self.sampled = {}
+            self.lc = task.LoopingCall(self.sample)
+            self.lc.start(1.0 / self.sampleRate)
     
     def _dims(self):
         # Deduct 4 from each dimension due to outline and padding
@@ -419,6 +569,29 @@ class GUI(object):
             self.f.updateWidth(width)
         self.loop.draw_screen()
 
+    def _fileCounts(self, fileName):
+        counts = self.stats.files.get(fileName, {})
+        return counts.get('added', 0), counts.get('parsed', 0)
+        
+    def sample(self):
+        """
+        Updates the progress shown for each of my files whose counts
+        have changed since the last time I was called, and my
+        dashboard if it's due for an update.
+        """
+        changed = hasattr(self, 'd') and self.d.refresh(self.stats)
+        for fileName in self.stats.files.keys():
+            if fileName not in self.f.fileNames:
+                continue
+            counts = self._fileCounts(fileName)
+            if counts == self.sampled.get(fileName, None):
+                continue
+            self.sampled[fileName] = counts
+            self.f.progress(fileName, "{:d}/{:d}", *counts)
+            changed = True
+        if changed:
+            self.update()
+    
     def stop(self):
         """
         Tears down the GUI display. This will be called by
@@ -428,6 +601,8 @@ class GUI(object):
         if self.running and not hasattr(self, '_shutdownFlag'):
             self._shutdownFlag = None
             self.running = False
+            if hasattr(self, 'lc') and self.lc.running:
+                self.lc.stop()
             self.screen.unhook_event_loop(self.loop)
             self.loop.stop()
     
@@ -492,8 +667,14 @@ class GUI(object):
         formatting arguments, the progress indicator is reset and the
         brief status text following the filename is updated.
         """
+        if fileName not in self.f.fileNames:
+            # Not a file in my list, like a source of syslog messages
+            return
         if args:
             self.f.setStatus(fileName, *args)
+            if hasattr(self, 'sampled'):
+                # Don't let a sample of stale counts cover this up
+                self.sampled[fileName] = self._fileCounts(fileName)
         else:
             self.f.indicator(fileName)
         self.update()
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# logalyzer:
+# Parses your bloated HTTP access logs to extract the info you want
+# about hits from (hopefully) real people instead of just the endless
+# stream of hackers and bots that passes for web traffic
+# nowadays. Stores the info in a relational database where you can
+# access it using all the power of SQL.
+#
+# Copyright (C) 2015, 2017, 2018 by Edwin A. Suominen,
+# http://edsuom.com/logalyzer
+#
+# See edsuom.com for API documentation as well as information about
+# Ed's background and other projects, software and otherwise.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the
+# License. You may obtain a copy of the License at
+# 
+#   http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an "AS
+# IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+
+"""
+HyperLogLog sketches for approximate counts of unique IP addresses.
+
+A sketch of 4096 one-byte registers estimates the number of distinct
+values added to it within about 1.6%, no matter how many there
+are. Sketches can be merged to count the distinct values added to
+any of them, which is what makes them useful for counting unique
+visitors over arbitrary date ranges from per-day sketches.
+"""
+
+import math, struct, zlib, hashlib
+
+
+class HyperLogLog(object):
+    """
+    I am a HyperLogLog sketch with 2^I{p} registers.
+
+    Use L{toBlob} and L{fromBlob} to store and retrieve me as a
+    compressed string of my registers.
+    """
+    p = 12
+
+    def __init__(self, registers=None):
+        self.m = 1 << self.p
+        if registers is None:
+            registers = bytearray(self.m)
+        elif len(registers) != self.m:
+            raise ValueError(
+                "Need {:d} registers, got {:d}".format(self.m, len(registers)))
+        self.registers = registers
+
+    @classmethod
+    def fromBlob(cls, blob):
+        """
+        Returns a new instance of me with registers from the supplied
+        blob that was returned by L{toBlob}.
+        """
+        return cls(bytearray(zlib.decompress(blob)))
+
+    def toBlob(self):
+        """
+        Returns my registers as a compressed string. A sketch of just a
+        few values compresses to a few dozen bytes.
+        """
+        return zlib.compress(bytes(self.registers))
+
+    def add(self, value):
+        """
+        Adds the supplied string value to me, returning C{True} if that
+        changed any of my registers.
+        """
+        x = struct.unpack('<Q', hashlib.md5(value).digest()[:8])[0]
+        k = x >> (64 - self.p)
+        w = x & ((1 << (64 - self.p)) - 1)
+        # Position of the leftmost 1 bit in the remaining bits
+        rank = 64 - self.p - w.bit_length() + 1
+        if rank > self.registers[k]:
+            self.registers[k] = rank
+            return True
+        return False
+
+    def update(self, values):
+        """
+        Adds each of the supplied string values to me, returning
+        C{True} if that changed any of my registers.
+        """
+        changed = False
+        for value in values:
+            if self.add(value):
+                changed = True
+        return changed
+
+    def merge(self, other):
+        """
+        Merges the registers of another instance of me into mine, so
+        that I count everything that either of us counted. Returns
+        C{True} if that changed any of my registers.
+        """
+        changed = False
+        registers = self.registers
+        for k, x in enumerate(other.registers):
+            if x > registers[k]:
+                registers[k] = x
+                changed = True
+        return changed
+
+    def __len__(self):
+        return int(round(self.count()))
+
+    def count(self):
+        """
+        Returns my estimate of how many distinct values have been added
+        to me, with linear counting for small cardinalities.
+        """
+        m = self.m
+        alpha = 0.7213 / (1 + 1.079/m)
+        E = alpha * m * m / sum([2.0**-x for x in self.registers])
+        if E <= 2.5*m:
+            zeros = self.registers.count(b'\x00')
+            if zeros:
+                E = m * math.log(float(m) / zeros)
+        return E
@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# logalyzer:
+# Parses your bloated HTTP access logs to extract the info you want
+# about hits from (hopefully) real people instead of just the endless
+# stream of hackers and bots that passes for web traffic
+# nowadays. Stores the info in a relational database where you can
+# access it using all the power of SQL.
+#
+# Copyright (C) 2015, 2017, 2018 by Edwin A. Suominen,
+# http://edsuom.com/logalyzer
+#
+# See edsuom.com for API documentation as well as information about
+# Ed's background and other projects, software and otherwise.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the
+# License. You may obtain a copy of the License at
+# 
+#   http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an "AS
+# IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+
+"""
+Receiving logfile lines as syslog messages over the network, for
+the I{--listen} mode of I{la}.
+
+Web servers that ship their access logs over syslog send each line as
+a message, in a UDP datagram or over a TCP connection with either
+octet-counting or newline framing (RFC 6587). I take the logfile line
+out of each message and have the lines parsed in batches, one source
+at a time, by the same workers and record keeper as lines from
+logfiles.
+"""
+
+import re, socket
+
+from twisted.internet import reactor, defer, protocol
+
+from asynqueue.util import DeferredTracker
+
+from util import oops, Base
+
+
+reSyslog = re.compile(
+    r'(?:<\d{1,3}>)?(?:' +\
+    # RFC 5424: VERSION TIMESTAMP HOSTNAME APP-NAME PROCID MSGID SD
+    r'\d{1,2} \S+ (?P<host5424>\S+) \S+ \S+ \S+ ' +\
+    r'(?:-|(?:\[.*?(?<!\\)\])+) ?(?:\xef\xbb\xbf)?' +\
+    # RFC 3164: TIMESTAMP [HOSTNAME] TAG[PID]:
+    r'|[A-Z][a-z]{2} [ \d]\d \d\d:\d\d:\d\d ' +\
+    r'(?:(?P<host3164>[^\s:]+) )?[^\s:\[]+(?:\[\d+\])?: ?' +\
+    r')?(?P<line>.*?)\s*$', re.DOTALL)
+
+def parseSyslog(message):
+    """
+    Returns a 2-tuple with the hostname in the header of the supplied
+    syslog message, or C{None} if there isn't one, and the logfile
+    line that's in the message.
+
+    Messages in both the RFC 5424 and the older BSD (RFC 3164) format
+    are understood. Anything else is taken as the line itself.
+    """
+    match = reSyslog.match(message)
+    host = match.group('host5424') or match.group('host3164')
+    if host == "-":
+        host = None
+    return host, match.group('line')
+
+def parseAddress(text):
+    """
+    Returns a 2-tuple with the integer port and the interface (an
+    empty string for all of them) of the supplied [HOST:]PORT text,
+    or raises a C{ValueError} if it isn't one.
+    """
+    interface, port = text.rpartition(':')[::2]
+    if not port.isdigit() or int(port) > 65535:
+        raise ValueError("Invalid [HOST:]PORT '{}'".format(text))
+    return int(port), interface
+
+
+class SyslogUDP(protocol.DatagramProtocol):
+    """
+    I receive syslog messages in UDP datagrams, one message per
+    datagram, for a L{Listener}.
+    """
+    def __init__(self, listener):
+        self.listener = listener
+
+    def datagramReceived(self, data, addr):
+        self.listener.receive(addr[0], data)
+
+
+class SyslogTCP(protocol.Protocol):
+    """
+    I receive syslog messages over a TCP connection for my factory's
+    L{Listener}, framed by either a count of their octets or a
+    newline after each one.
+    """
+    maxLength = 65536
+    reOctetCount = re.compile(r'(\d{1,5}) ')
+
+    def connectionMade(self):
+        self.host = self.transport.getPeer().host
+        self.buffer = ""
+    
+    def dataReceived(self, data):
+        buffer = self.buffer + data
+        k = 0
+        while k < len(buffer):
+            match = self.reOctetCount.match(buffer, k)
+            if match:
+                kEnd = match.end() + int(match.group(1))
+                if kEnd > len(buffer):
+                    break
+                message = buffer[match.end():kEnd]
+            else:
+                kEnd = buffer.find('\n', k)
+                if kEnd < 0:
+                    if len(buffer) - k > self.maxLength:
+                        # No framing to be found, just garbage
+                        self.factory.listener.counts['dropped'] += 1
+                        k = len(buffer)
+                    break
+                message = buffer[k:kEnd]
+                kEnd += 1
+            k = kEnd
+            self.factory.listener.receive(self.host, message, self.transport)
+        self.buffer = buffer[k:]
+
+
+class Listener(Base):
+    """
+    I receive logfile lines in syslog messages and have them parsed in
+    batches by calling I{parse} with the name of their source and a
+    list of them. It must return a C{Deferred} that fires with the
+    number of records parsed.
+
+    The source is the hostname in the message header, if there is
+    one, or else the IP address of the sender. A batch gets parsed
+    when it has I{batchSize} lines or after I{batchDelay} seconds,
+    whichever comes first.
+
+    When I have I{maxPending} lines that haven't been parsed yet, TCP
+    connections get paused until half of them have been, and UDP
+    messages get dropped.
+
+    @ivar counts: A dict with the number of messages C{received} and
+      C{dropped} and of the records C{parsed} from their lines.
+    """
+    batchSize = 500
+    batchDelay = 0.5
+    maxPending = 20000
+    # Bytes of buffering for UDP datagrams that arrive in a burst
+    udpBuffer = 4*1024*1024
+    
+    def __init__(self, parse, verbose=False):
+        self.parse = parse
+        self.verbose = verbose
+        self.batches = {}
+        self.N_pending = 0
+        self.paused = set()
+        self.dc = None
+        self.ports = []
+        self.dt = DeferredTracker()
+        self.counts = {'received': 0, 'dropped': 0, 'parsed': 0}
+
+    def listen(self, port, interface=''):
+        """
+        Starts listening for syslog messages over both UDP and TCP on the
+        specified I{port} of the specified network I{interface}, or
+        all of them.
+        """
+        factory = protocol.Factory()
+        factory.protocol = SyslogTCP
+        factory.listener = self
+        udpPort = reactor.listenUDP(
+            port, SyslogUDP(self), interface, maxPacketSize=65535)
+        udpPort.socket.setsockopt(
+            socket.SOL_SOCKET, socket.SO_RCVBUF, self.udpBuffer)
+        self.ports.append(udpPort)
+        self.ports.append(reactor.listenTCP(port, factory, interface=interface))
+        self.msgHeading(
+            "Listening for syslog messages on port {:d}", port)
+    
+    def receive(self, peer, message, transport=None):
+        """
+        Receives a syslog I{message} from the IP address I{peer}, adding
+        its logfile line to the batch for its source.
+
+        Supply the I{transport} of a TCP connection the message came
+        from, so it can be paused when too many lines are pending.
+        """
+        self.counts['received'] += 1
+        if transport is None and self.N_pending >= self.maxPending:
+            self.counts['dropped'] += 1
+            return
+        host, line = parseSyslog(message)
+        if not line:
+            return
+        source = host or peer
+        batch = self.batches.setdefault(source, [])
+        batch.append(line)
+        self.N_pending += 1
+        if len(batch) >= self.batchSize:
+            self.flush(source)
+        elif self.dc is None:
+            self.dc = reactor.callLater(self.batchDelay, self.flushAll)
+        if transport and self.N_pending >= self.maxPending:
+            if transport not in self.paused:
+                transport.pauseProducing()
+                self.paused.add(transport)
+
+    def flush(self, source):
+        """
+        Has the batch of lines from the specified I{source} parsed now.
+        """
+        def done(N):
+            self.counts['parsed'] += N or 0
+            self.N_pending -= len(lines)
+            if self.paused and self.N_pending <= self.maxPending // 2:
+                while self.paused:
+                    self.paused.pop().resumeProducing()
+
+        lines = self.batches.pop(source)
+        d = defer.maybeDeferred(self.parse, source, lines)
+        d.addErrback(oops)
+        d.addCallback(done)
+        self.dt.put(d)
+        
+    def flushAll(self):
+        """
+        Has all pending batches of lines parsed now.
+        """
+        if self.dc is not None:
+            if self.dc.active():
+                self.dc.cancel()
+            self.dc = None
+        for source in self.batches.keys():
+            self.flush(source)
+
+    @defer.inlineCallbacks
+    def stop(self):
+        """
+        Stops listening and has any pending batches of lines parsed,
+        returning a C{Deferred} that fires when they have been.
+        """
+        while self.ports:
+            yield self.ports.pop().stopListening()
+        self.flushAll()
+        yield self.dt.deferToAll()
+        self.msgHeading(
+            "Received {:d} syslog messages, dropped {:d}",
+            self.counts['received'], self.counts['dropped'])
@@ -30,24 +30,23 @@
 HTTP logfile reading and parsing.
 """
 
-import os, re, gzip
+import os, re, gzip, time
 from copy import copy
-from datetime import datetime
+from datetime import datetime, timedelta
 from collections import OrderedDict
 
 from zope.interface import implements
-from twisted.internet import defer, reactor
+from twisted.internet import defer, reactor, threads
 from twisted.internet.interfaces import IConsumer
 
 import asynqueue
+from asynqueue.util import DeferredTracker
 
-import sift, parse
+import sift, parse, spool
+from follow import Tail
+from listen import Listener
 from util import oops, Base
-from records import RecordKeeper
-
-
-# PROFILING
-from util import profile
+from records import RecordKeeper, shardedCount
 
 
 class KWParse:
@@ -73,8 +72,24 @@ class ProcessReader(KWParse):
         r'(\.(jpg|jpeg|png|gif|css|ico|woff|ttf|svg|eot\??))' +\
         r'|(robots\.txt|sitemap\.xml|googlecea.+\.html)$')
 
-    keyWords = (('exclude', []), ('ignoreSecondary', False))
+    keyWords = (
+        ('exclude', []), ('ignoreSecondary', False), ('spoolDir', None),
+        ('reportStats', False), ('profileDir', None), ('accounting', False))
+
+    # With reportStats set, the number of lines read between dicts of
+    # counts yielded by a call to me, see L{workerCounts}
+    statsInterval = 10000
 
+    # Number of bytes before the start of a shard to run through
+    # makeRecord (without yielding anything) so that redirect and
+    # blocked-IP state carries across the shard boundary
+    lookback = 65536
+
+    # The format of timestamp keys, see L{parse.LineParser.timestampKey}
+    timestampFormat = "%Y-%m-%d %H:%M:%S"
+    
+    reVhostDef = re.compile(r'^[#;]*\s*([\S]+\.[\S]+)$')
+    
     def __init__(self, matchers, **kw):
         self.parseKW(kw)
         self.isRunning = False
@@ -82,6 +97,15 @@ class ProcessReader(KWParse):
         self.m = parse.MatcherManager(matchers)
         self.rc = parse.RedirectChecker()
         self.ipm = sift.IPMatcher()
+        self.cacheCounts = {}
+        self.rejects = {}
+        self.cpuTime = 0.0
+        self.dtLast = None
+        if self.accounting:
+            for name, null in self.m.matcherTable:
+                matcher = getattr(self.m, name)
+                if hasattr(matcher, 'account'):
+                    matcher.account()
 
     def file(self, filePath):
         """
@@ -94,6 +118,112 @@ class ProcessReader(KWParse):
             fh = open(filePath, mode="r")
         return fh
 
+    def vhostDefinition(self, line):
+        """
+        Returns the vhost defined by the supplied first line of a logfile,
+        or C{None} if it isn't a vhost definition.
+        """
+        match = self.reVhostDef.match(line.strip())
+        if match:
+            return match.group(1)
+
+    def timeSpan(self, filePath):
+        """
+        Returns datetime objects for the first timestamp of the
+        specified logfile and the latest one of the lines at its end,
+        or C{None} if it has no timestamped lines. Only the last
+        I{lookback} bytes of a plain-text file get read for the
+        latest one, but a compressed file has to be read all the way
+        through.
+        """
+        first, last = None, None
+        with self.file(filePath) as fh:
+            for line in fh:
+                first = self.p.timestampKey(line)
+                if first:
+                    break
+            if not first:
+                return
+            if not filePath.endswith('.gz'):
+                fh.seek(0, 2)
+                k0 = fh.tell() - self.lookback
+                if k0 > 0:
+                    # Skip the partial line
+                    fh.seek(k0)
+                    fh.readline()
+                else: fh.seek(0)
+            for line in fh:
+                key = self.p.timestampKey(line)
+                if key and (last is None or key > last):
+                    last = key
+        return [datetime.strptime(x, self.timestampFormat)
+                for x in (first, max([first, last]))]
+
+    def seekTimestamp(self, fh, key, N=65536):
+        """
+        Returns a byte offset of the open plain-text logfile I{fh} that
+        is no more than I{N} bytes before the first line timestamped
+        at or after the timestamp key I{key}, found with a binary
+        search. The lines are assumed to be in chronological order,
+        or close to it.
+        """
+        def keyAt(k):
+            fh.seek(k)
+            if k:
+                # Skip the partial line
+                fh.readline()
+            for line in fh:
+                thisKey = self.p.timestampKey(line)
+                if thisKey:
+                    return thisKey
+        
+        fh.seek(0, 2)
+        lo, hi = 0, fh.tell()
+        while hi - lo > N:
+            mid = (lo + hi) // 2
+            thisKey = keyAt(mid)
+            if thisKey is None or thisKey >= key:
+                hi = mid
+            else: lo = mid
+        return lo
+    
+    def shardLines(self, fh, start, end):
+        """
+        Iterates over the lines of the open plain-text logfile I{fh} that
+        begin at or after byte I{start} and before byte I{end}. A line
+        straddling I{start} belongs to the shard before this one.
+
+        Lines from up to I{lookback} bytes before I{start} are run
+        through L{makeRecord} with their results discarded, to prime
+        my redirect checker and IP matcher the way a single-worker
+        parsing of the whole file would have.
+        """
+        k0 = max([0, start - self.lookback])
+        if k0:
+            # Back up one byte and finish that line, so we begin on
+            # the first line starting at or after byte k0
+            fh.seek(k0-1)
+            fh.readline()
+        if end is None:
+            end = float('inf')
+        pos = fh.tell()
+        # The shard before this one counts the rejections of these lines
+        rejects = self.rejects
+        self.rejects = {}
+        while pos < start:
+            line = fh.readline()
+            if not line:
+                self.rejects = rejects
+                return
+            pos += len(line)
+            self.makeRecord(line)
+        self.rejects = rejects
+        for line in fh:
+            if pos >= end:
+                break
+            pos += len(line)
+            yield line
+
     def makeRecord(self, line, alreadyParsed=False):
         """
         This is where most of the processing time gets spent.
@@ -138,40 +268,47 @@ class ProcessReader(KWParse):
 
         If one or more HTTP codes are supplied in my I{exclude}
         attribute, then lines with those codes will be ignored.
+
+        Each line that isn't accepted is counted as a rejection by the
+        check that rejected it, see L{reject}.
         """
         stuff = line if alreadyParsed else self.p(line)
         if stuff is None:
             # Bogus line
-            return
+            return self.reject('unparsed')
         vhost, ip, dt, url, http, ref, ua = stuff
         # First and fastest of all is checking for IP addresses
         # already identified as being blocked. If this is a blocked IP
         # address, there's no need to pay any further attention to
         # anything from it
         if self.ipm(ip):
-            return
+            return self.reject('blocked')
         # Now (also very fast), check for specified IP addresses to
         # ignore but not block
         if self.m.ipMatcher(ip):
-            return ip, False
+            return self.reject('ip', ip)
         # Now check for secondary file, if we are ignoring those
         if self.ignoreSecondary and self.reSecondary.search(url):
-            return
+            return self.reject('secondary')
         # Then do some relatively easy exclusion checks, starting with
         # botMatcher and refMatcher so we can harvest the most blocked
         # IP addresses
-        if self.m.botMatcher(ip, url) or self.m.refMatcher(ip, ref):
+        if self.m.botMatcher(ip, url):
+            # Misbehaving IP
+            self.ipm.addIP(ip)
+            return self.reject('url', ip, True)
+        if self.m.refMatcher(ip, ref):
             # Misbehaving IP
             self.ipm.addIP(ip)
-            return ip, True
+            return self.reject('ref', ip, True)
         if self.exclude:
             if http in self.exclude:
                 # Excluded code
-                return
+                return self.reject('http')
         if self.m.uaMatcher(ip, ua):
             # Excluded UA string. We may ignore but never block based
             # just on UA, even if it's a bot.
-            return ip, False
+            return self.reject('ua', ip)
         # OK, this is an approved record ... unless the requested
         # vhost is bogus or there is an IP address match
         record = {
@@ -181,12 +318,12 @@ class ProcessReader(KWParse):
         if self.m.vhostMatcher(ip, vhost):
             # Excluded vhost, consider this IP misbehaving also, and block
             self.ipm.addIP(ip)
-            return ip, True
+            return self.reject('vhost', ip, True)
         record['vhost'] = vhost
         # If the request got this far but asked for a URL indicating a benign bot,
         # ignore but don't block
         if url in self.benignBotURLs:
-            return ip, False
+            return self.reject('benign', ip)
         # The last and by FAR the most time-consuming check is for
         # excluded networks to ignore (but not block). Only done if
         # all other checks have passed. Use your .net rules to avoid
@@ -194,9 +331,65 @@ class ProcessReader(KWParse):
         # places where you just KNOW it's not an actual person
         # browsing your site.
         if self.m.netMatcher(ip):
-            return ip, False
+            return self.reject('net', ip)
         return dt, record
 
+    def reject(self, check, ip=None, block=False):
+        """
+        Counts a rejection of a line by the named I{check} and returns
+        what L{makeRecord} does for it: C{None} if there's no I{ip}
+        address whose other entries are to be affected, or a 2-tuple
+        with the IP address and whether it's to be blocked.
+        """
+        self.rejects[check] = self.rejects.get(check, 0) + 1
+        if ip is not None:
+            return ip, block
+        
+    def workerCounts(self, N, N_bytes):
+        """
+        Returns a dict of counts for the supervising process's
+        L{stats.Stats} about what I've done since the last call: the
+        process ID I{pid} of the worker running me, the number of
+        I{lines} (I{N}) and I{bytes} (I{N_bytes}) read, the CPU
+        I{seconds} used, the number of cache hits and lookups for
+        each of my matchers with a cache, as 2-tuples in a dict of
+        I{caches}, and the number of lines rejected by each check of
+        L{makeRecord}, in a dict of I{rejects}. The number of items
+        now held by my big structures is in a dict of I{sizes}: the IP
+        addresses awaiting a redirect in my redirect checker, those
+        in my IP matcher, and the values in the cache of each of my
+        matchers with one. The datetime of the latest record accepted
+        so far from the logfile being parsed, if any, is I{last}.
+
+        If I have I{accounting} set, there's also a dict of I{rules}
+        with the L{sift.RuleAccounting.ruleCounts} of each of my
+        matchers that keeps them.
+        """
+        t = time.clock()
+        counts = {
+            'pid': os.getpid(), 'lines': N, 'bytes': N_bytes,
+            'seconds': t - self.cpuTime, 'caches': {},
+            'rejects': self.rejects, 'last': self.dtLast,
+            'sizes': {'redirects': len(self.rc), 'worker.ipm': len(self.ipm)}}
+        self.cpuTime = t
+        self.rejects = {}
+        if self.accounting:
+            counts['rules'] = {}
+            for name, null in self.m.matcherTable:
+                f = getattr(getattr(self.m, name), 'ruleCounts', None)
+                if f is not None:
+                    counts['rules'][name] = f()
+        for name, null in self.m.matcherTable:
+            cm = getattr(getattr(self.m, name), 'cm', None)
+            if cm is None:
+                continue
+            counts['sizes']['cache.' + name] = len(cm)
+            hits, lookups = cm.counts()
+            prevHits, prevLookups = self.cacheCounts.get(name, (0, 0))
+            self.cacheCounts[name] = hits, lookups
+            counts['caches'][name] = hits - prevHits, lookups - prevLookups
+        return counts
+    
     def ignoreIPs(self, ipList):
         """
         The supervising process may call this with a list of IP addresses
@@ -205,7 +398,9 @@ class ProcessReader(KWParse):
         for ip in ipList:
             self.ipm.addIP(ip)
             
-    def __call__(self, filePath):
+    def __call__(
+            self, filePath, start=None, end=None, vhost=None,
+            skipBefore=None, stopAfter=None):
         """
         The public interface to parse a logfile. My processes call this
         via the queue to iterate over misbehaving IP addresses and
@@ -218,14 +413,79 @@ class ProcessReader(KWParse):
         #2, you can specify a vhost for the entire file on the first
         line. It can be prefixed with a comment symbol ("#" or ";" if
         you wish).
+
+        To parse just one shard of a big plain-text logfile, supply
+        the I{start} and I{end} byte offsets of the shard. The first
+        line of the file won't be seen by any shard but the first, so
+        supply whatever vhost it defines (see L{vhostDefinition}) with
+        the I{vhost} keyword. Supplying just an I{end} offset parses
+        the whole file up to there, leaving out anything appended to it
+        after that offset was determined.
+
+        If I have a I{spoolDir}, the records get appended to segment
+        files there instead of being yielded, and only the rejected IP
+        addresses are. See L{spool}.
+
+        If I have I{reportStats} set, a dict of counts from
+        L{workerCounts} is also yielded for every I{statsInterval}
+        lines read and once more at the end.
+
+        If I have a I{profileDir}, the worker process running me gets
+        profiled, and its profile is written there after each call.
+        See L{profiling}.
+
+        If I have I{accounting} set, my matchers keep count of the
+        hits and evaluation time of each of their rules, and the
+        dicts of counts include them. See L{workerCounts}.
+
+        Lines from before the time of a timestamp key supplied with
+        I{skipBefore} are skipped without any parsing beyond their
+        timestamps, and a plain-text file is read starting from near
+        the first line that isn't, found with L{seekTimestamp}. Reading
+        stops at the first line after the time of a timestamp key
+        supplied with I{stopAfter}. See
+        L{parse.LineParser.timestampKey}.
         """
         # Redirect checking is only valid within an individual logfile
         self.rc.clear()
-        firstLine = True
+        # So is a vhost definition
+        self.p.setVhost(vhost)
+        self.dtLast = None
+        firstLine = not start
         self.isRunning = True
+        if self.profileDir:
+            import profiling
+            profiling.profileWorker()
+        self.cpuTime = time.clock()
+        sw = spool.SegmentWriter(
+            self.spoolDir, filePath) if self.spoolDir else None
         with self.file(filePath) as fh:
-            for line in fh:
+            if skipBefore and not filePath.endswith('.gz'):
+                k = self.seekTimestamp(fh, skipBefore)
+                fh.seek(0)
+                if k > (start or 0):
+                    if firstLine:
+                        # The vhost definition won't get seen
+                        firstLine = False
+                        vhost = self.vhostDefinition(fh.readline())
+                        if vhost:
+                            self.p.setVhost(vhost)
+                    start = k
+            if end is not None and (start or 0) >= end:
+                # This whole shard is before the time to skip to
+                lines = []
+            elif start or end:
+                lines = self.shardLines(fh, start or 0, end)
+            else: lines = fh
+            N, N_bytes = 0, 0
+            for line in lines:
                 #print line
+                if self.reportStats:
+                    N += 1
+                    N_bytes += len(line)
+                    if N == self.statsInterval:
+                        yield self.workerCounts(N, N_bytes)
+                        N, N_bytes = 0, 0
                 if firstLine:
                     firstLine = False
                     # Check first non-blank line for possible vhost
@@ -233,18 +493,54 @@ class ProcessReader(KWParse):
                     line = line.strip()
                     if not line:
                         continue
-                    match = re.match(r'^[#;]*\s*([\S]+\.[\S]+)$', line)
-                    if match:
+                    vhost = self.vhostDefinition(line)
+                    if vhost:
                         # This was indeed a vhost definition
-                        self.p.setVhost(match.group(1))
+                        self.p.setVhost(vhost)
                         continue
                 if not self.isRunning:
                     break
+                if skipBefore or stopAfter:
+                    key = self.p.timestampKey(line)
+                    if key:
+                        if skipBefore and key < skipBefore:
+                            continue
+                        if stopAfter and key > stopAfter:
+                            break
                 # This next line is where most of the processing time
                 # is spent
                 stuff = self.makeRecord(line)
-                if stuff:
+                if not stuff:
+                    continue
+                if isinstance(stuff[0], str):
                     yield stuff
+                    continue
+                if self.dtLast is None or stuff[0] > self.dtLast:
+                    self.dtLast = stuff[0]
+                if sw:
+                    sw.write(*stuff)
+                else: yield stuff
+        if sw:
+            sw.close()
+        if self.reportStats:
+            yield self.workerCounts(N, N_bytes)
+        if self.profileDir:
+            import profiling
+            profiling.dumpWorker(self.profileDir)
+
+    def parseLines(self, lines, vhost=None):
+        """
+        Parses the supplied list of logfile I{lines}, received some way
+        other than in a logfile, yielding what L{makeRecord} returns
+        for each one that it doesn't ignore. Supply any vhost for them
+        all with the I{vhost} keyword.
+        """
+        self.rc.clear()
+        self.p.setVhost(vhost)
+        for line in lines:
+            stuff = self.makeRecord(line)
+            if stuff:
+                yield stuff
 
 
 class Reader(KWParse, Base):
@@ -253,14 +549,31 @@ class Reader(KWParse, Base):
     """
     # Maximum number of logfiles to process concurrently
     N = 6
+    # Uncompressed logfiles bigger than this many bytes get split into
+    # shards that are parsed concurrently
+    shardSize = 32*1024*1024
+    # Seconds between checks for new lines when following logfiles
+    followInterval = 2.0
     
     keyWords = (
         ('cores', None),
         ('exclude', []), ('ignoreSecondary', False), ('blockedIPs', []),
         ('verbose', False), ('info', False), ('warnings', False),
-        ('gui', None), ('updateOnly', False))
+        ('gui', None), ('updateOnly', False), ('writers', 1),
+        ('spoolDir', None), ('compact', False), ('rollups', False),
+        ('sketches', False), ('margin', None),
+        ('since', None), ('until', None), ('stats', None),
+        ('profileDir', None), ('accounting', False), ('dryRun', False))
+
+    # Rotation suffixes, as in access.log.1 or access.log-20180102.gz
+    reRotated = re.compile(r'(\.\d+|-\d{8})?(\.gz)?$')
     
     def __init__(self, rules, dbURL, **kw):
+        """
+        With I{dryRun} set, the logfiles get parsed with no database
+        at all, and I{dbURL} is ignored. See
+        L{records.NullTransactor}.
+        """
         self.parseKW(kw)
         self.consumers = []
         # Three connections for each concurrent parsing of a logfile:
@@ -268,16 +581,58 @@ class Reader(KWParse, Base):
         # done during that transaction.
         N_pool = 3*max([1, 2*self.N_processes])
         self.rk = RecordKeeper(
-            dbURL, N_pool, self.blockedIPs,
+            None if self.dryRun else dbURL, N_pool, self.blockedIPs,
             verbose=self.verbose, info=self.info, echo=self.warnings,
-            gui=self.gui)
+            gui=self.gui, writers=self.writers,
+            compact=self.compact, rollups=self.rollups,
+            sketches=self.sketches, stats=self.stats)
+        # The record keeper supplies one if I wasn't given any
+        self.stats = self.rk.stats
         self.pr = ProcessReader(
             self.getMatchers(rules),
             exclude=self.exclude,
-            ignoreSecondary=self.ignoreSecondary)
+            ignoreSecondary=self.ignoreSecondary,
+            spoolDir=self.spoolDir, reportStats=True,
+            accounting=self.accounting,
+            # Without worker processes, parsing gets profiled along
+            # with everything else in the main process
+            profileDir=self.profileDir if self.N_processes else None)
+        # Replaced with the ones in the database when I run
+        self.watermarks = {}
+        # The stat of each logfile when it was found or dispatched and
+        # the byte offset it was parsed through, for following, and
+        # the path of each one found by discover
+        self.fileStats = {}
+        self.fileEnds = {}
+        self.filePaths = {}
+        if self.spoolDir:
+            self.spool = spool.SpoolLoader(self.spoolDir, self.rk)
+        # For logfiles whose parsing is done but whose records are
+        # still being loaded from the spool
+        self.dt = DeferredTracker()
         # A lock for getting shutdown done right
         self.lock = asynqueue.DeferredLock()
+        # And one for starting up just once, see startup
+        self.startupLock = asynqueue.DeferredLock()
+        self.started = False
 
+    @defer.inlineCallbacks
+    def startup(self):
+        """
+        Returns a C{Deferred} that fires when my record keeper has
+        started up, with the database preloaded, and I have the
+        watermarks of my logfile sources. That only gets done once,
+        for the first call.
+        """
+        yield self.startupLock.acquire()
+        if not self.started:
+            yield self.rk.startup()
+            self.watermarks = yield self.rk.getWatermarks()
+            if hasattr(self, 'spool'):
+                self.spool.startup()
+            self.started = True
+        self.startupLock.release()
+        
     def isRunning(self):
         if hasattr(self, '_shutdownFlag'):
             return False
@@ -285,6 +640,33 @@ class Reader(KWParse, Base):
             return self.pq.isRunning()
         return False
     
+    def filePath(self, fileName):
+        """
+        Returns the path of the logfile with the specified name, where
+        L{discover.Discovery} found it or in my directory.
+        """
+        filePath = self.filePaths.get(fileName, None)
+        if filePath is None:
+            return self.pathInDir(fileName)
+        return filePath
+
+    def fileNames(self, logFiles):
+        """
+        Returns a list of the names of the supplied I{logFiles}, each
+        either the name of a logfile in my directory or a
+        L{discover.LogFile}, noting the path and stat of each of the
+        latter.
+        """
+        fileNames = []
+        for logFile in logFiles:
+            if isinstance(logFile, basestring):
+                fileNames.append(logFile)
+                continue
+            self.filePaths[logFile.name] = logFile.path
+            self.fileStats[logFile.name] = logFile.stat
+            fileNames.append(logFile.name)
+        return fileNames
+        
     def getMatchers(self, rules):
         result = {}
         for matcherName, ruleList in rules.iteritems():
@@ -298,6 +680,10 @@ class Reader(KWParse, Base):
             cores = asynqueue.ProcessQueue.cores()
         else:
             cores = int(self.cores)
+        if self.dryRun:
+            # There's no database load on the main process, so it can
+            # service a worker for every core
+            return cores
         return min([self.N, cores])
         
     def getQueue(self, thread=False):
@@ -309,6 +695,71 @@ class Reader(KWParse, Base):
             q = asynqueue.ProcessQueue(self.N_processes)
         return q
 
+    def source(self, fileName):
+        """
+        Returns the name of the source of the specified logfile, which
+        is its name without any rotation suffix. All versions of a
+        rotated logfile share the watermark of their source.
+        """
+        return self.reRotated.sub("", fileName)
+
+    def skipBefore(self, fileName):
+        """
+        Returns a timestamp key for skipping lines of the specified
+        logfile that are from before my I{since} datetime or the
+        watermark of its source, less my I{margin} of seconds,
+        whichever is later. Returns C{None} if there's no I{since}
+        and no margin or watermark.
+
+        The watermarks are the ones from when my run started, so a
+        logfile never gets skipped past because another version of it
+        got parsed in the same run.
+        """
+        dtList = []
+        if self.since:
+            dtList.append(self.since)
+        if self.margin is not None:
+            dt = self.watermarks.get(self.source(fileName), None)
+            if dt is not None:
+                dtList.append(dt - timedelta(seconds=self.margin))
+        if dtList:
+            return max(dtList).strftime(self.pr.timestampFormat)
+
+    def stopAfter(self):
+        """
+        Returns a timestamp key for stopping at lines from after my
+        I{until} datetime, or C{None} if I don't have one.
+        """
+        if self.until:
+            return self.until.strftime(self.pr.timestampFormat)
+        
+    def inWindow(self, first, last):
+        """
+        Returns C{True} unless lines timestamped from datetime I{first}
+        through I{last} are all outside the time window of my
+        I{since} and I{until} datetimes.
+        """
+        if self.since and last < self.since:
+            return False
+        if self.until and first > self.until:
+            return False
+        return True
+    
+    def shards(self, filePath, size):
+        """
+        Returns a list of (start, end) byte ranges for splitting the
+        specified logfile of I{size} bytes into shards to be parsed
+        concurrently, one per worker at most. Compressed and
+        not-so-big files aren't split, and for them the list is empty.
+        """
+        if filePath.endswith('.gz') or not hasattr(self, 'pq'):
+            return []
+        N = min([len(self.pq), size // self.shardSize])
+        if N < 2:
+            return []
+        k = [j*size // N for j in xrange(N)] + [size]
+        return zip(k[:-1], k[1:])
+        
     @defer.inlineCallbacks
     def shutdown(self):
         """
@@ -320,6 +771,11 @@ class Reader(KWParse, Base):
             # Signal dispatch loop to quit
             self._shutdownFlag = None
             ID = self.msgHeading("Reader shutting down...")
+            # "Wait" for any batches of received lines to be parsed
+            if hasattr(self, 'listener'):
+                yield self.listener.stop()
+                del self.listener
+                self.msgBody("Stopped listening", ID=ID)
             # "Wait" for lock
             yield self.lock.acquireAndRelease()
             self.msgBody("Dispatch loop finished", ID=ID)
@@ -334,6 +790,11 @@ class Reader(KWParse, Base):
                     "Stopped {:d} active consumers", len(dList), ID=ID)
             else:
                 self.msgBody("No consumers active", ID=ID)
+            # "Wait" for any segment being loaded from the spool
+            if hasattr(self, 'spool'):
+                yield self.spool.shutdown()
+                del self.spool
+                self.msgBody("Spool loader stopped", ID=ID)
             # "Wait" for recordkeeper to shut down
             if hasattr(self, 'rk'):
                 yield self.rk.shutdown()
@@ -346,7 +807,6 @@ class Reader(KWParse, Base):
                 self.msgBody("Process queue stopped", ID=ID)
             self.msgBody("All done", ID=ID)
 
-    #@profile
     def _dispatch(self, fileName):
         """
         Called by L{run} to dispatch parsing jobs to CPU cores.
@@ -366,36 +826,151 @@ class Reader(KWParse, Base):
                 self.fileStatus(fileName, "New file")
             return load()
 
-        def done(null, consumer):
-            N = consumer.N_parsed
-            self.consumers.remove(consumer)
-            self.msgBody("Parsed {:d} records from {}", N, fileName, ID=ID)
-            # Update file info for this log file
-            d1 = self.rk.fileInfo(fileName, fileInfo[0], fileInfo[1], N)
+        def shardsDone(results, consumers, t0):
+            failures = [x[1] for x in results if not x[0]]
+            if not failures:
+                return done(None, consumers, t0)
+            # Leave the file's info and watermark as they were, so it
+            # gets parsed again next time
+            for consumer in consumers:
+                self.consumers.remove(consumer)
+            self.msgBody(
+                "Parsing of {:d} of {:d} shards failed",
+                len(failures), len(consumers), ID=ID)
+            self.fileStatus(fileName, "Failed")
+            return failures[0]
+        
+        def done(null, consumers, t0):
+            # The latest record parsed, as reported by the workers
+            dtList = [x.dtLast for x in consumers if x.dtLast]
+            dtLast = max(dtList) if dtList else None
+            for consumer in consumers:
+                self.consumers.remove(consumer)
             # Advise all ProcessReaders of newly identified IP
             # addresses that are being blocked so that they can skip
             # over any log entries from them.
             ipList = self.rk.getNewBlockedIPs()
-            d2 = self.pq.update(self.pr.ignoreIPs, ipList)
-            # The delay involved with updating the workers and
-            # updating the database can be concurrent.
-            return defer.DeferredList([d1, d2])
+            dList = [self.pq.update(self.pr.ignoreIPs, ipList)]
+            if hasattr(self, 'spool'):
+                # The records went to the spool, so the file isn't
+                # done until its segments have been loaded. That
+                # doesn't hold up the parsing of other files, see run.
+                d = self.spool.drain(filePath)
+                d.addCallback(finish, dtLast, t0).addErrback(oops)
+                self.dt.put(d)
+            else:
+                if len(consumers) > 1:
+                    N = shardedCount(consumers)
+                else: N = consumers[0].N_parsed
+                # The delay involved with updating the workers and
+                # updating the database can be concurrent.
+                dList.append(finish(N, dtLast, t0))
+            return defer.DeferredList(dList)
+
+        def finish(N, dtLast, t0):
+            self.stats.bump('wall', time.time()-t0, fileName=fileName)
+            self.msgBody("Parsed {:d} records from {}", N, fileName, ID=ID)
+            dList = []
+            if self.since or self.until:
+                # Only part of the file was loaded, so its info and
+                # watermark stay as they were
+                dtLast = None
+            else:
+                # Update file info for this log file
+                dList.append(self.rk.fileInfo(
+                    fileName, fileInfo[0], fileInfo[1], N))
+            if dtLast and self.isRunning():
+                # Everything through the latest record that was found
+                # in the file has been loaded
+                dList.append(self.rk.setWatermark(
+                    self.source(fileName), dtLast).addErrback(oops))
+            return defer.DeferredList(dList)
         
+        @defer.inlineCallbacks
+        def getSpan():
+            # Only needed for skipping files outside a time window
+            if not (self.since or self.until):
+                defer.returnValue(None)
+            # The time span of a file that hasn't changed since it was
+            # last found is in the database, which saves reading a
+            # compressed one all the way through
+            row = yield self.rk.fileSpan(fileName)
+            if row and list(row[:2]) == fileInfo:
+                defer.returnValue(list(row[2:]))
+            span = yield threads.deferToThread(self.pr.timeSpan, filePath)
+            if span:
+                yield self.rk.fileSpan(fileName, *(fileInfo+span))
+            defer.returnValue(span)
+        
+        @defer.inlineCallbacks
         def load():
-            self.msgBody("Dispatching file for loading", ID=ID)
-            # Get a ProcessConsumer for this file
-            consumer = self.rk.consumerFactory(fileName)
-            self.consumers.append(consumer)
-            # Call the ProcessReader on one of my subordinate
-            # processes to have it feed the consumer with
-            # misbehaving IP addresses and filtered records
-            return self.pq.call(
-                self.pr, filePath, consumer=consumer).addCallback(
-                    done, consumer).addErrback(oops)
-
-        filePath = self.pathInDir(fileName)
+            yield self.startup()
+            span = yield getSpan()
+            if span and not self.inWindow(*span):
+                self.msgBody(
+                    "Skipping file, its lines are from {} to {}",
+                    span[0], span[1], ID=ID)
+                self.fileStatus(fileName, "Outside time window")
+                return
+            yield dispatch()
+        
+        def dispatch():
+            t0 = time.time()
+            if hasattr(self, 'spool'):
+                # Count the records loaded from the spool for this name
+                self.spool.fileNames[filePath] = fileName
+            skipBefore = self.skipBefore(fileName)
+            if skipBefore:
+                self.msgBody(
+                    "Skipping lines from before {}", skipBefore, ID=ID)
+            stopAfter = self.stopAfter()
+            end = None
+            if not filePath.endswith('.gz'):
+                # Parse no further than the last complete line the
+                # file had when it was found. Anything after that is
+                # left for following, see follow.
+                end = self.fileEnds[fileName] = Tail.lastLineEnd(
+                    filePath, fileInfo[1])
+            shards = self.shards(filePath, end)
+            if not shards:
+                self.msgBody("Dispatching file for loading", ID=ID)
+                # Get a ProcessConsumer for this file
+                consumer = self.rk.consumerFactory(fileName)
+                self.consumers.append(consumer)
+                # Call the ProcessReader on one of my subordinate
+                # processes to have it feed the consumer with
+                # misbehaving IP addresses and filtered records
+                return self.pq.call(
+                    self.pr, filePath, end=end,
+                    skipBefore=skipBefore, stopAfter=stopAfter,
+                    consumer=consumer).addCallback(
+                        done, [consumer], t0).addErrback(oops)
+            self.msgBody(
+                "Dispatching file for loading in {:d} shards",
+                len(shards), ID=ID)
+            # Only the first shard sees the first line, so any vhost
+            # definition there has to be passed to the others
+            with open(filePath) as fh:
+                vhost = self.pr.vhostDefinition(fh.readline())
+            dList = []
+            consumers = []
+            for start, end in shards:
+                consumer = self.rk.consumerFactory(fileName, tally=True)
+                self.consumers.append(consumer)
+                consumers.append(consumer)
+                dList.append(self.pq.call(
+                    self.pr, filePath, start, end, vhost,
+                    skipBefore=skipBefore, stopAfter=stopAfter,
+                    consumer=consumer))
+            return defer.DeferredList(dList, consumeErrors=True).addCallback(
+                shardsDone, consumers, t0).addErrback(oops)
+
+        filePath = self.filePath(fileName)
         ID = self.msgHeading("Logfile {}...", fileName)
-        stat = os.stat(filePath)
+        # Logfiles found by discover were stat'ed then
+        stat = self.fileStats.get(fileName, None)
+        if stat is None:
+            stat = self.fileStats[fileName] = os.stat(filePath)
         fileInfo = [int(getattr(stat, x)) for x in ('st_mtime', 'st_size')]
         fileInfo[0] = datetime.fromtimestamp(fileInfo[0])
         if self.updateOnly:
@@ -406,13 +981,141 @@ class Reader(KWParse, Base):
                 fileName).addCallbacks(gotInfo, oops)
         return load()
 
+    def _blockNew(self, blocked=None):
+        """
+        Advises my workers of any IP addresses newly found to be blocked,
+        so they can skip over entries from them, and supplies a list
+        of them to any callable I{blocked}. Returns a C{Deferred} that
+        fires when the workers have been advised.
+        """
+        ipList = self.rk.getNewBlockedIPs()
+        if not ipList:
+            return defer.succeed(None)
+        if blocked:
+            blocked(ipList)
+        return self.pq.update(self.pr.ignoreIPs, ipList)
+    
+    @defer.inlineCallbacks
+    def _parseLines(self, source, lines, blocked=None):
+        """
+        Called by my L{listen.Listener} to parse a batch of I{lines}
+        received from the named I{source}, returning a C{Deferred}
+        that fires with the number of records parsed.
+        """
+        yield self.startup()
+        consumer = self.rk.consumerFactory(source)
+        self.consumers.append(consumer)
+        yield self.pq.call(self.pr.parseLines, lines, consumer=consumer)
+        self.consumers.remove(consumer)
+        yield self._blockNew(blocked)
+        defer.returnValue(consumer.N_parsed)
+    
+    def listen(self, port, interface='', blocked=None):
+        """
+        Starts listening for logfile lines in syslog messages over UDP
+        and TCP on the specified I{port} of the specified network
+        I{interface}, or all of them, and keeps parsing them in
+        batches until I'm shut down. See L{listen.Listener}.
+
+        Call this after L{run} is done. Whenever IP addresses are newly
+        found to be blocked, a list of them gets supplied to any
+        callable you specify with I{blocked}.
+        """
+        def parse(source, lines):
+            return self._parseLines(source, lines, blocked)
+        
+        self.listener = Listener(parse, verbose=self.verbose)
+        self.listener.gui = self.gui
+        self.listener.listen(port, interface)
+    
+    @defer.inlineCallbacks
+    def _follow(self, filePath, start, end, fileName=None):
+        """
+        Called by L{follow} to parse the lines of a logfile from byte
+        I{start} up to byte I{end}, returning a C{Deferred} that fires
+        with the number of records parsed. They're counted for the
+        specified I{fileName}, or the logfile's own name.
+        """
+        yield self.startup()
+        vhost = None
+        if start:
+            with open(filePath) as fh:
+                vhost = self.pr.vhostDefinition(fh.readline())
+        fileName = fileName or os.path.basename(filePath)
+        consumer = self.rk.consumerFactory(fileName)
+        self.consumers.append(consumer)
+        if hasattr(self, 'spool'):
+            self.spool.fileNames[filePath] = fileName
+        yield self.pq.call(
+            self.pr, filePath, start, end, vhost, consumer=consumer)
+        self.consumers.remove(consumer)
+        if hasattr(self, 'spool'):
+            N = yield self.spool.drain(filePath)
+        else: N = consumer.N_parsed
+        defer.returnValue(N)
+    
+    @defer.inlineCallbacks
+    def follow(self, fileNames, blocked=None):
+        """
+        Keeps parsing lines as they get added to the specified logfiles,
+        checking every I{followInterval} seconds until I'm shut
+        down. Rotated and compressed versions of logfiles don't get
+        added to and are ignored. See L{follow.Tail} for how rotation
+        of a logfile is handled.
+
+        Call this after L{run} is done with the same logfiles, and they
+        get followed from the end of the last complete line they had
+        when it found them, which is as far as it parsed them.
+
+        Whenever IP addresses are newly found to be blocked, a list of
+        them gets supplied to any callable you specify with
+        I{blocked}.
+
+        Returns a C{Deferred} that fires with a dict of all IP
+        addresses rejected during the run when I'm shut down.
+        """
+        yield self.lock.acquire()
+        tails = []
+        for fileName in self.fileNames(fileNames):
+            if self.source(fileName) != fileName:
+                continue
+            tails.append((os.path.dirname(fileName), Tail(
+                self.filePath(fileName),
+                self.fileStats.get(fileName, None),
+                self.fileEnds.get(fileName, None))))
+        ID = self.msgHeading("Following {:d} logfiles", len(tails))
+        while self.isRunning():
+            dList = []
+            for dirName, tail in tails:
+                # A rotated version of a logfile is named like it,
+                # in the same directory
+                for filePath, start, end in tail.check():
+                    fileName = os.path.join(
+                        dirName, os.path.basename(filePath))
+                    dList.append(self._follow(
+                        filePath, start, end, fileName).addErrback(oops))
+            if dList:
+                results = yield defer.DeferredList(dList)
+                N = sum([x[1] for x in results if x[0] and x[1]])
+                self.msgBody("Parsed {:d} new records", N, ID=ID)
+                yield self._blockNew(blocked)
+            yield self.deferToDelay(self.followInterval)
+        rejectedIPs = self.rk.rejectedIPs
+        self.lock.release()
+        defer.returnValue(rejectedIPs)
+    
     @defer.inlineCallbacks
     def run(self, fileNames):
         """
         Runs everything via the process queue (multiprocessing!),
         returning a reference to a list of all IP addresses purged
         during the run.
+
+        The logfiles get dispatched in the order of I{fileNames}, which
+        can be names of logfiles in my directory or a work list of
+        L{discover.LogFile} instances.
         """
+        fileNames = self.fileNames(fileNames)
         dList = []
         self.lock.acquire()
         self.pq = self.getQueue()
@@ -420,9 +1123,17 @@ class Reader(KWParse, Base):
             "Dispatching {:d} parsing jobs", len(fileNames))
         # We have at most two files being parsed concurrently for each
         # worker servicing my process queue
-        ds = defer.DeferredSemaphore(min([self.N, 2*len(self.pq)]))
-        # "Wait" for everything to start up
-        yield self.rk.startup()
+        N_files = 2*len(self.pq)
+        if not self.dryRun:
+            N_files = min([self.N, N_files])
+        ds = defer.DeferredSemaphore(N_files)
+        # "Wait" for everything to start up. If only new or changed
+        # logfiles get loaded, the database doesn't get preloaded
+        # until one is found, so a run that finds none is quick.
+        if self.updateOnly:
+            yield self.rk.waitUntilRunning()
+        else:
+            yield self.startup()
         
         # Dispatch files as permitted by the semaphore
         for fileName in fileNames:
@@ -445,9 +1156,18 @@ class Reader(KWParse, Base):
             "Done dispatching, awaiting {:d} last results",
             ds.limit-ds.tokens, ID=ID)
         yield defer.DeferredList(dList)
+        if hasattr(self, 'spool'):
+            # "Wait" for the records of the last files to be loaded
+            # from the spool
+            yield self.dt.deferToAll()
         self.msgBody(
             "Rejected {:d} IP addresses, of which {:d} were blocked",
             len(self.rk.rejectedIPs), sum(self.rk.rejectedIPs.values()), ID=ID)
+        metrics = self.rk.fc.metrics()
+        self.msgBody(
+            "DB flow control window ended at {:d} records, with {:d} "+\
+            "producer pauses and {:d} window cuts",
+            metrics['window'], metrics['paused'], metrics['cuts'], ID=ID)
         # Can now shut down, regularly or due to interruption
         self.lock.release()
         # Fire result deferred with list of bad IPs
@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# logalyzer:
+# Parses your bloated HTTP access logs to extract the info you want
+# about hits from (hopefully) real people instead of just the endless
+# stream of hackers and bots that passes for web traffic
+# nowadays. Stores the info in a relational database where you can
+# access it using all the power of SQL.
+#
+# Copyright (C) 2015, 2017, 2018 by Edwin A. Suominen,
+# http://edsuom.com/logalyzer
+#
+# See edsuom.com for API documentation as well as information about
+# Ed's background and other projects, software and otherwise.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the
+# License. You may obtain a copy of the License at
+# 
+#   http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an "AS
+# IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+
+
+"""
+Machine-readable metrics for unattended runs.
+
+Snapshots of the counts and gauges in a L{stats.Stats} object get
+written to a file every so often, either as lines of JSON appended to
+it or as a file for the textfile collector of the Prometheus node
+exporter. Taking a snapshot is just copying a few small dicts, so
+there's no reason not to leave it on. Each one includes the number
+of items held by each of the big structures that grow as a run goes
+on, see L{stats.Stats.sizes}.
+"""
+
+import os, time, json
+
+from twisted.internet import task
+
+
+class Metrics(object):
+    """
+    I write snapshots of the counts and gauges in a L{stats.Stats}
+    object to the file at I{filePath} every I{interval} seconds once
+    you call L{start}, and once more when you call L{stop}.
+
+    If the file name ends with I{.prom}, I replace it with each
+    snapshot in the Prometheus text format, for a textfile collector
+    to pick up. Otherwise, I append each snapshot to it as a line of
+    JSON.
+    """
+    interval = 10.0
+    prefix = "logalyzer_"
+
+    # The name of each count I write for each file (and overall),
+    # with the name it has in the stats. Accepted lines whose records
+    # weren't inserted were duplicates of ones already in the
+    # database. There's one of the purges for each IP address purged,
+    # and the entries it had in the database are purged.
+    fileCounts = (
+        ('bytes',      'bytes'),
+        ('lines',      'lines'),
+        ('accepted',   'parsed'),
+        ('ignored',    'ignored'),
+        ('blocked',    'blocked'),
+        ('inserts',    'added'),
+        ('duplicates', 'duplicates'),
+        ('purges',     'purges'),
+        ('purged',     'purged'),
+    )
+    # The name of each count I write for each worker
+    workerCounts = ('lines', 'bytes', 'seconds')
+    # The name of each gauge I write, with its name in the stats and
+    # its Prometheus metric type
+    gauges = (
+        ('db_in_flight',    'inFlight', 'gauge'),
+        ('producer_pauses', 'paused',   'counter'),
+        ('rss_bytes',       'rss',      'gauge'),
+    )
+    
+    def __init__(self, filePath, stats, interval=None):
+        self.filePath = filePath
+        self.stats = stats
+        if interval:
+            self.interval = interval
+        self.prom = filePath.endswith(".prom")
+        self.t0 = time.time()
+        self.lc = None
+
+    def counts(self, counts):
+        """
+        Returns a dict of what I write for one file (or overall), given
+        its I{counts} from the stats.
+        """
+        return dict([(x, counts.get(y, 0)) for x, y in self.fileCounts])
+
+    def latencies(self, snapshot):
+        """
+        Returns a dict of the latency of each stage, in seconds: the
+        CPU time spent by workers I{parse}-ing each line, the smoothed
+        time taken by each I{db} write, and the average time taken
+        by each I{purge} of an IP address. A stage that hasn't done
+        anything yet is left out.
+        """
+        counts = snapshot['counts']
+        result = {}
+        for name, numerator, denominator in (
+                ('parse', 'seconds', 'lines'),
+                ('purge', 'purgeSeconds', 'purges')):
+            if counts.get(denominator, 0):
+                result[name] = float(counts[numerator]) / counts[denominator]
+        latency = snapshot['gauges'].get('dbLatency', None)
+        if latency:
+            result['db'] = latency
+        return result
+    
+    def record(self, t=None):
+        """
+        Returns a dict of everything in one snapshot, taken at time I{t}
+        or now.
+        """
+        if t is None:
+            t = time.time()
+        snapshot = self.stats.snapshot()
+        workers = {}
+        for pid, counts in snapshot['workers'].iteritems():
+            workers[str(pid)] = dict(
+                [(x, counts.get(x, 0)) for x in self.workerCounts])
+        gauges = snapshot['gauges']
+        return {
+            'time': t,
+            'elapsed': t - self.t0,
+            'totals': self.counts(snapshot['counts']),
+            'files': dict([(x, self.counts(y))
+                           for x, y in snapshot['files'].iteritems()]),
+            'workers': workers,
+            'latency': self.latencies(snapshot),
+            'gauges': dict([(x[0], gauges.get(x[1], None))
+                            for x in self.gauges]),
+            'memory': {'sizes': self.stats.sizes()},
+        }
+
+    @staticmethod
+    def label(name, value):
+        value = str(value).replace(
+            '\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        return '{{{}="{}"}}'.format(name, value)
+    
+    def promLines(self, record):
+        """
+        Returns a list of the lines in the Prometheus text format for
+        the supplied I{record}.
+        """
+        def metric(name, kind, values, labelName=None):
+            name = self.prefix + name
+            lines.append("# TYPE {} {}".format(name, kind))
+            for key in sorted(values):
+                value = values[key]
+                if value is None:
+                    continue
+                label = "" if labelName is None \
+                        else self.label(labelName, key)
+                lines.append("{}{} {}".format(name, label, value))
+
+        lines = []
+        names = [x[0] for x in self.fileCounts]
+        for name in sorted(names):
+            metric(
+                name + "_total", "counter",
+                dict([(x, y[name]) for x, y in record['files'].iteritems()]),
+                'file')
+        for name in self.workerCounts:
+            metric(
+                "worker_{}_total".format(name), "counter",
+                dict([(x, y[name])
+                      for x, y in record['workers'].iteritems()]), 'pid')
+        metric("latency_seconds", "gauge", record['latency'], 'stage')
+        for name, null, kind in self.gauges:
+            value = record['gauges'][name]
+            if kind == "counter":
+                name += "_total"
+            metric(name, kind, {0: value})
+        memory = record['memory']
+        metric("items", "gauge", memory['sizes'], 'structure')
+        metric("elapsed_seconds", "gauge", {0: record['elapsed']})
+        metric("last_update_timestamp_seconds", "gauge", {0: record['time']})
+        return lines
+
+    def write(self, t=None):
+        """
+        Writes a snapshot taken at time I{t} or now to my file.
+        """
+        record = self.record(t)
+        if self.prom:
+            # Written to a temporary file and then renamed so that the
+            # collector never sees a partial one. It ignores files
+            # without the .prom extension.
+            tempPath = "{}.{:d}".format(self.filePath, os.getpid())
+            with open(tempPath, 'w') as fh:
+                for line in self.promLines(record):
+                    fh.write(line + '\n')
+            os.rename(tempPath, self.filePath)
+            return
+        with open(self.filePath, 'a') as fh:
+            fh.write(json.dumps(record, sort_keys=True) + '\n')
+
+    def start(self):
+        """
+        Starts writing a snapshot every I{interval} seconds.
+        """
+        self.lc = task.LoopingCall(self.write)
+        self.lc.start(self.interval, now=False)
+    
+    def stop(self):
+        """
+        Stops my periodic writing and writes one last snapshot.
+        """
+        if self.lc is not None and self.lc.running:
+            self.lc.stop()
+        self.lc = None
+        self.write()
+
+
+def throughputReport(stats, elapsed):
+    """
+    Returns a list of lines reporting, for each logfile and overall,
+    the lines read, the lines accepted, ignored, and blocked, the
+    wall time taken, and the lines read per second, given a
+    L{stats.Stats} object and the I{elapsed} seconds of the run.
+    """
+    def row(name, counts, seconds):
+        lines = counts.get('lines', 0)
+        rate = "{:.0f}".format(lines/seconds) if seconds else "-"
+        return proto.format(
+            name, lines, counts.get('parsed', 0), counts.get('ignored', 0),
+            counts.get('blocked', 0), seconds, rate)
+
+    width = max([len(x) for x in stats.files] + [len("Total")])
+    proto = "{:<" + str(width) + "s} {:>10d} {:>10d} {:>10d} {:>10d} " +\
+            "{:>10.2f} {:>10s}"
+    result = [("{:<" + str(width) + "s} {:>10s} {:>10s} {:>10s} {:>10s} " +\
+               "{:>10s} {:>10s}").format(
+                   "File", "Lines", "Accepted", "Ignored", "Blocked",
+                   "Wall s", "Lines/s")]
+    for fileName in sorted(stats.files):
+        counts = stats.files[fileName]
+        result.append(row(fileName, counts, counts.get('wall', 0.0)))
+    result.append(row("Total", stats.counts, elapsed))
+    seconds = stats.get('seconds')
+    if seconds:
+        result.append(
+            "Workers parsed {:.0f} lines per CPU second".format(
+                stats.get('lines')/seconds))
+    return result
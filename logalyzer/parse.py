@@ -49,6 +49,9 @@ class RedirectChecker(object):
     def __init__(self):
         self.redirects = set()
 
+    def __len__(self):
+        return len(self.redirects)
+        
     def clear(self):
         self.redirects.clear()
         
@@ -115,7 +118,7 @@ class LineParser(object):
 
     reCLF = rc(
         # IP Address
-        r'(\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})',        # 1
+        r'(' + IP_PATTERN + r')',                       # 1
         # vhost
         r'([\w\-\.]+)',                                 # 2
         # -
@@ -161,8 +164,38 @@ class LineParser(object):
         month = self.months.index(monthName) + 1
         return self.dtFactory(year, month, day, hour, minute, second)
 
+    def timestampKey(self, line):
+        """
+        Returns a 'YYYY-MM-DD HH:MM:SS' string for the timestamp of the
+        supplied line, or C{None} if it doesn't have one I can
+        find. The rest of the line isn't parsed, so this is a lot
+        faster than calling me.
+
+        The strings sort in chronological order, and can be compared
+        with the result of C{strftime("%Y-%m-%d %H:%M:%S")} for a
+        datetime object.
+        """
+        if line[:4].isdigit() and line[4:5] == "-":
+            # twistd prefix
+            return line[:10] + " " + line[11:19]
+        k0 = line.find('[')
+        k1 = line.find(']', k0)
+        if k0 < 0 or k1 < 0:
+            return
+        try:
+            day, monthName, rest = line[k0+1:k1].split('/', 2)
+            month = self.months.index(monthName) + 1
+            day = int(day)
+        except ValueError:
+            return
+        return "{}-{:02d}-{:02d} {}".format(rest[:4], month, day, rest[5:13])
+    
     def setVhost(self, vhost):
-        self.vhost = vhost.lower()
+        """
+        Sets a vhost for lines that don't specify one, or clears it if
+        C{None}.
+        """
+        self.vhost = vhost.lower() if vhost else None
     
     def __call__(self, line):
         """
@@ -0,0 +1,368 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# logalyzer:
+# Parses your bloated HTTP access logs to extract the info you want
+# about hits from (hopefully) real people instead of just the endless
+# stream of hackers and bots that passes for web traffic
+# nowadays. Stores the info in a relational database where you can
+# access it using all the power of SQL.
+#
+# Copyright (C) 2015, 2017, 2018 by Edwin A. Suominen,
+# http://edsuom.com/logalyzer
+#
+# See edsuom.com for API documentation as well as information about
+# Ed's background and other projects, software and otherwise.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the
+# License. You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an "AS
+# IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+
+"""
+Database writing partitioned across writer processes.
+
+Each writer process owns a hash partition of IP addresses and has
+its own L{database.Transactor}, with its own DB connections and its
+own deduplication state. All the entries from one IP address are
+written by one writer, so checking for duplicate entries and purging
+an IP address never involve more than one of them.
+
+The main process talks to its writers with Twisted's AMP over their
+stdin and stdout, sending records in batches.
+"""
+
+import sys, os, os.path, zlib, cPickle as pickle
+
+from twisted.internet import reactor, defer, stdio
+from twisted.internet.endpoints import ProcessEndpoint, connectProtocol
+from twisted.protocols import amp
+
+from util import Base
+import database
+
+
+# The directory containing this package, for writer processes to
+# import it from
+PACKAGE_PARENT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def partitionOf(ip, N):
+    """
+    Returns the index of the partition, of I{N} partitions, that owns
+    the supplied dotted-quad IP address. The result is the same in
+    every process, unlike Python's C{hash}.
+    """
+    return (zlib.crc32(ip) & 0xffffffff) % N
+
+
+class Startup(amp.Command):
+    arguments = [
+        ('url', amp.String()), ('k', amp.Integer()), ('N', amp.Integer()),
+        ('pool_size', amp.Integer()), ('echo', amp.Boolean()),
+        ('compact', amp.Boolean()), ('rollups', amp.Boolean()),
+        ('sketches', amp.Boolean())]
+    response = [('N_ip', amp.Integer())]
+
+class AddRecords(amp.Command):
+    # A pickled list of (dt, record) tuples
+    arguments = [('records', amp.String())]
+    # One character for each record, '1' if it was added or '0' if not
+    response = [('added', amp.String())]
+
+class PurgeIP(amp.Command):
+    arguments = [('ip', amp.String())]
+    response = [('N', amp.Integer())]
+
+class Shutdown(amp.Command):
+    arguments = []
+    response = []
+
+
+class WriterProtocol(amp.AMP):
+    """
+    I run in a writer process, doing database transactions for the
+    records and purges that the main process sends me.
+    """
+    def __init__(self):
+        amp.AMP.__init__(self)
+        self.purgedIPs = set()
+
+    @Startup.responder
+    def startup(
+            self, url, k, N, pool_size, echo, compact, rollups, sketches):
+        def done(N_ip):
+            return {'N_ip': N_ip}
+
+        self.t = database.Transactor(
+            url, pool_size=pool_size, verbose=echo, echo=echo,
+            compact=compact, rollups=rollups, sketches=sketches)
+        return self.t.callWhenRunning(
+            self.t.preload, N_batch=100,
+            ipFilter=lambda ip: partitionOf(ip, N) == k).addCallback(done)
+
+    @AddRecords.responder
+    def addRecords(self, records):
+        def done(results):
+            return {'added': "".join(["1" if x else "0" for x in results])}
+
+        dList = []
+        for dt, record in pickle.loads(records):
+            if record['ip'] in self.purgedIPs:
+                d = defer.succeed(False)
+            else:
+                d = self.t.setRecord(dt, record)
+            dList.append(d)
+        return defer.gatherResults(dList).addCallback(done)
+
+    @PurgeIP.responder
+    def purgeIP(self, ip):
+        self.purgedIPs.add(ip)
+        return self.t.purgeIP(ip, niceness=15).addCallback(
+            lambda N: {'N': N or 0})
+
+    @Shutdown.responder
+    def shutdown(self):
+        return self.t.shutdown().addCallback(lambda _: {})
+
+    def connectionLost(self, reason):
+        amp.AMP.connectionLost(self, reason)
+        if reactor.running:
+            reactor.stop()
+
+
+class WriterClient(amp.AMP):
+    """
+    I talk to a writer process over its stdin and stdout.
+    """
+    def makeConnection(self, transport):
+        # A process transport has no peer or host address, which AMP
+        # only wants for log messages
+        self._transportPeer = self._transportHost = None
+        amp.BinaryBoxProtocol.makeConnection(self, transport)
+
+
+class Partition(Base):
+    """
+    I am the main process's handle on one writer process. Records are
+    sent to it in batches of up to I{batchSize} records, or after
+    I{batchDelay} seconds, whichever comes first.
+    """
+    batchSize = 200
+    batchDelay = 0.05
+    # AMP values can't be any bigger than 64K
+    maxBytes = 60000
+
+    def __init__(self, ap):
+        self.ap = ap
+        self.pending = []
+        self.dc = None
+
+    def addRecord(self, dt, record):
+        """
+        Queues up the supplied record for my writer, returning a
+        C{Deferred} that fires with C{True} if it was added to the
+        database.
+        """
+        d = defer.Deferred()
+        self.pending.append((dt, record, d))
+        if len(self.pending) >= self.batchSize:
+            self.flush()
+        elif self.dc is None:
+            self.dc = reactor.callLater(self.batchDelay, self.flush)
+        return d
+
+    def flush(self):
+        """
+        Sends all pending records to my writer now.
+        """
+        if self.dc is not None:
+            if self.dc.active():
+                self.dc.cancel()
+            self.dc = None
+        if self.pending:
+            batch = self.pending
+            self.pending = []
+            self._send(batch)
+
+    def _send(self, batch):
+        def gotResponse(response):
+            for k, char in enumerate(response['added']):
+                batch[k][2].callback(char == "1")
+
+        def failed(failureObj):
+            for stuff in batch:
+                stuff[2].errback(failureObj)
+
+        records = pickle.dumps([x[:2] for x in batch], 2)
+        if len(records) > self.maxBytes and len(batch) > 1:
+            k = len(batch) // 2
+            self._send(batch[:k])
+            self._send(batch[k:])
+            return
+        self.ap.callRemote(
+            AddRecords, records=records).addCallbacks(gotResponse, failed)
+
+    def purgeIP(self, ip):
+        """
+        Has my writer purge the database of entries from the supplied IP
+        address, after any records from it that are still pending.
+        """
+        self.flush()
+        return self.ap.callRemote(PurgeIP, ip=ip).addCallback(
+            lambda response: response['N'])
+
+    def shutdown(self):
+        self.flush()
+        d = self.ap.callRemote(Shutdown)
+        d.addCallback(lambda _: self.ap.transport.loseConnection())
+        return d
+
+
+class Partitions(Base):
+    """
+    I stand in for a L{database.Transactor} in a L{records.RecordKeeper},
+    dividing its record writes and IP purges among I{N} writer
+    processes by hash partition of IP address. File info stays with
+    a transactor of my own in the main process.
+    """
+    def __init__(
+            self, dbURL, N,
+            pool_size=None, verbose=False, echo=False,
+            compact=False, rollups=False, sketches=False):
+        self.dbURL = dbURL
+        self.N = N
+        self.pool_size = pool_size
+        self.echo = echo
+        # My transactor creates all the tables before any writer
+        # starts up, so the writers won't race each other doing it
+        self.t = database.Transactor(
+            dbURL, pool_size=pool_size, verbose=verbose, echo=echo,
+            compact=compact, rollups=rollups, sketches=sketches)
+        self.partitions = []
+
+    def callWhenRunning(self, f, *args, **kw):
+        return self.t.callWhenRunning(f, *args, **kw)
+
+    def _endpoint(self):
+        env = dict(os.environ)
+        # Make sure the writer can import this package, even if it's
+        # not installed
+        env['PYTHONPATH'] = os.pathsep.join(
+            [PACKAGE_PARENT] + filter(None, [env.get('PYTHONPATH')]))
+        args = [sys.executable, '-m', 'logalyzer.partition']
+        return ProcessEndpoint(reactor, sys.executable, args, env=env)
+
+    @defer.inlineCallbacks
+    def preload(self, **kw):
+        """
+        Spawns my writer processes and has each one preload the IP
+        addresses in its partition. Returns a C{Deferred} that fires
+        with the number of IP addresses in the database.
+
+        Progress keywords for L{database.Transactor.preload} are
+        ignored.
+        """
+        dList = []
+        for k in xrange(self.N):
+            dList.append(connectProtocol(self._endpoint(), WriterClient()))
+        apList = yield defer.gatherResults(dList)
+        dList = []
+        for k, ap in enumerate(apList):
+            self.partitions.append(Partition(ap))
+            dList.append(ap.callRemote(
+                Startup, url=self.dbURL, k=k, N=self.N,
+                pool_size=self.pool_size or 5, echo=self.echo,
+                compact=self.t.compact, rollups=self.t.rollups,
+                sketches=self.t.sketches))
+        responses = yield defer.gatherResults(dList)
+        defer.returnValue(sum([x['N_ip'] for x in responses]))
+
+    def _partition(self, ip):
+        return self.partitions[partitionOf(ip, self.N)]
+
+    def setRecord(self, dt, record):
+        """
+        See L{database.Transactor.setRecord}.
+        """
+        return self._partition(record['ip']).addRecord(dt, record)
+
+    def setRecords(self, records):
+        """
+        See L{database.Transactor.setRecords}.
+        """
+        dList = [self.setRecord(*x) for x in records]
+        return defer.gatherResults(dList).addCallback(sum)
+    
+    def purgeIP(self, ip, **kw):
+        """
+        See L{database.Transactor.purgeIP}. Any keywords are ignored.
+        """
+        return self._partition(ip).purgeIP(ip)
+
+    def fileInfo(self, *args):
+        """
+        See L{database.Transactor.fileInfo}.
+        """
+        return self.t.fileInfo(*args)
+
+    def fileSpan(self, *args):
+        """
+        See L{database.Transactor.fileSpan}.
+        """
+        return self.t.fileSpan(*args)
+    
+    def getWatermarks(self):
+        """
+        See L{database.Transactor.getWatermarks}.
+        """
+        return self.t.getWatermarks()
+
+    def setWatermark(self, source, dt):
+        """
+        See L{database.Transactor.setWatermark}.
+        """
+        return self.t.setWatermark(source, dt)
+    
+    def hitsForIP(self, ip):
+        """
+        See L{database.Transactor.hitsForIP}.
+        """
+        return self.t.hitsForIP(ip)
+
+    def sizes(self):
+        """
+        See L{database.Transactor.sizes}. The structures in my writer
+        processes aren't included.
+        """
+        return self.t.sizes()
+    
+    @defer.inlineCallbacks
+    def shutdown(self):
+        dList = []
+        while self.partitions:
+            dList.append(self.partitions.pop().shutdown())
+        yield defer.DeferredList(dList)
+        yield self.t.shutdown()
+
+
+def run():
+    """
+    Runs a writer process, talking AMP with the main process over
+    stdin and stdout.
+    """
+    # Anything printed would garble the AMP stream
+    sys.stdout = sys.stderr
+    stdio.StandardIO(WriterProtocol())
+    reactor.run()
+
+
+if __name__ == "__main__":
+    run()
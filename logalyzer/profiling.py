@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# logalyzer:
+# Parses your bloated HTTP access logs to extract the info you want
+# about hits from (hopefully) real people instead of just the endless
+# stream of hackers and bots that passes for web traffic
+# nowadays. Stores the info in a relational database where you can
+# access it using all the power of SQL.
+#
+# Copyright (C) 2015, 2017, 2018 by Edwin A. Suominen,
+# http://edsuom.com/logalyzer
+#
+# See edsuom.com for API documentation as well as information about
+# Ed's background and other projects, software and otherwise.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the
+# License. You may obtain a copy of the License at
+# 
+#   http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an "AS
+# IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+
+
+"""
+Profiling of the main process and its parsing workers.
+
+Each process writes its own C{.pstats} file to a profile directory:
+I{main-<pid>.pstats} for the main process, including the threads that
+do its database transactions, and I{worker-<pid>.pstats} for each
+worker of the process queue. Then L{summarize} merges them into a
+summary of where the time went in each part of the pipeline.
+"""
+
+import os, os.path, glob, types, threading, pstats
+from cProfile import Profile
+
+# The logread module imports this one, but only uses it once both are
+# loaded
+import logread, parse, sift, records, database
+
+
+# The profiler of this worker process, if it's being profiled
+_workerProfile = None
+
+def profileWorker():
+    """
+    Starts profiling this worker process for the rest of its life, if
+    it isn't already being profiled.
+    """
+    global _workerProfile
+    if _workerProfile is None:
+        _workerProfile = Profile()
+        _workerProfile.enable()
+
+def dumpWorker(dirPath):
+    """
+    Writes the profile of this worker process so far to its
+    I{worker-<pid>.pstats} file in the directory at I{dirPath}, and
+    keeps on profiling.
+    """
+    if _workerProfile is None:
+        return
+    _workerProfile.dump_stats(
+        os.path.join(dirPath, "worker-{:d}.pstats".format(os.getpid())))
+    _workerProfile.enable()
+
+
+class Snapshot(object):
+    """
+    I hold a snapshot of the stats of a profiler that may still be
+    running in another thread, in a form that C{pstats.Stats} will
+    accept.
+    """
+    def __init__(self, profile):
+        profile.snapshot_stats()
+        self.stats = profile.stats
+
+    def create_stats(self):
+        pass
+
+
+class Profiler(object):
+    """
+    I profile the main process, including any threads that get started
+    after you call my L{start} method, and write its profile to a
+    I{main-<pid>.pstats} file in the directory at I{dirPath} when you
+    call L{stop}. Any profiles left there from a previous run get
+    removed so they won't be merged with this one's.
+    """
+    def __init__(self, dirPath):
+        self.dirPath = dirPath
+        if os.path.isdir(dirPath):
+            for filePath in glob.glob(os.path.join(dirPath, "*.pstats")):
+                os.remove(filePath)
+        else: os.makedirs(dirPath)
+        self.profiles = []
+
+    def _thread(self, frame, event, arg):
+        # Only called on the first profiling event of a new thread,
+        # because enabling a profiler replaces this function
+        self.startProfile()
+
+    def startProfile(self):
+        p = Profile()
+        self.profiles.append(p)
+        p.enable()
+        
+    def start(self):
+        """
+        Starts profiling this thread and any new ones.
+        """
+        threading.setprofile(self._thread)
+        self.startProfile()
+
+    def stop(self):
+        """
+        Stops profiling and writes the profile of this process, returning
+        the path of its file.
+        """
+        threading.setprofile(None)
+        main = self.profiles[0]
+        main.disable()
+        ps = pstats.Stats(Snapshot(main))
+        for p in self.profiles[1:]:
+            ps.add(Snapshot(p))
+        filePath = os.path.join(
+            self.dirPath, "main-{:d}.pstats".format(os.getpid()))
+        ps.dump_stats(filePath)
+        return filePath
+
+    
+class Component(object):
+    """
+    I identify the functions of one class in profile stats: its
+    methods (including ones wrapped by decorators) and any functions
+    defined inside them.
+    """
+    def __init__(self, name, cls):
+        self.name = name
+        self.funcs = set()
+        for obj in cls.__dict__.itervalues():
+            if isinstance(obj, (staticmethod, classmethod)):
+                obj = obj.__func__
+            if isinstance(obj, types.FunctionType):
+                self.addFunction(obj)
+
+    def addFunction(self, func):
+        inner = [x.cell_contents for x in (func.func_closure or [])
+                 if isinstance(x.cell_contents, types.FunctionType)]
+        code = func.func_code
+        if inner and code.co_filename != inner[0].func_code.co_filename:
+            # A decorator from somewhere else, whose code isn't mine
+            for func in inner:
+                self.addFunction(func)
+            return
+        self.addCode(code)
+
+    def addCode(self, code):
+        self.funcs.add((code.co_filename, code.co_firstlineno, code.co_name))
+        for obj in code.co_consts:
+            if isinstance(obj, types.CodeType):
+                self.addCode(obj)
+        
+    def __contains__(self, func):
+        """
+        Returns C{True} if the supplied function of the profile stats, a
+        tuple with its file name, line number, and name, is one of
+        mine.
+        """
+        return func in self.funcs
+    
+    def times(self, stats):
+        """
+        Returns a 3-tuple with the number of calls to my functions, the
+        cumulative time spent in them and what they call, and the time
+        spent in them alone, from the supplied dict of profile
+        I{stats}.
+
+        The calls and cumulative time are only counted for my
+        functions that aren't called by any of my other ones, so
+        nothing is counted twice.
+        """
+        N, ct, tt = 0, 0.0, 0.0
+        for func in self.funcs:
+            stuff = stats.get(func, None)
+            if stuff is None:
+                continue
+            tt += stuff[2]
+            if [x for x in stuff[4] if x in self.funcs]:
+                continue
+            N += stuff[1]
+            ct += stuff[3]
+        return N, ct, tt
+
+
+def components():
+    """
+    Returns a list of L{Component} objects for the parts of the
+    pipeline that a profile summary shows. The regular-expression
+    matchers all share the code of L{sift.ReMatcherBase}, so they
+    can't be told apart.
+    """
+    return [Component(*x) for x in (
+        ("ProcessReader",   logread.ProcessReader),
+        ("LineParser",      parse.LineParser),
+        ("IPMatcher",       sift.IPMatcher),
+        ("NetMatcher",      sift.NetMatcher),
+        ("Regex matchers",  sift.ReMatcherBase),
+        ("ProcessConsumer", records.ProcessConsumer),
+        ("RecordKeeper",    records.RecordKeeper),
+        ("Transactor",      database.Transactor),
+    )]
+
+
+def summarize(dirPath, N_top=25):
+    """
+    Merges all the C{.pstats} files in the directory at I{dirPath}
+    and writes a summary of where the time went to I{summary.txt}
+    there, returning its path. The summary has the calls, cumulative
+    time, and own time of each part of the pipeline, followed by the
+    I{N_top} functions with the most time spent in them alone.
+    """
+    filePaths = sorted(glob.glob(os.path.join(dirPath, "*.pstats")))
+    summaryPath = os.path.join(dirPath, "summary.txt")
+    with open(summaryPath, 'w') as fh:
+        if not filePaths:
+            fh.write("No profiles in {}\n".format(dirPath))
+            return summaryPath
+        ps = pstats.Stats(*filePaths, stream=fh)
+        fh.write("Where the time went in {:d} processes\n\n".format(
+            len(filePaths)))
+        fh.write("{:<16s} {:>10s} {:>14s} {:>10s}\n".format(
+            "", "Calls", "Cumulative s", "Own s"))
+        for c in components():
+            fh.write("{:<16s} {:>10d} {:>14.3f} {:>10.3f}\n".format(
+                c.name, *c.times(ps.stats)))
+        fh.write("\n")
+        ps.strip_dirs().sort_stats('tottime').print_stats(N_top)
+    return summaryPath
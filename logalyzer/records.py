@@ -30,17 +30,140 @@
 All the recordkeeping is done here, with help from L{database}.
 """
 
+import time
+
 from zope.interface import implements
 from twisted.internet import defer
 from twisted.internet.interfaces import IConsumer
 
 from asynqueue.util import DeferredTracker
 
-from util import oops, Base
+from util import oops, Base, rss, physicalMemory
 from sift import IPMatcher
-import database
+from stats import Stats
+
+
+class FlowControl(Base):
+    """
+    I size the window of records that all my consumers together may
+    have waiting on the database before their producers get paused,
+    the way TCP sizes its congestion window.
+
+    The window grows by about one record for each window's worth of
+    records written while the smoothed DB write latency stays under
+    I{maxLatency} seconds. It's cut in half, no more than once per
+    window's worth, when the latency goes over that, or when the
+    resident memory of this process goes over I{maxMemory} bytes (by
+    default, half the physical memory). There's no default if the
+    current resident memory can't be determined, see L{util.rss}.
+
+    @ivar window: The current window size, in records.
+    @ivar latency: The smoothed latency of DB writes, in seconds.
+    @ivar N_paused: The number of times a producer was paused.
+    @ivar N_resumed: The number of times a producer was resumed.
+    """
+    initialWindow = 10
+    minWindow = 2
+    maxWindow = 1000
+    maxLatency = 0.5
+    # Weight of each new latency in the smoothed latency
+    alpha = 0.1
+    # Memory is only checked every this many completed writes
+    memoryInterval = 100
+    
+    def __init__(self, maxLatency=None, maxMemory=None):
+        if maxLatency:
+            self.maxLatency = maxLatency
+        if maxMemory is None and rss() is not None:
+            maxMemory = physicalMemory()
+            if maxMemory: maxMemory /= 2
+        self.maxMemory = maxMemory
+        self.window = float(self.initialWindow)
+        self.latency = 0.0
+        self.N_inFlight = 0
+        self.N_done = 0
+        self.N_paused = 0
+        self.N_resumed = 0
+        self.N_cuts = 0
+        self.kLastCut = 0
+        self.paused = set()
+
+    def sent(self):
+        """
+        Call this when a record is sent to the database. Returns a
+        timestamp to supply to L{done} when the write is done.
+        """
+        self.N_inFlight += 1
+        return time.time()
 
+    def isFull(self):
+        """
+        Returns C{True} if the number of records waiting on the database
+        is over my window size.
+        """
+        return self.N_inFlight > self.window
+    
+    def pause(self, producer):
+        """
+        Pauses the supplied producer until there's room in my window.
+        """
+        if producer not in self.paused:
+            self.paused.add(producer)
+            producer.pauseProducing()
+            self.N_paused += 1
 
+    def forget(self, producer):
+        """
+        Call this when a producer is done, so I don't try to resume it.
+        """
+        self.paused.discard(producer)
+    
+    def done(self, t0):
+        """
+        Call this with the timestamp I{t0} returned from L{sent} when a
+        DB write is done. Updates my window and resumes all paused
+        producers if there's room in it.
+        """
+        self.N_inFlight -= 1
+        self.N_done += 1
+        self.latency += self.alpha * (time.time() - t0 - self.latency)
+        if self.isCongested():
+            # No more than one cut for each window's worth of writes,
+            # since the ones already in flight don't reflect the last
+            # cut yet
+            if self.N_done - self.kLastCut > self.window:
+                self.window = max([self.minWindow, 0.5*self.window])
+                self.kLastCut = self.N_done
+                self.N_cuts += 1
+        elif self.window < self.maxWindow:
+            self.window = min([self.maxWindow, self.window + 1.0/self.window])
+        if self.paused and not self.isFull():
+            paused = self.paused
+            self.paused = set()
+            for producer in paused:
+                producer.resumeProducing()
+                self.N_resumed += 1
+
+    def isCongested(self):
+        if self.latency > self.maxLatency:
+            return True
+        if self.maxMemory and not self.N_done % self.memoryInterval:
+            N_bytes = rss()
+            if N_bytes and N_bytes > self.maxMemory:
+                return True
+        return False
+
+    def metrics(self):
+        """
+        Returns a dict of my current window size, smoothed latency,
+        number of window cuts, and pause and resume counts.
+        """
+        return {
+            'window': int(self.window), 'latency': self.latency,
+            'cuts': self.N_cuts,
+            'paused': self.N_paused, 'resumed': self.N_resumed}
+    
+        
 class ProcessConsumer(Base):
     """
     I consume bad IP addresses and good records from a logfile parsing
@@ -51,16 +174,26 @@ class ProcessConsumer(Base):
     msgInterval = 10000
     stopInterval = 100000
     
-    def __init__(self, rk, fileName, msgID=None, verbose=False, gui=None):
+    def __init__(
+            self, rk, fileName,
+            msgID=None, verbose=False, gui=None, tally=False, stats=None):
+        if tally:
+            # For consuming one shard of a logfile, see shardedCount
+            self.ipCounts = {}
+            self.blockedIPs = set()
         self.N_parsed = 0
         self.N_added = 0
+        # The latest record the worker has found, see
+        # logread.ProcessReader.workerCounts
+        self.dtLast = None
         self.rk = rk
         self.fileName = fileName
         self.msgID = msgID
         self.verbose = verbose
         self.gui = gui
+        self.stats = rk.stats if stats is None else stats
         self.dt = DeferredTracker()
-        self.N_backLog = 0
+        self.fc = rk.fc
     
     def registerProducer(self, producer, streaming):
         if hasattr(self, 'producer'):
@@ -80,6 +213,7 @@ class ProcessConsumer(Base):
     def unregisterProducer(self):
         if not hasattr(self, 'producer'):
             return
+        self.fc.forget(self.producer)
         del self.producer
         if self.verbose:
             self.msgBody(
@@ -99,53 +233,144 @@ class ProcessConsumer(Base):
         self.dProducer.callback(None)
 
     def write(self, data):
+        def release(result, t0):
+            # Failed or not, the write isn't in flight anymore
+            self.fc.done(t0)
+            return result
+        
         def done(wasAdded):
-            self.N_backLog -= 1
-            if self.N_backLog < 10 and hasattr(self, 'producer'):
-                self.producer.resumeProducing()
             if hasattr(self, 'rk'):
                 self.N_parsed += 1
+                self.stats.bump('parsed', fileName=self.fileName)
                 if wasAdded:
                     self.N_added += 1
-                return
-                # This next little bit causes a huge memory leak, only
-                # in GUI mode. A high price to pay to watch a spinner
-                # symbol, so it's avoided with the 'return' above.
-                if not self.N_parsed % 10:
-                    self.rk.fileProgress(self.fileName)
-                if self.msgID and not self.N_added % 100:
-                    self.rk.msgProgress(self.msgID)
+                    self.stats.bump('added', fileName=self.fileName)
+                else:
+                    self.stats.bump('duplicates', fileName=self.fileName)
 
         if not hasattr(self, 'rk'):
             return
+        if isinstance(data, dict):
+            # Counts from the parsing worker, see
+            # logread.ProcessReader.workerCounts
+            for name in ('lines', 'bytes', 'seconds'):
+                self.stats.bump(
+                    name, data[name],
+                    fileName=self.fileName, worker=data['pid'])
+            for name, (hits, lookups) in data['caches'].iteritems():
+                self.stats.bump('hits.' + name, hits)
+                self.stats.bump('lookups.' + name, lookups)
+            for check, N in data.get('rejects', {}).iteritems():
+                self.stats.bump('rejects.' + check, N)
+            for name, ruleCounts in data.get('rules', {}).iteritems():
+                self.stats.tally(name, ruleCounts)
+            if 'sizes' in data:
+                self.stats.setSizes(data['pid'], data['sizes'])
+            dtLast = data.get('last', None)
+            if dtLast and (self.dtLast is None or dtLast > self.dtLast):
+                self.dtLast = dtLast
+            return
         if isinstance(data[0], str):
+            if data[1] and hasattr(self, 'blockedIPs'):
+                self.blockedIPs.add(data[0])
+            self.stats.bump(
+                'blocked' if data[1] else 'ignored', fileName=self.fileName)
             # No need to pause producer for a mere IP address
-            d = self.rk.purgeIP(*data)
+            d = self.rk.purgeIP(*data, fileName=self.fileName)
             # With both disabled, usage was file; VM=316MB, RM=111MB
             # No worse with this enabled
         else:
             # Writing records can take a while, so pause the producer
-            # until it's done if there's a backlog. That keeps my DB
-            # transaction queue's memory usage from ballooning with
-            # too many pending records.
-            self.N_backLog += 1
-            if self.N_backLog > 10:
-                self.producer.pauseProducing()
-            # Major memory leak was caused by the callback, in GUI
-            # mode: It added a little over 5,000 bytes per record
-            # parsed to the memory usage.
-            d = self.rk.addRecord(*data).addCallbacks(done, oops)
+            # until it's done if there's a backlog bigger than the flow
+            # control window. That keeps my DB transaction queue's
+            # memory usage from ballooning with too many pending
+            # records.
+            if hasattr(self, 'ipCounts'):
+                ip = data[1]['ip']
+                self.ipCounts[ip] = self.ipCounts.get(ip, 0) + 1
+            t0 = self.fc.sent()
+            if self.fc.isFull() and hasattr(self, 'producer'):
+                self.fc.pause(self.producer)
+            # The callback only bumps counts in my stats. Updating the
+            # GUI from it for every record added a little over 5,000
+            # bytes per record parsed to the memory usage, so the GUI
+            # samples the stats instead.
+            d = self.rk.addRecord(*data).addBoth(release, t0)
+            d.addCallbacks(done, oops)
         self.dt.put(d)
 
     def stopProduction(self, ID=None):
         del self.rk
         if hasattr(self, 'producer'):
+            self.fc.forget(self.producer)
             self.msgBody(
                 "Interrupting producer {} after {:d}/{:d} records",
                 repr(self.producer), self.N_added, self.N_parsed, ID=ID)
             self.producer.stopProducing()
         return self.dt.deferToAll()
-            
+
+
+def shardedCount(consumers):
+    """
+    Returns the number of records that a single-worker parsing of a
+    logfile would have written, given the tallying
+    L{ProcessConsumer} instances that consumed its shards, in file
+    order.
+
+    A shard doesn't know about IP addresses blocked in the shards
+    before it, so it yields records from them that a single worker
+    would have skipped. Those don't get counted.
+    """
+    N = 0
+    blockedIPs = set()
+    for consumer in consumers:
+        for ip, N_ip in consumer.ipCounts.iteritems():
+            if ip not in blockedIPs:
+                N += N_ip
+        blockedIPs.update(consumer.blockedIPs)
+    return N
+
+
+class NullTransactor(object):
+    """
+    I stand in for a L{database.Transactor} when there's no database,
+    for a dry run. Every record gets accepted and nothing gets
+    written, so nothing is ever added or purged, and there's never
+    anything stored about a logfile.
+    """
+    def callWhenRunning(self, f, *args, **kw):
+        return defer.maybeDeferred(f, *args, **kw)
+
+    def preload(self, **kw):
+        return defer.succeed(0)
+
+    def shutdown(self):
+        return defer.succeed(None)
+
+    def fileInfo(self, *args, **kw):
+        return defer.succeed(None)
+
+    def fileSpan(self, *args, **kw):
+        return defer.succeed(None)
+
+    def getWatermarks(self, **kw):
+        return defer.succeed({})
+
+    def setWatermark(self, *args, **kw):
+        return defer.succeed(None)
+
+    def purgeIP(self, *args, **kw):
+        return defer.succeed(0)
+
+    def setRecord(self, *args, **kw):
+        return defer.succeed(False)
+
+    def setRecords(self, *args, **kw):
+        return defer.succeed(0)
+
+    def sizes(self):
+        return {}
+    
                 
 class RecordKeeper(Base):
     """
@@ -158,20 +383,50 @@ class RecordKeeper(Base):
     make use of L{DTK} and {sift.IPMatcher} instances via I{dtk} and
     I{ipm} attributes to avoid database activity.
 
+    With a I{dbURL} of C{None}, there's no database and I use a
+    L{NullTransactor} instead, for a dry run.
+
     """
     progressUpdateInterval = 1000
     
     def __init__(
             self, dbURL, N_pool, blockedIPs,
-            verbose=False, info=False, echo=False, gui=None):
+            verbose=False, info=False, echo=False, gui=None, writers=1,
+            compact=False, rollups=False, sketches=False, stats=None):
         # ---------------------------------------------------------------------
         self.rejectedIPs = dict.fromkeys(blockedIPs, True)
         self.verbose = verbose
         self.info = info
         self.gui = gui
-        self.t = database.Transactor(
-            dbURL, pool_size=N_pool, verbose=echo, echo=echo)
+        self.stats = Stats() if stats is None else stats
+        if dbURL is None:
+            writers = 0
+        elif writers > 1 and dbURL in ('sqlite://', 'sqlite:///:memory:'):
+            self.msgWarning(
+                "Writer processes can't share an in-memory database")
+            writers = 1
+        kw = {'pool_size': N_pool, 'verbose': echo, 'echo': echo,
+              'compact': compact, 'rollups': rollups, 'sketches': sketches}
+        # The database modules bring in sAsync and SQLAlchemy, which a
+        # dry run doesn't need
+        if dbURL is None:
+            self.t = NullTransactor()
+        elif writers > 1:
+            # Record writes and purges are done by writer processes,
+            # each owning a hash partition of IP addresses
+            import partition
+            self.t = partition.Partitions(dbURL, writers, **kw)
+        else:
+            import database
+            self.t = database.Transactor(dbURL, **kw)
         self.dt = DeferredTracker()
+        # One window for all consumers, since they share the database
+        self.fc = FlowControl()
+        self.stats.gauge('inFlight', lambda: self.fc.N_inFlight)
+        self.stats.gauge('paused', lambda: self.fc.N_paused)
+        self.stats.gauge('dbLatency', lambda: self.fc.latency)
+        self.stats.gauge('rss', rss)
+        self.stats.sizer(self.sizes)
         # There will be no repeated checks of the same IP in my usage
         # of the IP matcher, so the cache would only slow things down
         self.ipm = IPMatcher()
@@ -197,6 +452,13 @@ class RecordKeeper(Base):
             N_progress=self.progressUpdateInterval).addCallbacks(
                 done, oops)
         
+    def waitUntilRunning(self):
+        """
+        Returns a deferred that fires when my DB transactor is running,
+        without waiting for any preloading. See L{startup}.
+        """
+        return self.t.callWhenRunning(lambda: None)
+    
     def shutdown(self):
         return self.dt.deferToAll().addCallbacks(
             lambda _: self.t.shutdown(), oops)
@@ -212,37 +474,78 @@ class RecordKeeper(Base):
                 self.ipm.addIP(ip)
                 ipList.append(ip)
         return ipList
-    
-    def consumerFactory(self, fileName, msgID=None):
+
+    def sizes(self):
+        """
+        Returns a dict of the number of items held by my big in-memory
+        structures, my I{rejectedIPs} and the IP matcher of those
+        blocked (I{keeper.ipm}), along with those of my transactor.
+        See L{database.Transactor.sizes}.
+        """
+        result = {
+            'rejectedIPs': len(self.rejectedIPs),
+            'keeper.ipm': len(self.ipm)}
+        result.update(self.t.sizes())
+        return result
+
+    def consumerFactory(self, fileName, msgID=None, tally=False):
         """
         Constructs and returns a reference to a new L{ProcessConsumer}
         that obtains nasty IP addresses and new records from a process
-        parsing a particular logfile.
+        parsing a particular logfile, or one shard of it if I{tally}
+        is set.
         """
         return ProcessConsumer(
-            self, fileName, msgID=msgID, verbose=self.info, gui=self.gui)
+            self, fileName,
+            msgID=msgID, verbose=self.info, gui=self.gui, tally=tally,
+            stats=self.stats)
     
     def fileInfo(self, *args):
         """
         See L{database.Transactor.fileInfo}
         """
         return self.t.fileInfo(*args)
+
+    def fileSpan(self, *args):
+        """
+        See L{database.Transactor.fileSpan}
+        """
+        return self.t.fileSpan(*args)
+    
+    def getWatermarks(self):
+        """
+        See L{database.Transactor.getWatermarks}
+        """
+        return self.t.getWatermarks()
+
+    def setWatermark(self, source, dt):
+        """
+        See L{database.Transactor.setWatermark}
+        """
+        return self.t.setWatermark(source, dt)
         
-    def purgeIP(self, ip, block):
+    def purgeIP(self, ip, block, fileName=None):
         """
         Purges my records (and database, if any) of entries from the
         supplied IP address and appends the IP to a list to be
         returned when I'm done so that a master list of purged IP
         addresses can be provided. Any further adds from this IP are
         ignored.
+
+        The number of entries purged and the time it took are counted
+        in my L{Stats}, for the file I{fileName} if you supply one.
         
         @return: A C{Deferred} that fires when the database has been
           updated, or immediately if no database transaction is
           needed.
         
         """
-        def donePurging(N):
-            if N: self.msgProgress(self.purgeMsgID, N)
+        def donePurging(N, t0):
+            self.stats.bump('purges', fileName=fileName)
+            self.stats.bump('purgeSeconds', time.time()-t0, fileName=fileName)
+            if N:
+                self.stats.bump('purged', N, fileName=fileName)
+                self.msgProgress(self.purgeMsgID, N)
 
         if not hasattr(self, 'purgeMsgID'):
             self.purgeMsgID = self.msgHeading("Purging IP addresses")
@@ -258,7 +561,7 @@ class RecordKeeper(Base):
         # DB accordingly
         self.rejectedIPs[ip] = block
         d = self.t.purgeIP(ip, niceness=15)
-        d.addCallbacks(donePurging, oops)
+        d.addCallbacks(donePurging, oops, callbackArgs=(time.time(),))
         self.dt.put(d)
         return d
 
@@ -281,4 +584,21 @@ class RecordKeeper(Base):
         self.dt.put(d)
         return d
 
+    def addRecords(self, records):
+        """
+        Adds the supplied list of (dt, record) tuples to the database in
+        bulk, skipping any from rejected IP addresses. Used for
+        loading records from a L{spool}.
+
+        Returns a deferred that fires with the number of new entries
+        added to the database.
+        """
+        records = [x for x in records if x[1]['ip'] not in self.rejectedIPs]
+        if not records:
+            return defer.succeed(0)
+        d = self.t.setRecords(records)
+        d.addErrback(oops)
+        self.dt.put(d)
+        return d
+
 
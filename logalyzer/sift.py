@@ -30,14 +30,58 @@
 Filtering of HTTP logs as they are read.
 """
 
-import re, os.path, array
-
-import ipcalc
+import re, os.path, array, time
 
 import util
 
 
-class IPMatcher(object):
+class RuleAccounting(object):
+    """
+    I give a matcher the option of counting the hits and evaluations
+    of each of its rules, and the time spent evaluating it. Call
+    L{account} to turn that on. It's off by default because timing
+    each rule is a lot slower than just matching.
+    """
+    ruleStats = None
+
+    def account(self):
+        """
+        Starts keeping count of the hits, evaluations, and evaluation time
+        of each of my rules. See L{ruleCounts}.
+        """
+        self.ruleStats = {}
+
+    def tally(self, rule, hit, seconds=0.0):
+        """
+        Adds an evaluation of the specified I{rule} taking I{seconds} to
+        my counts, and a hit if I{hit} is set.
+        """
+        counts = self.ruleStats.get(rule, None)
+        if counts is None:
+            counts = self.ruleStats[rule] = [0, 0, 0.0]
+        if hit:
+            counts[0] += 1
+        counts[1] += 1
+        counts[2] += seconds
+    
+    def ruleCounts(self):
+        """
+        Returns a dict of 3-tuples with the number of hits, the number of
+        evaluations, and the evaluation time in seconds of each rule
+        evaluated since the last call, keyed by the rule. The dict is
+        empty if I'm not keeping count.
+
+        Lookups answered by a cache don't evaluate any rule, so they
+        aren't counted.
+        """
+        if self.ruleStats is None:
+            return {}
+        result = dict([(x, tuple(y)) for x, y in self.ruleStats.iteritems()])
+        self.ruleStats = {}
+        return result
+    
+
+class IPMatcher(RuleAccounting):
     """
     I efficiently match IP addresses. Simple and fast.
 
@@ -45,7 +89,7 @@ class IPMatcher(object):
     and add any further ones with L{addIP}.
 
     """
-    reDottedQuad = re.compile(r'[0-9]{,3}\.[0-9]{,3}\.[0-9]{,3}\.[0-9]{,3}')
+    reDottedQuad = re.compile(util.IP_PATTERN + r'$')
     
     def __init__(self, rules=[]):
         self.ipSet = set()
@@ -73,10 +117,15 @@ class IPMatcher(object):
         self.ipSet.discard(ip)
             
     def __call__(self, ip):
-        return ip in self.ipSet
+        if ip in self.ipSet:
+            if self.ruleStats is not None:
+                # Just a set lookup, so only the hits are worth counting
+                self.tally(ip, True)
+            return True
+        return False
         
 
-class MatcherBase(object):
+class MatcherBase(RuleAccounting):
     """
     Build your matcher on me
     """
@@ -117,6 +166,8 @@ class NetMatcher(MatcherBase):
     
     def startup(self, rules):
         self.networks = []
+        # The ipcalc classes, imported for the first network rule
+        self.Network = self.IP = None
         # Cache for offenders
         self.cm.new()
         # Cache for innocents
@@ -134,12 +185,16 @@ class NetMatcher(MatcherBase):
         match = self.reRule.match(rule)
         if match is None:
             return
-        thisNet = ipcalc.Network(match.group(0))
+        if self.Network is None:
+            # Only needed if there are network rules
+            import ipcalc
+            self.Network, self.IP = ipcalc.Network, ipcalc.IP
+        thisNet = self.Network(match.group(0))
         # Quick check
         thisLong = thisNet.network_long()
         if thisLong in self.netLongs:
             # Same long network address, so do more thorough check
-            for otherNet, null in self.networks:
+            for otherNet, null, null in self.networks:
                 if thisNet.check_collision(otherNet):
                     # Yep, redundant rule
                     break
@@ -147,13 +202,15 @@ class NetMatcher(MatcherBase):
                 # No collision, so actually NOT a redundant rule;
                 # add it. (Will this ever happen with properly
                 # defined rules?)
-                self.networks.append([thisNet, 0])
+                self.networks.append([thisNet, 0, rule])
         else:
             # New long network address, add both it and the network object
             self.netLongs.append(thisLong)
-            self.networks.append([thisNet, 0])
+            self.networks.append([thisNet, 0, rule])
     
     def __call__(self, ip):
+        if not self.networks:
+            return False
         # Likely to be several sequential hits from offenders and
         # innocents alike
         if self.cm.check(0, ip):
@@ -162,7 +219,9 @@ class NetMatcher(MatcherBase):
         if self.cm.check(1, ip):
             # Innocent was cached
             return False
-        ipObject = ipcalc.IP(ip)
+        ipObject = self.IP(ip)
+        if self.ruleStats is not None:
+            return self.accountedCall(ip, ipObject)
         # Not found (yet), go through the actual list of networks. If
         # a hit is found, the count for that network is increased and
         # the list is resorted by number of hits, descending. This
@@ -178,6 +237,27 @@ class NetMatcher(MatcherBase):
         self.cm.set(1, ip)
         return False
 
+    def accountedCall(self, ip, ipObject):
+        """
+        Does what a call to me does for an uncached IP address when I'm
+        keeping count, except that every network gets checked so its
+        counts don't depend on the ones ahead of it.
+        """
+        found = None
+        for netAndCount in self.networks:
+            t0 = time.time()
+            hit = netAndCount[0].has_key(ipObject)
+            self.tally(netAndCount[2], hit, time.time() - t0)
+            if hit and found is None:
+                found = netAndCount
+        if found is None:
+            self.cm.set(1, ip)
+            return False
+        self.cm.set(0, ip)
+        found[1] += 1
+        self.networks.sort(key=lambda x: x[1], reverse=True)
+        return True
+
 
 class ReMatcherBase(MatcherBase):
     """
@@ -186,7 +266,36 @@ class ReMatcherBase(MatcherBase):
     def startup(self, rules):
         # Cache for Offenders only
         self.cm.new()
+        self.rules = rules
         self.re = self.reFromRules(rules)
+
+    def account(self):
+        """
+        Starts keeping count, with each of my rules compiled separately
+        so it can be evaluated and timed by itself. A repeated rule is
+        only evaluated once.
+        """
+        MatcherBase.account(self)
+        self.ruleREs = []
+        seen = set()
+        for rule in self.rules:
+            if rule not in seen:
+                seen.add(rule)
+                self.ruleREs.append((rule, re.compile(rule)))
+
+    def search(self, string):
+        """
+        Returns C{True} if any of my rules match the supplied I{string},
+        evaluating every one of them separately and counting its hit
+        (if any) and the time it took.
+        """
+        found = False
+        for rule, reRule in self.ruleREs:
+            t0 = time.time()
+            hit = reRule.search(string) is not None
+            self.tally(rule, hit, time.time() - t0)
+            found = found or hit
+        return found
     
     def __call__(self, ip, string):
         # Likely to be several sequential hits from offenders
@@ -195,7 +304,10 @@ class ReMatcherBase(MatcherBase):
             return True
         # Sometimes offenders start with an innocent query, so no
         # cache for innocents
-        if self.re and self.re.search(string.strip()):
+        if self.ruleStats is not None:
+            found = self.search(string.strip())
+        else: found = self.re and self.re.search(string.strip())
+        if found:
             # Offender found
             self.cm.set(0, ip)
             return True
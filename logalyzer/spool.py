@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# logalyzer:
+# Parses your bloated HTTP access logs to extract the info you want
+# about hits from (hopefully) real people instead of just the endless
+# stream of hackers and bots that passes for web traffic
+# nowadays. Stores the info in a relational database where you can
+# access it using all the power of SQL.
+#
+# Copyright (C) 2015, 2017, 2018 by Edwin A. Suominen,
+# http://edsuom.com/logalyzer
+#
+# See edsuom.com for API documentation as well as information about
+# Ed's background and other projects, software and otherwise.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the
+# License. You may obtain a copy of the License at
+# 
+#   http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an "AS
+# IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+
+"""
+An append-only local spool between logfile parsing and the database.
+
+Parsing processes append the records they've accepted to compact
+binary segment files in a spool directory instead of sending each
+one to the main process and waiting on the database. A loader in the
+main process drains the segments into the database in bulk
+transactions. Parsing can then go as fast as the CPU cores allow, and
+a database hiccup doesn't stall it.
+
+A segment is a stream of C{marshal}-ed objects: the path of the
+logfile its records came from, followed by one tuple for each
+record. It is written as a I{.part} file and only renamed to a
+I{.seg} file once it's complete, so the loader never sees a partial
+segment.
+"""
+
+import os, os.path, time, marshal, itertools
+from datetime import datetime
+
+from twisted.internet import defer, task
+
+import asynqueue
+
+from util import oops, Base
+
+
+# The record values stored in a segment, after the datetime
+FIELDS = ('ip', 'http', 'was_rd', 'vhost', 'url', 'ref', 'ua')
+
+# For unique segment names within a process
+_serial = itertools.count()
+
+
+def encode(dt, record):
+    """
+    Returns a C{marshal}-able tuple for the supplied datetime and
+    record dict.
+    """
+    return (dt.year, dt.month, dt.day, dt.hour, dt.minute, dt.second) +\
+        tuple([record[x] for x in FIELDS])
+
+def decode(stuff):
+    """
+    Returns a (dt, record) tuple for a tuple from L{encode}.
+    """
+    return datetime(*stuff[:6]), dict(zip(FIELDS, stuff[6:]))
+
+
+class SegmentWriter(object):
+    """
+    I append records parsed from one logfile to segment files in a
+    spool directory, starting a new segment every I{N} records.
+    """
+    N = 5000
+    
+    def __init__(self, spoolDir, filePath):
+        self.spoolDir = spoolDir
+        self.filePath = filePath
+        self.fh = None
+        self.N_records = 0
+
+    def _path(self):
+        name = "{:d}-{:d}-{:06d}".format(
+            os.getpid(), int(time.time()), _serial.next())
+        return os.path.join(self.spoolDir, name)
+    
+    def write(self, dt, record):
+        """
+        Appends the record for the supplied datetime to my current
+        segment.
+        """
+        if self.fh is None:
+            self.partPath = self._path() + ".part"
+            self.fh = open(self.partPath, 'wb')
+            marshal.dump(self.filePath, self.fh)
+        marshal.dump(encode(dt, record), self.fh)
+        self.N_records += 1
+        if not self.N_records % self.N:
+            self.close()
+
+    def close(self):
+        """
+        Closes my current segment, if any, making it available to the
+        loader.
+        """
+        if self.fh is None:
+            return
+        self.fh.close()
+        self.fh = None
+        os.rename(self.partPath, self.partPath[:-5] + ".seg")
+
+
+class SpoolLoader(Base):
+    """
+    I drain segment files from a spool directory into the database,
+    via the bulk L{records.RecordKeeper.addRecords} method of the
+    supplied record keeper I{rk}.
+
+    I check for new segments every I{interval} seconds while running,
+    loading I{N_batch} records per transaction. Segments left over
+    from an interrupted run get loaded, too, but their records aren't
+    counted for this run's L{drain} of the same logfile.
+
+    The records loaded from each logfile are counted in the stats of
+    the record keeper as parsed (accepted by the worker), added, or
+    duplicates, the way L{records.ProcessConsumer} counts the records
+    written to it. They're counted for the name given for the
+    logfile's path in my I{fileNames}, or for the path itself.
+    """
+    interval = 1.0
+    N_batch = 500
+    
+    def __init__(self, spoolDir, rk):
+        self.spoolDir = spoolDir
+        if not os.path.isdir(spoolDir):
+            os.makedirs(spoolDir)
+        self.rk = rk
+        self.counts = {}
+        self.fileNames = {}
+        self.stale = set()
+        self.lock = asynqueue.DeferredLock()
+        self.lc = task.LoopingCall(self.poll)
+
+    def startup(self):
+        """
+        Removes any partial segments left by an interrupted run, notes
+        the complete ones it left, and starts checking for new
+        segments to load.
+        """
+        for fileName in os.listdir(self.spoolDir):
+            if fileName.endswith(".part"):
+                os.remove(os.path.join(self.spoolDir, fileName))
+        self.stale = set(self.segments())
+        self.lc.start(self.interval, now=False)
+
+    def shutdown(self):
+        """
+        Stops checking for segments, returning a C{Deferred} that fires
+        when any segment being loaded is done. Segments not yet loaded
+        stay in the spool for the next run.
+        """
+        if self.lc.running:
+            self.lc.stop()
+        return self.lock.acquireAndRelease()
+
+    def segments(self):
+        """
+        Returns a list of paths to the complete segments in my spool
+        directory, oldest first.
+        """
+        paths = [
+            os.path.join(self.spoolDir, x)
+            for x in os.listdir(self.spoolDir) if x.endswith(".seg")]
+        return sorted(paths, key=os.path.getmtime)
+
+    @defer.inlineCallbacks
+    def loadSegment(self, segPath):
+        """
+        Loads the records in the segment at I{segPath} into the database
+        and then deletes it.
+        """
+        isStale = segPath in self.stale
+        self.stale.discard(segPath)
+        with open(segPath, 'rb') as fh:
+            filePath = marshal.load(fh)
+            done = False
+            while not done:
+                records = []
+                while len(records) < self.N_batch:
+                    try:
+                        records.append(decode(marshal.load(fh)))
+                    except EOFError:
+                        done = True
+                        break
+                if records:
+                    N_added = yield self.rk.addRecords(records)
+                    if not isStale:
+                        self.count(filePath, len(records), N_added or 0)
+        os.remove(segPath)
+        
+    def count(self, filePath, N, N_added):
+        """
+        Counts I{N} records loaded from the logfile at I{filePath}, of
+        which I{N_added} were added to the database.
+        """
+        self.counts[filePath] = self.counts.get(filePath, 0) + N
+        fileName = self.fileNames.get(filePath, filePath)
+        stats = self.rk.stats
+        stats.bump('parsed', N, fileName=fileName)
+        stats.bump('added', N_added, fileName=fileName)
+        stats.bump('duplicates', N - N_added, fileName=fileName)
+        
+    @defer.inlineCallbacks
+    def load(self):
+        """
+        Loads all the segments currently in my spool directory.
+        """
+        yield self.lock.acquire()
+        try:
+            for segPath in self.segments():
+                yield self.loadSegment(segPath)
+        finally:
+            self.lock.release()
+
+    def poll(self):
+        if not self.lock.locked:
+            self.load().addErrback(oops)
+    
+    def drain(self, filePath):
+        """
+        Call this when all segments have been written for the logfile at
+        I{filePath}. Returns a C{Deferred} that fires with the number
+        of its records loaded from the spool when they've all been
+        loaded.
+        """
+        return self.load().addCallback(
+            lambda _: self.counts.pop(filePath, 0))
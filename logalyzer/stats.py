@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# logalyzer:
+# Parses your bloated HTTP access logs to extract the info you want
+# about hits from (hopefully) real people instead of just the endless
+# stream of hackers and bots that passes for web traffic
+# nowadays. Stores the info in a relational database where you can
+# access it using all the power of SQL.
+#
+# Copyright (C) 2015, 2017, 2018 by Edwin A. Suominen,
+# http://edsuom.com/logalyzer
+#
+# See edsuom.com for API documentation as well as information about
+# Ed's background and other projects, software and otherwise.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the
+# License. You may obtain a copy of the License at
+# 
+#   http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an "AS
+# IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+
+"""
+Counts of what's going on during a run.
+
+The parts of the pipeline bump counts in a shared L{Stats} object as
+things happen, which is nothing more than a dict update. Whatever
+displays or records the counts samples them on its own schedule, so
+the cost of showing progress doesn't grow with the number of records.
+Things that aren't counts, like the depth of a queue, are registered
+as gauges and only looked at when sampled. So are the sizes of the
+big structures that hold on to memory.
+"""
+
+
+class Stats(object):
+    """
+    I keep counts of what's going on during a run, overall and for
+    each logfile (or other source of lines) and parsing worker.
+
+    @ivar counts: A dict of the overall count for each name.
+    @ivar files: A dict of a dict of counts for each file name.
+    @ivar workers: A dict of a dict of counts for each worker, keyed
+      by its process ID.
+    @ivar gauges: A dict of a no-argument callable for each gauge
+      name.
+    @ivar rules: A dict of a dict of the hits, evaluations, and
+      evaluation seconds of each rule, as a 3-item list keyed by the
+      rule, for each matcher that keeps count of them.
+    @ivar sizers: A list of no-argument callables, each returning a
+      dict of the number of items held by some big structures in
+      this process, keyed by name.
+    @ivar workerSizes: A dict of the latest dict of item counts
+      reported by each worker, keyed by its process ID.
+    """
+    def __init__(self):
+        self.counts = {}
+        self.files = {}
+        self.workers = {}
+        self.gauges = {}
+        self.rules = {}
+        self.sizers = []
+        self.workerSizes = {}
+
+    def _bump(self, dct, key, name, N):
+        counts = dct.get(key, None)
+        if counts is None:
+            counts = dct[key] = {}
+        counts[name] = counts.get(name, 0) + N
+        
+    def bump(self, name, N=1, fileName=None, worker=None):
+        """
+        Adds I{N} to the overall count for the specified I{name} and, if
+        you supply a I{fileName} or I{worker} process ID, to the count
+        for that file or worker, too.
+        """
+        self.counts[name] = self.counts.get(name, 0) + N
+        if fileName is not None:
+            self._bump(self.files, fileName, name, N)
+        if worker is not None:
+            self._bump(self.workers, worker, name, N)
+
+    def tally(self, name, ruleCounts):
+        """
+        Adds the supplied dict of I{ruleCounts} from the matcher with the
+        specified I{name} to my counts for its rules. See
+        L{sift.RuleAccounting.ruleCounts}.
+        """
+        rules = self.rules.setdefault(name, {})
+        for rule, values in ruleCounts.iteritems():
+            counts = rules.get(rule, None)
+            if counts is None:
+                rules[rule] = list(values)
+                continue
+            for k, value in enumerate(values):
+                counts[k] += value
+    
+    def gauge(self, name, f):
+        """
+        Registers a gauge with the specified I{name}, whose value is
+        whatever the no-argument callable I{f} returns when a sample
+        is taken.
+        """
+        self.gauges[name] = f
+
+    def sizer(self, f):
+        """
+        Registers a no-argument callable I{f} that returns a dict of the
+        number of items held by each of one or more big structures,
+        keyed by name, when a sample is taken.
+        """
+        self.sizers.append(f)
+
+    def setSizes(self, worker, sizes):
+        """
+        Replaces the I{sizes} last reported by the I{worker} with the
+        specified process ID.
+        """
+        self.workerSizes[worker] = sizes
+        
+    def sizes(self):
+        """
+        Returns a dict of the current number of items held by each big
+        structure my sizers know about, and by those the workers have
+        reported, summed over the workers.
+        """
+        result = {}
+        for f in self.sizers:
+            result.update(f())
+        for sizes in self.workerSizes.itervalues():
+            for name, N in sizes.iteritems():
+                result[name] = result.get(name, 0) + N
+        return result
+    
+    def read(self, name):
+        """
+        Returns the current value of the gauge with the specified
+        I{name}, or C{None} if there's no such gauge.
+        """
+        f = self.gauges.get(name, None)
+        if f is not None:
+            return f()
+
+    def get(self, name, fileName=None):
+        """
+        Returns the overall count for the specified I{name}, or the count
+        for a particular file if you supply its I{fileName}.
+        """
+        counts = self.counts if fileName is None \
+                 else self.files.get(fileName, {})
+        return counts.get(name, 0)
+
+    def snapshot(self):
+        """
+        Returns a copy of my overall counts and those for each file and
+        worker, as a dict with I{counts}, I{files}, and I{workers}
+        entries, that won't change as more counts get bumped. The
+        current values of my gauges are in its I{gauges} entry.
+        """
+        def copy(dct):
+            return dict([(x, dict(y)) for x, y in dct.iteritems()])
+        
+        return {
+            'counts': dict(self.counts),
+            'files': copy(self.files),
+            'workers': copy(self.workers),
+            'gauges': dict([(x, self.read(x)) for x in self.gauges])}
@@ -33,7 +33,7 @@ import sys, os.path
 
 # Ensure that the package under test and its modules can all be imported by
 # name only
-packagePath = os.path.dirname(__file__)
+packagePath = os.path.dirname(os.path.abspath(__file__))
 for k in xrange(2):
     packagePath = os.path.dirname(packagePath)
     if packagePath not in sys.path:
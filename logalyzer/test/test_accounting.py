@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# logalyzer:
+# Parses your bloated HTTP access logs to extract the info you want
+# about hits to your webserver from (hopefully) real people instead of
+# just the endless hackers and bots. Stores the info in a relational
+# database where you can access it using all the power of SQL.
+#
+# Copyright (C) 2015, 2017, 2018 by Edwin A. Suominen,
+# http://edsuom.com/logalyzer
+#
+# See edsuom.com for API documentation as well as information about
+# Ed's background and other projects, software and otherwise.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the
+# License. You may obtain a copy of the License at
+# 
+#   http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an "AS
+# IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+
+
+
+import os, os.path, tempfile
+
+from testbase import TestCase
+from stats import Stats
+import accounting
+
+
+class TestAccounting(TestCase):
+    def setUp(self):
+        fd, self.filePath = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.filePath)
+        
+    def test_ruleRows(self):
+        rows = accounting.ruleRows(
+            ["cheap", "dear", "dead", "cheap"],
+            {"cheap": (5, 100, 0.01), "dear": (1, 100, 0.5)})
+        self.assertEqual(rows, [
+            [1, 100, 0.5, "dear"],
+            [5, 100, 0.01, "cheap"],
+            [0, 0, 0.0, "dead"]])
+    
+    def test_writeReport(self):
+        s = Stats()
+        s.bump('lines', 1000)
+        s.bump('rejects.ua', 40)
+        s.bump('rejects.weird', 2)
+        s.bump('lookups.uaMatcher', 50)
+        s.bump('hits.uaMatcher', 10)
+        s.tally('uaMatcher', {"bot": (30, 40, 0.004), "crawl": (0, 40, 0.002)})
+        s.tally('ipMatcher', {"1.2.3.4": (2, 2, 0.0)})
+        rules = {
+            'UAMatcher': ["bot", "crawl", "spider"], 'BotMatcher': [],
+            'IPMatcher': ["1.2.3.4"]}
+        filePath = accounting.writeReport(self.filePath, s, rules)
+        self.assertEqual(filePath, self.filePath)
+        with open(filePath) as fh:
+            text = fh.read()
+        self.assertIn("for 1000 lines read", text)
+        self.assertIn("UAMatcher: 3 rules, 2 never matched, "+\
+                      "50 lookups, 10 answered by cache", text)
+        self.assertNotIn("BotMatcher", text)
+        # The IP matcher has no cache, so no lookups to report
+        self.assertIn("IPMatcher: 1 rules, 0 never matched\n", text)
+        lines = text.split('\n')
+        for line in lines:
+            if "User-agent rule" in line:
+                self.assertEqual(line.split()[-1], "40")
+            if line.startswith("  weird"):
+                self.assertEqual(line.split()[-1], "2")
+        ruleLines = [x.split() for x in lines if x.endswith(
+            ("bot", "crawl", "spider"))]
+        self.assertEqual([x[-1] for x in ruleLines], ["bot", "crawl", "spider"])
+        self.assertEqual(ruleLines[0][:2], ["30", "40"])
+        self.assertEqual(ruleLines[0][3], "100.00")
+        self.assertEqual(ruleLines[2][3], "-")
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# logalyzer:
+# Parses your bloated HTTP access logs to extract the info you want
+# about hits to your webserver from (hopefully) real people instead of
+# just the endless hackers and bots. Stores the info in a relational
+# database where you can access it using all the power of SQL.
+#
+# Copyright (C) 2015, 2017, 2018 by Edwin A. Suominen,
+# http://edsuom.com/logalyzer
+#
+# See edsuom.com for API documentation as well as information about
+# Ed's background and other projects, software and otherwise.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the
+# License. You may obtain a copy of the License at
+# 
+#   http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an "AS
+# IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+
+
+
+import os, os.path, gzip, tempfile
+
+from testbase import TestCase, RULES_NET, RULES_UA, RULES_BOT
+import parse, sift
+
+from logalyzer.bench.synthetic import LogGenerator
+from logalyzer.bench import stages
+
+
+RULES = {
+    'NetMatcher': RULES_NET, 'UAMatcher': RULES_UA, 'BotMatcher': RULES_BOT}
+
+
+class TestLogGenerator(TestCase):
+    def test_lines(self):
+        p = parse.LineParser()
+        g = LogGenerator(N_ua=5, N_url=10, botShare=0.0)
+        lines = list(g.lines(200))
+        # Same lines every time for the same seed
+        self.assertEqual(lines, list(LogGenerator(
+            N_ua=5, N_url=10, botShare=0.0).lines(200)))
+        self.assertNotEqual(lines, list(LogGenerator(
+            N_ua=5, N_url=10, botShare=0.0, seed=1).lines(200)))
+        parsed = [p(x) for x in lines]
+        self.assertNotIn(None, parsed)
+        self.assertLessEqual(len(set([x[6] for x in parsed])), 5)
+        self.assertLessEqual(len(set([x[3] for x in parsed])), 10)
+        dts = [x[2] for x in parsed]
+        self.assertEqual(dts, sorted(dts))
+
+    def test_twisted(self):
+        p = parse.LineParser()
+        lines = list(LogGenerator(twisted=True).lines(10))
+        for line in lines:
+            self.assertTrue(line[:4].isdigit())
+            self.assertIsInstance(p(line), list)
+        self.assertEqual(
+            [p(x)[2] for x in lines],
+            [p(x)[2] for x in LogGenerator().lines(10)])
+        
+    def test_botShare(self):
+        lines = list(LogGenerator(botShare=0.5).lines(2000))
+        um = sift.UAMatcher(RULES_UA)
+        bm = sift.BotMatcher(RULES_BOT)
+        p = parse.LineParser()
+        N = 0
+        for stuff in [p(x) for x in lines]:
+            if um(stuff[1], stuff[6]) or bm(stuff[1], stuff[3]):
+                N += 1
+        self.assertGreater(N, 700)
+        self.assertLess(N, 1000)
+        
+    def test_write(self):
+        fd, filePath = tempfile.mkstemp(suffix=".gz")
+        os.close(fd)
+        N_bytes = LogGenerator().write(filePath, 100)
+        with gzip.open(filePath) as fh:
+            lines = fh.readlines()
+        os.remove(filePath)
+        self.assertEqual(len(lines), 100)
+        self.assertEqual(sum([len(x) for x in lines]), N_bytes)
+
+
+class TestBenchmark(TestCase):
+    def test_run_noDB(self):
+        b = stages.Benchmark(RULES, N=500)
+        d = b.run(db=False)
+        results = self.successResultOf(d)
+        for name in ('LineParser', 'makeRecord', 'UAMatcher', 'NetMatcher'):
+            self.assertEqual(results[name]['items'], 500)
+            self.assertGreater(results[name]['rate'], 0)
+        self.assertNotIn('setRecord', results)
+
+    def test_importing(self):
+        b = stages.Benchmark(RULES, N=10)
+        # Nothing heavy gets imported until a run needs it
+        self.assertEqual(b.importing(N=1), [])
+        self.assertGreater(b.results['import main']['rate'], 0)
+
+    def test_compare(self):
+        old = {'stages': {
+            'LineParser': {'rate': 1000.0}, 'makeRecord': {'rate': 500.0},
+            'gone': {'rate': 1.0}}}
+        new = {'stages': {
+            'LineParser': {'rate': 1100.0}, 'makeRecord': {'rate': 400.0}}}
+        lines = stages.compare(old, new)
+        self.assertEqual(len(lines), 3)
+        self.assertTrue(lines[1].startswith("LineParser"))
+        self.assertNotIn("SLOWER", lines[1])
+        self.assertTrue(lines[2].endswith("0.80  SLOWER"))
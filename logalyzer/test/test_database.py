@@ -26,6 +26,7 @@
 # governing permissions and limitations under the License.
 
 import os.path, random
+from datetime import timedelta
 from copy import copy
 
 from twisted.internet import defer
@@ -52,6 +53,20 @@ def makeEntry(id, http, was_rd, *ids):
     return result
 
 
+class TestValueHash(TestCase):
+    def test_valueHash(self):
+        hashes = set()
+        for value in ("/", "/foo", "/foo/", "x"*1000):
+            h = database.valueHash(value)
+            self.assertEqual(h, database.valueHash(value))
+            self.assertTrue(-2**63 <= h < 2**63)
+            hashes.add(h)
+        self.assertEqual(len(hashes), 4)
+        self.assertEqual(
+            database.valueHash(u"/caf\xe9"),
+            database.valueHash("/caf\xc3\xa9"))
+
+
 class TestDTK(TestCase):
     rows = [(dt1,), (dt1,), (dt2,)]
 
@@ -84,21 +99,60 @@ class TestDTK(TestCase):
         self.assertFalse(dtk.check(dt2))
         
 
+class TestIDCache(TestCase):
+    def test_eviction(self):
+        c = database.IDCache(3)
+        for k, value in enumerate("abcd"):
+            c[value] = k
+        self.assertEqual(len(c), 3)
+        self.assertNotIn("a", c)
+        # Using b makes c the least recently used
+        self.assertEqual(c["b"], 1)
+        c["e"] = 4
+        self.assertNotIn("c", c)
+        self.assertEqual(c.get("b"), 1)
+        self.assertEqual(c.get("c"), None)
+        self.assertEqual(c.get("c", 99), 99)
+        self.assertRaises(KeyError, c.__getitem__, "c")
+
+    def test_secondChance(self):
+        c = database.IDCache(3)
+        for k, value in enumerate("abc"):
+            c[value] = k
+        # Both a and b get a second chance, but c doesn't
+        self.assertEqual(c["a"], 0)
+        self.assertEqual(c.get("b"), 1)
+        c["d"] = 3
+        self.assertEqual(sorted(c.x.keys()), ["a", "b", "d"])
+        # They've used up their second chances
+        c["e"] = 4
+        self.assertEqual(sorted(c.x.keys()), ["b", "d", "e"])
+        self.assertEqual(len(c), 3)
+
+
 class TestTransactor(TestCase):
     verbose = False
     spew = False
+    compact = False
+    rollups = False
     
     def setUp(self):
         self.handler = TestHandler(self.isVerbose())
         logging.getLogger('asynqueue').addHandler(self.handler)
         self.t = database.Transactor(
-            DB_URL, verbose=self.isVerbose(), spew=self.spew)
+            DB_URL, verbose=self.isVerbose(), spew=self.spew,
+            compact=self.compact, rollups=self.rollups)
         return self.t.waitUntilRunning()
         
     @defer.inlineCallbacks
     def tearDown(self):
         if getattr(getattr(self, 't', None), 'running', False):
-            tableNames = ['entries', 'bad_ip', 'files'] + self.t.indexedValues
+            if self.t.compact:
+                yield self.t.sql("DROP VIEW entries")
+                del self.t.entries
+            tableNames = [
+                'entries', 'entries_c', 'bad_ip', 'files', 'watermarks',
+                'spans', 'rollup_hits', 'rollup_visitors'] + self.t.indexedValues
             for tableName in tableNames:
                 if hasattr(self.t, tableName):
                     yield self.t.sql("DROP TABLE {}".format(tableName))
@@ -210,6 +264,58 @@ class TestTransactor(TestCase):
                     ID = yield self.t.setNameValue(name, value)
                     self.assertEqual(ID, k+1)
         
+    @defer.inlineCallbacks
+    def test_setNameValue_long(self):
+        # Values that would've been the same if truncated to 255
+        # characters
+        longValues = ["/" + "x"*300 + str(k) for k in xrange(2)]
+        IDs = []
+        for value in longValues:
+            ID = yield self.t.setNameValue('url', value)
+            IDs.append(ID)
+        self.assertNotEqual(IDs[0], IDs[1])
+        for k, value in enumerate(longValues):
+            ID = yield self.t.setNameValue('url', value)
+            self.assertEqual(ID, IDs[k])
+            valueDict = yield self.t._getValuesFromIDs([1, ID])
+            self.assertEqual(valueDict['url'], value)
+        
+    @defer.inlineCallbacks
+    def test_setNameValue_collision(self):
+        # Values whose hashes all collide go in successive slots
+        self.patch(database, 'valueHash', lambda value: 2**63-1)
+        IDs = []
+        for value in ("/a", "/b", "/c"):
+            ID = yield self.t.setNameValue('url', value)
+            IDs.append(ID)
+        self.assertEqual(len(set(IDs)), 3)
+        for k, value in enumerate(("/a", "/b", "/c")):
+            ID = yield self.t.setNameValue('url', value)
+            self.assertEqual(ID, IDs[k])
+        rows = yield self.t.sql("SELECT hash FROM url ORDER BY id")
+        self.assertEqual([x[0] for x in rows], [2**63-1, -2**63, -2**63+1])
+
+    @defer.inlineCallbacks
+    def test_setNameValue_integrityError(self):
+        # Another writer process inserts the value between the lookup
+        # and the insert
+        def lookupValues(name, values, **kw):
+            result = lookup(name, values)
+            if not inserted:
+                inserted.append(None)
+                self.t.connection.execute(
+                    self.t.url.insert(), hash=database.valueHash("/foo"),
+                    value="/foo")
+            return result
+
+        inserted = []
+        lookup = self.t._lookupValues
+        self.t._lookupValues = lookupValues
+        ID = yield self.t.setNameValue('url', "/foo")
+        self.assertEqual(ID, 1)
+        rows = yield self.t.sql("SELECT id FROM url")
+        self.assertEqual(len(rows), 1)
+    
     @defer.inlineCallbacks
     def test_setNameValue_more(self):
         def nowRun(null, name, value):
@@ -273,6 +379,27 @@ class TestTransactor(TestCase):
             for k, record in enumerate(records):
                 checkValues(record, RECORDS[dt1][k])
                 
+    @defer.inlineCallbacks
+    def test_getRecordsBetween(self):
+        def gotChunk(chunk):
+            chunks.append(chunk)
+        
+        yield self.writeAllRecords()
+        for N_chunk, sizes in ((1, [1, 1, 1]), (2, [2, 1]), (10, [3])):
+            chunks = []
+            N = yield self.t.getRecordsBetween(
+                dt1, dt3, gotChunk, N_chunk=N_chunk)
+            self.assertEqual(N, 3)
+            self.assertEqual([len(x) for x in chunks], sizes)
+            records = [x for chunk in chunks for x in chunk]
+            self.assertEqual(
+                records, [(dt1, RECORDS[dt1][0]), (dt1, RECORDS[dt1][1]),
+                          (dt2, RECORDS[dt2][0])])
+        chunks = []
+        N = yield self.t.getRecordsBetween(dt2, dt3, gotChunk)
+        self.assertEqual(N, 1)
+        self.assertEqual(chunks, [[(dt2, RECORDS[dt2][0])]])
+        
     @defer.inlineCallbacks
     def test_setRecord(self):
         # Since we're not doing preload, give the transactor an empty
@@ -296,6 +423,89 @@ class TestTransactor(TestCase):
         self.assertEqual(len(records), 2)
         self.assertIn(firstRecord, records)
         self.assertIn(modRecord, records)
+
+    @defer.inlineCallbacks
+    def test_setRecord_valueIDs(self):
+        def valueIDs(values, **kw):
+            calls.append(values)
+            return f(values, **kw)
+
+        calls = []
+        f = self.t.valueIDs
+        self.t.valueIDs = valueIDs
+        self.t.ipm = database.IPMatcher()
+        firstRecord = RECORDS[dt1][0]
+        yield self.t.setRecord(dt1, firstRecord)
+        # All the new values were looked up together
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(
+            sorted(calls[0].keys()), sorted(self.t.indexedValues))
+        modRecord = firstRecord.copy()
+        modRecord['ua'] = "Foo Browser/1.2"
+        yield self.t.setRecord(dt1, modRecord)
+        # Only the new one got looked up
+        self.assertEqual(calls[1], {'ua': ["Foo Browser/1.2"]})
+        yield self.t.setRecord(dt2, modRecord)
+        self.assertEqual(len(calls), 2)
+        records = yield self.t.getRecords(dt2)
+        self.assertEqual(records, [modRecord])
+    
+    @defer.inlineCallbacks
+    def test_setRecords(self):
+        self.t.ipm = database.IPMatcher()
+        recordList = []
+        for dt, theseRecords in RECORDS.iteritems():
+            for thisRecord in theseRecords:
+                recordList.append((dt, thisRecord))
+        N = yield self.t.setRecords(recordList)
+        self.assertEqual(N, 3)
+        # Setting them again, along with a new one, only adds the new one
+        modRecord = RECORDS[dt1][0].copy()
+        modRecord['ua'] = "Foo Browser/1.2"
+        recordList.append((dt1, modRecord))
+        N = yield self.t.setRecords(recordList)
+        self.assertEqual(N, 1)
+        N = yield self.t.hitsForIP(ip1)
+        self.assertEqual(N, 3)
+
+    @defer.inlineCallbacks
+    def test_setRecords_valueIDs(self):
+        self.t.ipm = database.IPMatcher()
+        ID = yield self.t.setNameValue('url', "/bar")
+        # Too small a cache for all the values of one batch
+        for name in self.t.indexedValues:
+            self.t.idTable[name] = database.IDCache(2)
+        recordList = []
+        for k, url in enumerate(("/foo", "/bar", "/foo", "/baz")):
+            record = RECORDS[dt1][0].copy()
+            record['url'] = url
+            recordList.append((dt1+timedelta(seconds=k), record))
+        N = yield self.t.setRecords(recordList)
+        self.assertEqual(N, 4)
+        self.assertEqual(len(self.t.idTable['url']), 2)
+        for k, (dt, record) in enumerate(recordList):
+            records = yield self.t.getRecords(dt)
+            self.assertEqual(records, [record])
+        ID_bar = yield self.t.setNameValue('url', "/bar")
+        self.assertEqual(ID_bar, ID)
+        rows = yield self.t.sql("SELECT value FROM url ORDER BY id")
+        self.assertEqual([x[0] for x in rows], ["/bar", "/foo", "/baz"])
+
+    @defer.inlineCallbacks
+    def test_preloadIDs(self):
+        self.t.ipm = database.IPMatcher()
+        yield self.t.setRecords(
+            [(dt1, x) for x in RECORDS[dt1]] + [(dt2, RECORDS[dt2][0])])
+        for name in self.t.indexedValues:
+            self.t.idTable[name] = database.IDCache(10)
+        N = yield self.t._preloadIDs(1)
+        self.assertEqual(N, 4)
+        for name in self.t.indexedValues:
+            self.assertIn(RECORDS[dt2][0][name], self.t.idTable[name])
+        self.assertNotIn("foo.com", self.t.idTable['vhost'])
+        N = yield self.t._preloadIDs(10)
+        self.assertEqual(N, 6)
+        self.assertIn("foo.com", self.t.idTable['vhost'])
     
     @defer.inlineCallbacks
     def test_purgeIP(self):
@@ -334,7 +544,215 @@ class TestTransactor(TestCase):
         yield self.t.fileInfo(file2, dt2, 5678, 2000)
         x = yield self.t.fileInfo(file2)
         self.assertEqual(x, (dt2, 5678, 2000))
-        
-        
-        
-        
+
+    @defer.inlineCallbacks
+    def test_watermarks(self):
+        x = yield self.t.getWatermarks()
+        self.assertEqual(x, {})
+        yield self.t.setWatermark("access.log", dt2)
+        yield self.t.setWatermark("other.log", dt1)
+        # Watermarks only go up
+        yield self.t.setWatermark("access.log", dt1)
+        x = yield self.t.getWatermarks()
+        self.assertEqual(x, {"access.log": dt2, "other.log": dt1})
+        yield self.t.setWatermark("other.log", dt3)
+        x = yield self.t.getWatermarks()
+        self.assertEqual(x["other.log"], dt3)
+
+    @defer.inlineCallbacks
+    def test_fileSpan(self):
+        x = yield self.t.fileSpan("access.log.1")
+        self.assertNone(x)
+        yield self.t.fileSpan("access.log.1", dt3, 1234, dt1, dt2)
+        x = yield self.t.fileSpan("access.log.1")
+        self.assertEqual(list(x), [dt3, 1234, dt1, dt2])
+        yield self.t.fileSpan("access.log.1", dt3, 2345, dt1, dt3)
+        x = yield self.t.fileSpan("access.log.1")
+        self.assertEqual(list(x), [dt3, 2345, dt1, dt3])
+
+
+class TestTransactorCompact(TestTransactor):
+    compact = True
+
+    def test_compact(self):
+        self.assertTrue(self.t.compact)
+        self.assertEqual(self.t.entries.name, 'entries_c')
+
+    @defer.inlineCallbacks
+    def test_view(self):
+        yield self.writeAllRecords()
+        rows = yield self.t.sql("SELECT dt, ip, http FROM entries")
+        self.assertEqual(
+            sorted([list(x) for x in rows]),
+            [[x.strftime("%Y-%m-%d %H:%M:%S.%f"), ip, http]
+             for x, ip, http in ((dt1, ip1, 200), (dt1, ip1, 200), (dt2, ip2, 404))])
+        rows = yield self.t.sql("SELECT dt, ip FROM entries_c WHERE http = 404")
+        self.assertEqual(
+            list(rows[0]), [database.dtToEpoch(dt2), database.ipToInt(ip2)])
+
+
+class TestTransactorRollups(TestTransactor):
+    rollups = True
+
+    def _rollups(self):
+        def gotRows(hits, visitors):
+            return (
+                sorted([tuple(x) for x in hits]),
+                sorted([tuple(x) for x in visitors]))
+        return self.t.sql(
+            "SELECT day, id_vhost, id_url, http, hits FROM rollup_hits"
+        ).addCallback(
+            lambda hits: self.t.sql(
+                "SELECT day, id_vhost, ip, hits FROM rollup_visitors"
+            ).addCallback(lambda visitors: gotRows(hits, visitors)))
+
+    @defer.inlineCallbacks
+    def test_rollups(self):
+        self.t.ipm = database.IPMatcher()
+        recordList = []
+        for dt, theseRecords in RECORDS.iteritems():
+            for thisRecord in theseRecords:
+                recordList.append((dt, thisRecord))
+        # Bulk and one by one, with duplicates that don't count
+        yield self.t.setRecords(recordList[:2])
+        for dt, thisRecord in recordList:
+            yield self.t.setRecord(dt, thisRecord)
+        hits, visitors = yield self._rollups()
+        vhostIDs = {}
+        for dt, thisRecord in recordList:
+            vhostIDs[thisRecord['vhost']] = self.t.idTable['vhost'][
+                thisRecord['vhost']]
+        d1, d2 = [str(x.date()) for x in (dt1, dt2)]
+        self.assertEqual(len(hits), 3)
+        self.assertEqual(
+            visitors, [(d1, vhostIDs['foo.com'], ip1, 2),
+                       (d2, vhostIDs['bar.com'], ip2, 1)])
+        self.assertEqual(sum([x[-1] for x in hits]), 3)
+        yield self.t.purgeIP(ip1)
+        hits, visitors = yield self._rollups()
+        self.assertEqual(
+            hits, [(d2, vhostIDs['bar.com'], self.t.idTable['url']["/"],
+                    404, 1)])
+        self.assertEqual(visitors, [(d2, vhostIDs['bar.com'], ip2, 1)])
+
+    @defer.inlineCallbacks
+    def test_backfill(self):
+        def emptyAndBackfill():
+            with self.t.connection.begin():
+                for table in (self.t.rollup_hits, self.t.rollup_visitors):
+                    self.t.connection.execute(table.delete())
+            self.t._backfillRollups()
+
+        yield self.writeAllRecords()
+        yield self.t.q.deferToThread(emptyAndBackfill)
+        hits, visitors = yield self._rollups()
+        self.assertEqual(sum([x[-1] for x in hits]), 3)
+        self.assertEqual(sum([x[-1] for x in visitors]), 3)
+
+
+class TestConversions(TestCase):
+    def test_ip(self):
+        for ip, N in (("0.0.0.1", 1), ("1.0.0.0", 2**24),
+                      ("255.255.255.255", 2**32-1), (ip1, None)):
+            x = database.ipToInt(ip)
+            if N is not None:
+                self.assertEqual(x, N)
+            self.assertEqual(database.intToIP(x), ip)
+
+    def test_dt(self):
+        for dt in (dt1, dt2, dt3):
+            self.assertEqual(database.epochToDT(database.dtToEpoch(dt)), dt)
+        self.assertEqual(database.dtToEpoch(database.datetime(1970, 1, 2)), 86400)
+
+
+class TestHashMigration(TestCase):
+    verbose = False
+
+    def setUp(self):
+        filePath, = tempFiles(os.path.abspath("migration.db"))
+        self.url = "sqlite:///{}".format(filePath)
+        # A database from before value tables had a hash column
+        engine = database.SA.create_engine(self.url)
+        engine.execute(
+            "CREATE TABLE url (id INTEGER PRIMARY KEY, value VARCHAR(255))")
+        engine.execute(
+            "CREATE UNIQUE INDEX unique_value ON url (value)")
+        for value in ("/", "/foo"):
+            engine.execute("INSERT INTO url (value) VALUES (?)", value)
+        engine.dispose()
+
+    def tearDown(self):
+        return self.t.shutdown()
+    
+    @defer.inlineCallbacks
+    def test_addHashColumn(self):
+        self.t = database.Transactor(self.url)
+        yield self.t.waitUntilRunning()
+        for k, value in enumerate(("/", "/foo")):
+            ID = yield self.t.setNameValue('url', value)
+            self.assertEqual(ID, k+1)
+        ID = yield self.t.setNameValue('url', "/bar")
+        self.assertEqual(ID, 3)
+        rows = yield self.t.sql("SELECT hash, value FROM url")
+        for h, value in rows:
+            self.assertEqual(h, database.valueHash(value))
+
+
+class TestUniqueHashMigration(TestCase):
+    verbose = False
+
+    def setUp(self):
+        filePath, = tempFiles(os.path.abspath("unique.db"))
+        deleteIfExists(filePath)
+        self.url = "sqlite:///{}".format(filePath)
+        h = database.valueHash("/")
+        # A database from when the hash index wasn't unique, with "/"
+        # stored twice and a different value in the same hash slot
+        engine = database.SA.create_engine(self.url)
+        engine.execute(
+            "CREATE TABLE url (id INTEGER PRIMARY KEY, "+\
+            "hash BIGINT, value TEXT)")
+        engine.execute("CREATE INDEX index_url_hash ON url (hash)")
+        for value, thisHash in (
+                ("/", h), ("/", h), ("/foo", database.valueHash("/foo")),
+                ("/bar", h)):
+            engine.execute(
+                "INSERT INTO url (hash, value) VALUES (?, ?)",
+                thisHash, value)
+        meta = database.SA.MetaData(engine)
+        entries = database.SA.Table(
+            'entries', meta, *database.entriesColumns())
+        entries.create()
+        # The second entry duplicates the first one once its url is
+        # merged, and the third just uses the other ID for it
+        for dt, id_url in ((dt1, 1), (dt1, 2), (dt2, 2)):
+            engine.execute(
+                entries.insert(), dt=dt, ip=ip1, http=200, was_rd=False,
+                id_vhost=1, id_url=id_url, id_ref=1, id_ua=1)
+        engine.dispose()
+
+    def tearDown(self):
+        return self.t.shutdown()
+
+    @defer.inlineCallbacks
+    def test_uniqueHash(self):
+        self.t = database.Transactor(self.url)
+        yield self.t.waitUntilRunning()
+        rows = yield self.t.sql("SELECT id, hash FROM url ORDER BY id")
+        h = database.valueHash("/")
+        self.assertEqual(
+            [tuple(x) for x in rows],
+            [(1, h), (3, database.valueHash("/foo")),
+             (4, database.nextHash(h))])
+        rows = yield self.t.sql("SELECT id, id_url FROM entries ORDER BY id")
+        self.assertEqual([tuple(x) for x in rows], [(1, 1), (3, 1)])
+        for value, expected in (("/", 1), ("/foo", 3)):
+            ID = yield self.t.setNameValue('url', value)
+            self.assertEqual(ID, expected)
+        ID = yield self.t.setNameValue('url', "/baz")
+        self.assertEqual(ID, 5)
+        indexes = yield self.t.q.deferToThread(
+            lambda: database.SA.inspect(self.t.q.engine).get_indexes('url'))
+        self.assertEqual(
+            [(x['name'], bool(x['unique'])) for x in indexes],
+            [('unique_url_hash', True)])
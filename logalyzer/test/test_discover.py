@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# logalyzer:
+# Parses your bloated HTTP access logs to extract the info you want
+# about hits from (hopefully) real people instead of just the endless
+# stream of hackers and bots that passes for web traffic
+# nowadays. Stores the info in a relational database where you can
+# access it using all the power of SQL.
+#
+# Copyright (C) 2015, 2017, 2018 by Edwin A. Suominen,
+# http://edsuom.com/logalyzer
+#
+# See edsuom.com for API documentation as well as information about
+# Ed's background and other projects, software and otherwise.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the
+# License. You may obtain a copy of the License at
+# 
+#   http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an "AS
+# IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+
+"""
+Unit tests for logalyzer.discover
+"""
+
+import os, os.path, shutil, gzip, tempfile
+
+from testbase import TestCase
+from discover import LogFile, Discovery
+
+
+class TestDiscovery(TestCase):
+    def setUp(self):
+        self.dirPath = tempfile.mkdtemp()
+        for relPath, N in (
+                ("h1/access.log", 100),
+                ("h1/access.log.1", 300),
+                ("h1/error.log", 50),
+                ("h2/access.log", 200),
+                ("h2/old/access.log.2.gz", 40),
+                ("h2/old/deep/access.log.3", 10)):
+            self.write(relPath, N)
+
+    def tearDown(self):
+        shutil.rmtree(self.dirPath)
+
+    def path(self, *args):
+        return os.path.join(self.dirPath, *args)
+        
+    def write(self, relPath, N):
+        filePath = self.path(*relPath.split("/"))
+        if not os.path.isdir(os.path.dirname(filePath)):
+            os.makedirs(os.path.dirname(filePath))
+        fh = gzip.open(filePath, 'wb') \
+             if filePath.endswith('.gz') else open(filePath, 'w')
+        fh.write("x" * N)
+        fh.close()
+
+    def names(self, *specs, **kw):
+        return [x.name for x in Discovery(**kw)(
+            [self.path(*x.split("/")) for x in specs])]
+        
+    def test_oneDir(self):
+        # Just file names, with the biggest one first
+        self.assertEqual(
+            self.names("h1"), ["access.log.1", "access.log"])
+
+    def test_dirs(self):
+        self.assertEqual(
+            self.names("h1", "h2/old/deep"),
+            ["access.log.1", "access.log", "access.log.3"])
+        # Names don't depend on what other specs there are
+        self.assertEqual(
+            self.names("h1"), self.names("h1", "h2/old/deep")[:2])
+        # Different logfiles can't have the same name
+        self.assertRaises(ValueError, self.names, "h1", "h2")
+        self.assertEqual(
+            self.names("h*"),
+            ["h1/access.log.1", "h2/access.log", "h1/access.log"])
+
+    def test_recursive(self):
+        names = self.names("", recursive=True)
+        self.assertEqual(len(names), 5)
+        self.assertEqual(names[-1], "h2/old/deep/access.log.3")
+        self.assertNotIn("h1/error.log", names)
+        names = self.names("", recursive=True, exclude=["deep", "*.1"])
+        self.assertEqual(
+            sorted(names),
+            ["h1/access.log", "h2/access.log", "h2/old/access.log.2.gz"])
+        names = self.names("", recursive=True, exclude=["h2/old"])
+        self.assertEqual(
+            sorted(names),
+            ["h1/access.log", "h1/access.log.1", "h2/access.log"])
+        
+    def test_include(self):
+        self.assertEqual(
+            self.names("h1", include=["*.log"]),
+            ["access.log", "error.log"])
+
+    def test_glob(self):
+        self.assertEqual(
+            self.names("h*/access.log"), ["h2/access.log", "h1/access.log"])
+        # A file matched by a glob pattern is taken as it is
+        self.assertEqual(self.names("h*/error.*"), ["h1/error.log"])
+        self.assertEqual(
+            self.names("h2/*/deep/*"), ["old/deep/access.log.3"])
+        self.assertEqual(self.names("nothing*"), [])
+
+    def test_file(self):
+        logFiles = Discovery()(
+            [self.path("h1", "access.log"), self.path("h2", "old")])
+        self.assertEqual(
+            [x.name for x in logFiles], ["access.log.2.gz", "access.log"])
+        logFile = logFiles[1]
+        self.assertIsInstance(logFile, LogFile)
+        self.assertEqual(logFile.path, self.path("h1", "access.log"))
+        self.assertEqual(logFile.stat.st_size, 100)
+
+    def test_root(self):
+        for spec, root in (
+                ("/logs/*/access.log", "/logs"),
+                ("/logs/www[12]/", "/logs"),
+                ("logs/www1/*", "logs/www1"),
+                ("/*", "/"),
+                ("*.log", ".")):
+            self.assertEqual(Discovery.root(spec), root)
+        
+    def test_missing(self):
+        self.assertRaises(ValueError, Discovery(), [self.path("bogus")])
+
+    def test_work(self):
+        logFile = Discovery()([self.path("h2", "old", "access.log.2.gz")])[0]
+        self.assertEqual(
+            logFile.work, LogFile.gzipRatio * logFile.stat.st_size)
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# logalyzer:
+# Parses your bloated HTTP access logs to extract the info you want
+# about hits to your webserver from (hopefully) real people instead of
+# just the endless hackers and bots. Stores the info in a relational
+# database where you can access it using all the power of SQL.
+#
+# Copyright (C) 2015, 2017, 2018 by Edwin A. Suominen,
+# http://edsuom.com/logalyzer
+#
+# See edsuom.com for API documentation as well as information about
+# Ed's background and other projects, software and otherwise.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the
+# License. You may obtain a copy of the License at
+# 
+#   http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an "AS
+# IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+
+
+import os, os.path, shutil, tempfile
+
+from testbase import TestCase
+from follow import Tail
+
+
+class TestTail(TestCase):
+    def setUp(self):
+        self.dirPath = tempfile.mkdtemp()
+        self.filePath = os.path.join(self.dirPath, "access.log")
+        self.write("# foo.com\n", 'w')
+        self.t = Tail(self.filePath)
+
+    def tearDown(self):
+        shutil.rmtree(self.dirPath)
+
+    def write(self, text, mode='a', filePath=None):
+        with open(filePath or self.filePath, mode) as fh:
+            fh.write(text)
+
+    def test_check_appended(self):
+        self.assertEqual(self.t.check(), [])
+        self.write("line 1\nline 2\n")
+        self.assertEqual(self.t.check(), [(self.filePath, 10, 24)])
+        self.assertEqual(self.t.check(), [])
+
+    def test_check_partialLine(self):
+        self.write("line 1\nline")
+        self.assertEqual(self.t.check(), [(self.filePath, 10, 17)])
+        self.assertEqual(self.t.check(), [])
+        self.write(" 2\n")
+        self.assertEqual(self.t.check(), [(self.filePath, 17, 24)])
+
+    def test_check_renamed(self):
+        self.write("line 1\n")
+        self.assertEqual(len(self.t.check()), 1)
+        self.write("line 2\n")
+        oldPath = self.filePath + ".1"
+        os.rename(self.filePath, oldPath)
+        # The rest of the old file is found before the new one appears
+        self.assertEqual(self.t.check(), [(oldPath, 17, 24)])
+        self.assertEqual(self.t.check(), [])
+        self.write("line 3\n", 'w')
+        self.assertEqual(self.t.check(), [(self.filePath, 0, 7)])
+
+    def test_check_renamedAndReplaced(self):
+        oldPath = self.filePath + ".1"
+        self.write("line 1\n")
+        os.rename(self.filePath, oldPath)
+        self.write("line 2\n", 'w')
+        self.assertEqual(
+            self.t.check(), [(oldPath, 10, 17), (self.filePath, 0, 7)])
+
+    def test_check_truncated(self):
+        self.write("line 1\n")
+        self.assertEqual(len(self.t.check()), 1)
+        self.write("line 2\n", 'w')
+        self.assertEqual(self.t.check(), [(self.filePath, 0, 7)])
+
+    def test_check_offset(self):
+        self.write("line 1\nline 2\n")
+        t = Tail(self.filePath, offset=24)
+        self.assertEqual(t.check(), [])
+        self.write("line 3\n")
+        self.assertEqual(t.check(), [(self.filePath, 24, 31)])
+
+    def test_lastLineEnd(self):
+        self.write("line 1\nline 2\nline")
+        for end, expected in ((28, 24), (24, 24), (23, 17), (10, 10), (9, 0)):
+            self.assertEqual(
+                Tail.lastLineEnd(self.filePath, end, N=4), expected)
@@ -35,6 +35,7 @@ from twisted.internet import defer, reactor
 import testbase as tb
 
 import gui
+from stats import Stats
 
 
 LINES = """
@@ -272,6 +273,13 @@ class TestFilesAPI(tb.TestCase):
             row.status.get_text()[0],
             "Some message with an int 50!")
 
+    def test_progress(self):
+        fileName = "foo.txt"
+        self.f.progress(fileName, "{:d}/{:d}", 5, 10)
+        row = self.f.contents[0][0]
+        self.assertEqual(row.status.get_text()[0], "5/10")
+        self.assertEqual(row.p.get_text()[0], "/")
+        
     def test_cellWidth(self):
         self.f.leftColWidth = 10
         width, nCols = self.f._cellWidth(100)
@@ -284,6 +292,95 @@ class TestFilesAPI(tb.TestCase):
         self.assertEqual(nCols, 3)
         self.assertGreater(width, 45)
 
+
+
+class TestMessagesAPI(tb.TestCase):
+    def test_maxBoxes(self):
+        m = gui.Messages()
+        m.maxBoxes = 5
+        for k in xrange(1, 11):
+            m.heading("Heading #{:d}".format(k), k)
+            m.msg("A message", k)
+        self.assertEqual(m.boxes, range(6, 11))
+        self.assertEqual(len(m.body), 5)
+        # Messages for dropped headings are ignored
+        m.msg("Too late", 3)
+        m.progress(3, 1)
+        self.assertRaises(IndexError, m.msg, "Never was", 11)
+
+    def test_maxLines(self):
+        mb = gui.MessageBox("Heading")
+        mb.maxLines = 3
+        mb.progress(1)
+        for k in xrange(10):
+            mb.add("Line #{:d}".format(k))
+        self.assertEqual(mb.height, 4)
+        self.assertIs(mb.body[1], mb.pcWidget)
+        self.assertEqual(
+            [x.get_text()[0] for x in mb.body[2:]], ["Line #8", "Line #9"])
+
+
+class TestGUISample(tb.TestCase):
+    def setUp(self):
+        self.display = gui.GUI(None)
+        self.display.f = gui.Files(FILENAMES[1:], 100)
+        self.display.stats = Stats()
+        self.display.sampled = {}
+
+    def status(self, k):
+        return self.display.f.contents[k][0].status.get_text()[0]
+        
+    def test_sample(self):
+        stats = self.display.stats
+        stats.bump('parsed', 3, fileName="foo.txt")
+        stats.bump('added', 2, fileName="foo.txt")
+        stats.bump('parsed', fileName="some-source")
+        self.display.sample()
+        self.assertEqual(self.status(0), "2/3")
+        self.display.fileStatus("foo.txt", "Done")
+        self.display.sample()
+        self.assertEqual(self.status(0), "Done")
+        stats.bump('parsed', fileName="foo.txt")
+        self.display.sample()
+        self.assertEqual(self.status(0), "2/4")
+        # Not in the list of files
+        self.display.fileStatus("some-source", "Done")
+
+
+class TestDashboard(tb.TestCase):
+    def setUp(self):
+        self.d = gui.Dashboard()
+        self.stats = Stats()
+        self.depth = [0]
+        self.stats.gauge('inFlight', lambda: self.depth[0])
+        self.stats.gauge('rss', lambda: 300*2**20)
+
+    def text(self):
+        return self.d.get_text()[0].split("\n")
+        
+    def test_refresh(self):
+        self.assertFalse(self.d.refresh(self.stats, 100.0))
+        self.stats.bump('lines', 3000, worker=1234)
+        self.stats.bump('lines', 1000, worker=1235)
+        self.stats.bump('added', 1500)
+        self.stats.bump('purged', 20)
+        self.stats.bump('hits.netMatcher', 90)
+        self.stats.bump('lookups.netMatcher', 120)
+        self.stats.bump('lookups.uaMatcher', 0)
+        self.depth[0] = 412
+        # Too soon
+        self.assertFalse(self.d.refresh(self.stats, 100.5))
+        self.assertTrue(self.d.refresh(self.stats, 102.0))
+        self.assertEqual(self.text(), [
+            "Lines/s: 2000 (1500, 500)  Records/s: 750  Purges/s: 10",
+            "DB queue: 412  Pauses: 0  Cache hits: net 75%  RSS: 300 MB"])
+        # Rates are since the last refresh
+        self.stats.bump('lines', 1000, worker=1235)
+        self.assertTrue(self.d.refresh(self.stats, 103.0))
+        self.assertEqual(
+            self.text()[0],
+            "Lines/s: 1000 (0, 1000)  Records/s: 0  Purges/s: 0")
+        
             
 class TestFiles(TestCase):
     useFiller = True
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# logalyzer:
+# Parses your bloated HTTP access logs to extract the info you want
+# about hits to your webserver from (hopefully) real people instead of
+# just the endless hackers and bots. Stores the info in a relational
+# database where you can access it using all the power of SQL.
+#
+# Copyright (C) 2015, 2017, 2018 by Edwin A. Suominen,
+# http://edsuom.com/logalyzer
+#
+# See edsuom.com for API documentation as well as information about
+# Ed's background and other projects, software and otherwise.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the
+# License. You may obtain a copy of the License at
+# 
+#   http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an "AS
+# IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+
+
+from testbase import TestCase
+from hll import HyperLogLog
+
+
+def ips(first, N):
+    return ["10.{:d}.{:d}.{:d}".format(k >> 16, (k >> 8) & 255, k & 255)
+            for k in xrange(first, first+N)]
+
+
+class TestHyperLogLog(TestCase):
+    def test_empty(self):
+        hll = HyperLogLog()
+        self.assertEqual(len(hll), 0)
+        self.assertEqual(len(HyperLogLog.fromBlob(hll.toBlob())), 0)
+
+    def test_add(self):
+        hll = HyperLogLog()
+        self.assertTrue(hll.add("1.2.3.4"))
+        self.assertFalse(hll.add("1.2.3.4"))
+        self.assertFalse(hll.update(["1.2.3.4"]*10))
+        self.assertEqual(len(hll), 1)
+
+    def test_accuracy(self):
+        for N in (10, 100, 1000, 20000):
+            hll = HyperLogLog()
+            hll.update(ips(0, N))
+            # Twice the expected error of a 4096-register sketch
+            self.assertLess(abs(hll.count() - N), max([1, 0.033*N]))
+
+    def test_blob(self):
+        hll = HyperLogLog()
+        hll.update(ips(0, 100))
+        blob = hll.toBlob()
+        self.assertLess(len(blob), 1000)
+        self.assertEqual(HyperLogLog.fromBlob(blob).registers, hll.registers)
+        self.assertRaises(ValueError, HyperLogLog, bytearray(10))
+
+    def test_merge(self):
+        hll1, hll2 = HyperLogLog(), HyperLogLog()
+        hll1.update(ips(0, 3000))
+        hll2.update(ips(2000, 3000))
+        self.assertTrue(hll1.merge(hll2))
+        self.assertLess(abs(hll1.count() - 5000), 165)
+        self.assertFalse(hll1.merge(hll2))
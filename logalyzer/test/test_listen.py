@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# logalyzer:
+# Parses your bloated HTTP access logs to extract the info you want
+# about hits to your webserver from (hopefully) real people instead of
+# just the endless hackers and bots. Stores the info in a relational
+# database where you can access it using all the power of SQL.
+#
+# Copyright (C) 2015, 2017, 2018 by Edwin A. Suominen,
+# http://edsuom.com/logalyzer
+#
+# See edsuom.com for API documentation as well as information about
+# Ed's background and other projects, software and otherwise.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the
+# License. You may obtain a copy of the License at
+# 
+#   http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an "AS
+# IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+
+
+from twisted.internet import reactor, defer, protocol
+from twisted.internet.endpoints import TCP4ClientEndpoint, connectProtocol
+
+from testbase import TestCase
+import listen
+
+
+LINE = '10.0.0.1 - - [20/Feb/2015:12:00:00 +0000] "GET / HTTP/1.1" '+\
+       '200 1234 "-" "Browser/1.0"'
+
+
+class FakeTransport(object):
+    paused = False
+    
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+
+
+class TestParseSyslog(TestCase):
+    def test_bsd(self):
+        self.assertEqual(
+            listen.parseSyslog("<134>Feb 20 12:00:00 web1 nginx: "+LINE),
+            ("web1", LINE))
+        self.assertEqual(
+            listen.parseSyslog("<134>Feb  2 12:00:00 nginx[123]: "+LINE+"\n"),
+            (None, LINE))
+
+    def test_rfc5424(self):
+        self.assertEqual(
+            listen.parseSyslog(
+                "<134>1 2015-02-20T12:00:00Z web1 nginx - - - "+LINE),
+            ("web1", LINE))
+        self.assertEqual(
+            listen.parseSyslog(
+                '<134>1 2015-02-20T12:00:00Z - nginx 42 access '+\
+                '[meta x="1"][foo y="\\]"] '+LINE),
+            (None, LINE))
+
+    def test_bare(self):
+        self.assertEqual(listen.parseSyslog(LINE), (None, LINE))
+        self.assertEqual(listen.parseSyslog("<134>"+LINE), (None, LINE))
+
+
+class TestParseAddress(TestCase):
+    def test_valid(self):
+        self.assertEqual(listen.parseAddress("5140"), (5140, ""))
+        self.assertEqual(
+            listen.parseAddress("127.0.0.1:5140"), (5140, "127.0.0.1"))
+        self.assertEqual(listen.parseAddress("::1:5140"), (5140, "::1"))
+
+    def test_invalid(self):
+        for text in ("foo", "", "localhost:", "localhost:foo", "70000"):
+            self.assertRaises(ValueError, listen.parseAddress, text)
+
+
+class TestListener(TestCase):
+    def setUp(self):
+        self.batches = []
+        self.dList = []
+        self.l = listen.Listener(self.parse)
+        self.l.batchSize = 3
+        self.l.batchDelay = 0.05
+
+    def tearDown(self):
+        return self.l.stop()
+        
+    def parse(self, source, lines):
+        self.batches.append((source, lines))
+        d = defer.Deferred()
+        self.dList.append(d)
+        return d
+
+    def test_batches(self):
+        for k in xrange(4):
+            self.l.receive("10.1.1.1", "<134>Feb 20 12:00:00 web1 x: "+LINE)
+        self.l.receive("10.1.1.2", LINE)
+        self.assertEqual(self.batches, [("web1", [LINE]*3)])
+        self.l.flushAll()
+        self.assertEqual(
+            sorted(self.batches[1:]),
+            [("10.1.1.2", [LINE]), ("web1", [LINE])])
+        self.assertEqual(self.l.N_pending, 5)
+        for d in self.dList:
+            d.callback(2)
+        self.assertEqual(self.l.N_pending, 0)
+        self.assertEqual(self.l.counts['parsed'], 6)
+
+    def test_backPressure(self):
+        self.l.maxPending = 4
+        transport = FakeTransport()
+        for k in xrange(4):
+            self.l.receive("10.1.1.1", LINE, transport)
+        self.assertTrue(transport.paused)
+        # UDP messages get dropped
+        self.l.receive("10.1.1.1", LINE)
+        self.assertEqual(self.l.counts['dropped'], 1)
+        self.assertEqual(self.l.counts['received'], 5)
+        self.l.flushAll()
+        self.dList[0].callback(3)
+        # Resumed once no more than half are pending
+        self.assertFalse(transport.paused)
+        self.dList[1].callback(1)
+
+
+class Sender(protocol.DatagramProtocol):
+    pass
+
+
+class TestLoopback(TestCase):
+    def setUp(self):
+        self.received = []
+        self.l = listen.Listener(self.parse)
+        self.l.batchDelay = 0.05
+        self.l.listen(0, '127.0.0.1')
+        self.dReceived = defer.Deferred()
+
+    def tearDown(self):
+        return self.l.stop()
+    
+    def parse(self, source, lines):
+        self.received.extend(lines)
+        if len(self.received) >= self.N and not self.dReceived.called:
+            self.dReceived.callback(None)
+        return defer.succeed(len(lines))
+
+    def port(self, k):
+        return self.l.ports[k].getHost().port
+        
+    @defer.inlineCallbacks
+    def test_udp(self):
+        self.N = 10
+        p = reactor.listenUDP(0, Sender(), '127.0.0.1')
+        for k in xrange(self.N):
+            p.write(
+                "<134>Feb 20 12:00:00 web1 nginx: "+LINE,
+                ("127.0.0.1", self.port(0)))
+        yield self.dReceived
+        yield p.stopListening()
+        self.assertEqual(self.received, [LINE]*self.N)
+        self.assertEqual(self.l.counts['parsed'], self.N)
+        
+    @defer.inlineCallbacks
+    def test_tcp(self):
+        self.N = 6
+        endpoint = TCP4ClientEndpoint(reactor, "127.0.0.1", self.port(1))
+        p = yield connectProtocol(endpoint, protocol.Protocol())
+        message = "<134>Feb 20 12:00:00 web1 nginx: "+LINE
+        framed = "{:d} {}".format(len(message), message)
+        # Octet-counted and newline-framed messages, split anywhere
+        data = framed*3 + (message+"\n")*3
+        p.transport.write(data[:50])
+        p.transport.write(data[50:])
+        yield self.dReceived
+        p.transport.loseConnection()
+        self.assertEqual(self.received, [LINE]*self.N)
@@ -25,16 +25,21 @@
 # express or implied. See the License for the specific language
 # governing permissions and limitations under the License.
 
-import os.path
+import os.path, shutil, marshal, gzip, tempfile
 from contextlib import contextmanager
 from datetime import datetime as dt
 
 from twisted.python import failure
 from twisted.internet import defer
 
+from asynqueue.null import NullQueue
+from asynqueue.iteration import Delay
+
 from testbase import *
 
-import logread
+import logread, sift, spool
+from records import shardedCount
+from discover import Discovery
 
 DB_URL = 'mysql://test@localhost/test'
 #DB_URL = 'sqlite://'
@@ -113,6 +118,38 @@ class TestProcessReader(TestCase):
         result = mr(*args)
         self.assertRecord(result)
 
+    def test_makeRecord_rejects(self):
+        stuffBase = ["foo.com", ip1, dt(2015, 1, 1, 12, 30), "/"]
+        self.r.exclude = [404]
+        self.r.makeRecord("")
+        self.r.makeRecord(stuffBase + [404, "-", "-"], alreadyParsed=True)
+        self.r.makeRecord(stuffBase + [200, "-", "-"], alreadyParsed=True)
+        with self.matcher('uaMatcher'):
+            self.r.makeRecord(
+                stuffBase + [200, "-", "I am a bot"], alreadyParsed=True)
+        with self.matcher('botMatcher'):
+            self.r.makeRecord(
+                ["foo.com", ip1, dt(2015, 1, 1, 12, 30), "/x.php",
+                 200, "-", "-"], alreadyParsed=True)
+        self.r.makeRecord(stuffBase + [200, "-", "-"], alreadyParsed=True)
+        self.assertEqual(self.r.rejects, {
+            'unparsed': 1, 'http': 1, 'ua': 1, 'url': 1, 'blocked': 1})
+        counts = self.r.workerCounts(0, 0)
+        self.assertEqual(counts['rejects']['ua'], 1)
+        self.assertNotIn('rules', counts)
+        self.assertEqual(self.r.rejects, {})
+
+    def test_workerCounts_sizes(self):
+        r = logread.ProcessReader({'UAMatcher': sift.UAMatcher(["bot"])})
+        r.rc(ip1, 302)
+        r.ipm.addIP(ip2)
+        r.m.uaMatcher(ip1, "I am a bot")
+        r.m.uaMatcher(ip2, "Awesome browser/2.3")
+        sizes = r.workerCounts(0, 0)['sizes']
+        self.assertEqual(sizes['redirects'], 1)
+        self.assertEqual(sizes['worker.ipm'], 1)
+        self.assertEqual(sizes['cache.uaMatcher'], 1)
+        
     def _checkParsing(self, fileName, matcher, **kw):
         yielded = {}
         filePath = fileInModuleDir(fileName)
@@ -137,6 +174,223 @@ class TestProcessReader(TestCase):
                 "Had {:d} counts of type '{}', not {:d}".format(
                     counts[name], name, value))
     
+    def _writeLog(self, fileName, N):
+        """
+        Writes a logfile of I{N} lines with a vhost definition up top, a
+        few blockable bots, and some redirects, returning its path.
+        """
+        proto = '{} - - [20/Feb/2015:12:{:02d}:{:02d} +0000] ' +\
+                '"GET {} HTTP/1.1" {:d} 1234 "-" "Browser/1.0"\n'
+        filePath, = tempFiles(os.path.abspath(fileName))
+        with open(filePath, 'w') as fh:
+            fh.write("# foo.com\n")
+            for k in xrange(N):
+                ip = "10.0.{:d}.{:d}".format(k % 7, k % 13)
+                url = "/wp-login.php" if k % 37 == 5 else "/{:d}.html".format(k)
+                http = 302 if k % 11 == 3 else 200
+                fh.write(proto.format(ip, (k // 60) % 60, k % 60, url, http))
+        return filePath
+
+    def _shardReaders(self, N):
+        readers = []
+        for k in xrange(N):
+            r = logread.ProcessReader({})
+            r.m.botMatcher = self.botMatcher
+            readers.append(r)
+        return readers
+    
+    def test_call_shards(self):
+        filePath = self._writeLog("access.log.shards", 500)
+        size = os.path.getsize(filePath)
+        with self.matcher('botMatcher'):
+            expected = list(self.r(filePath))
+        k = [0, size // 3, 2*size // 3, size]
+        # With a lookback covering everything before each shard, the
+        # shards yield exactly what a single worker does
+        result = []
+        for j, r in enumerate(self._shardReaders(3)):
+            result.extend(r(filePath, k[j], k[j+1], "foo.com"))
+        self.assertEqual(result, expected)
+        for stuff in result:
+            if isinstance(stuff[1], dict):
+                self.assertEqual(stuff[1]['vhost'], "foo.com")
+
+    def test_call_last(self):
+        filePath = self._writeLog("access.log.last", 500)
+        self.r.reportStats = True
+        self.r.statsInterval = 100
+        dtList, lastList = [], []
+        with self.matcher('botMatcher'):
+            for stuff in self.r(filePath):
+                if isinstance(stuff, dict):
+                    lastList.append(stuff['last'])
+                elif not isinstance(stuff[0], str):
+                    dtList.append(stuff[0])
+        self.assertEqual(len(lastList), 6)
+        self.assertEqual(lastList, sorted(lastList))
+        self.assertEqual(lastList[-1], max(dtList))
+    
+    def test_call_skipBefore(self):
+        filePath = self._writeLog("access.log.skip", 500)
+        dtSkip = dt(2015, 2, 20, 12, 5)
+        expected = [x for x in self.r(filePath) if x[0] >= dtSkip]
+        r = logread.ProcessReader({})
+        result = list(r(filePath, skipBefore="2015-02-20 12:05:00"))
+        self.assertEqual(len(result), 200)
+        # Skipped lines don't prime the redirect checker, so was_rd
+        # may differ
+        self.assertEqual(
+            [(x[0], x[1]['ip'], x[1]['url']) for x in result],
+            [(x[0], x[1]['ip'], x[1]['url']) for x in expected])
+
+    def test_call_stopAfter(self):
+        filePath = self._writeLog("access.log.stop", 500)
+        r = logread.ProcessReader({})
+        expected = [x[0] for x in r(filePath)]
+        expected = [x for x in expected if x <= dt(2015, 2, 20, 12, 6)]
+        r = logread.ProcessReader({})
+        result = [x[0] for x in r(
+            filePath,
+            skipBefore="2015-02-20 12:02:00",
+            stopAfter="2015-02-20 12:06:00")]
+        self.assertEqual(len(result), 241)
+        self.assertEqual(
+            result, [x for x in expected if x >= dt(2015, 2, 20, 12, 2)])
+
+    def test_call_reportStats(self):
+        filePath = self._writeLog("access.log.stats", 500)
+        expected = list(self.r(filePath))
+        r = logread.ProcessReader(
+            {'UAMatcher': sift.UAMatcher(["NoSuchBot"])}, reportStats=True)
+        r.statsInterval = 200
+        result = list(r(filePath))
+        counts = [x for x in result if isinstance(x, dict)]
+        self.assertEqual([x for x in result if x not in counts], expected)
+        with open(filePath) as fh:
+            N = len(fh.readlines())
+        self.assertEqual([x['lines'] for x in counts], [200, 200, N-400])
+        self.assertEqual(
+            sum([x['bytes'] for x in counts]), os.path.getsize(filePath))
+        self.assertEqual(counts[0]['pid'], os.getpid())
+        # Lookups since the last dict of counts, none of them hits
+        lookups = [x['caches']['uaMatcher'][1] for x in counts]
+        self.assertEqual(sum(lookups), len(expected))
+        self.assertEqual(
+            [x['caches']['uaMatcher'][0] for x in counts], [0, 0, 0])
+        
+    def test_call_accounting(self):
+        filePath = self._writeLog("access.log.accounting", 500)
+        rules = ["NoSuchBot", r"Browser/1\.0"]
+        r = logread.ProcessReader(
+            {'UAMatcher': sift.UAMatcher(rules)},
+            reportStats=True, accounting=True)
+        result = list(r(filePath))
+        counts = [x for x in result if isinstance(x, dict)]
+        rejected = [x for x in result if x not in counts]
+        # Every line has the rejected user-agent
+        self.assertEqual(len(rejected), 500)
+        self.assertEqual(sum([x['rejects']['ua'] for x in counts]), 500)
+        ruleCounts = counts[-1]['rules']['uaMatcher']
+        self.assertEqual(sorted(ruleCounts.keys()), sorted(rules))
+        hits, evals, seconds = ruleCounts["NoSuchBot"]
+        self.assertEqual(hits, 0)
+        self.assertGreater(evals, 0)
+        # Both rules get evaluated for every lookup not answered by
+        # the cache
+        self.assertEqual(ruleCounts[rules[1]][:2], (evals, evals))
+        lookups, cacheHits = [
+            sum([x['caches']['uaMatcher'][k] for x in counts])
+            for k in (1, 0)]
+        self.assertEqual(evals, lookups - cacheHits)
+        
+    def test_seekTimestamp(self):
+        filePath = self._writeLog("access.log.seek", 3000)
+        with open(filePath) as fh:
+            lines = fh.readlines()
+            for key, N in (
+                    ("2015-02-20 12:00:00", 0),
+                    ("2015-02-20 12:30:00", 1024),
+                    ("2015-02-20 12:49:59", 1024),
+                    ("2015-02-20 12:50:00", 1024)):
+                k = self.r.seekTimestamp(fh, key, N=N)
+                # The offset is at a line boundary no more than N
+                # bytes before the first line with the key
+                kLine = 0
+                for j, line in enumerate(lines):
+                    if self.r.p.timestampKey(line) >= key:
+                        break
+                    kLine += len(line)
+                self.assertLessEqual(k, kLine)
+                self.assertGreaterEqual(k, kLine - N - 200)
+
+    def test_timeSpan(self):
+        filePath = self._writeLog("access.log.span", 500)
+        span = [dt(2015, 2, 20, 12, 0, 0), dt(2015, 2, 20, 12, 8, 19)]
+        self.assertEqual(self.r.timeSpan(filePath), span)
+        self.r.lookback = 200
+        self.assertEqual(self.r.timeSpan(filePath), span)
+        gzPath = filePath + ".gz"
+        with open(filePath) as fh, gzip.open(gzPath, 'wb') as fhz:
+            fhz.write(fh.read())
+        self.assertEqual(self.r.timeSpan(gzPath), span)
+        os.remove(gzPath)
+        with open(filePath, 'w') as fh:
+            fh.write("# foo.com\n")
+        self.assertNone(self.r.timeSpan(filePath))
+        
+    def test_call_shards_noLookback(self):
+        class Tally:
+            pass
+        
+        filePath = self._writeLog("access.log.shards", 500)
+        size = os.path.getsize(filePath)
+        with self.matcher('botMatcher'):
+            N_expected = len([
+                x for x in self.r(filePath) if isinstance(x[1], dict)])
+        k = [0, size // 4, size // 2, 3*size // 4, size]
+        consumers = []
+        for j, r in enumerate(self._shardReaders(4)):
+            r.lookback = 0
+            tally = Tally()
+            tally.ipCounts = {}
+            tally.blockedIPs = set()
+            for stuff in r(filePath, k[j], k[j+1], "foo.com"):
+                if isinstance(stuff[1], dict):
+                    ip = stuff[1]['ip']
+                    tally.ipCounts[ip] = tally.ipCounts.get(ip, 0) + 1
+                elif stuff[1]:
+                    tally.blockedIPs.add(stuff[0])
+            consumers.append(tally)
+        self.assertEqual(shardedCount(consumers), N_expected)
+    
+    def test_call_spool(self):
+        filePath = self._writeLog("access.log.spool", 500)
+        with self.matcher('botMatcher'):
+            expected = list(self.r(filePath))
+        spoolDir = os.path.abspath("spool")
+        os.mkdir(spoolDir)
+        try:
+            r = self._shardReaders(1)[0]
+            r.spoolDir = spoolDir
+            result = list(r(filePath))
+            # Only rejected IP addresses get yielded
+            self.assertEqual(
+                result, [x for x in expected if isinstance(x[0], str)])
+            records = []
+            for fileName in sorted(os.listdir(spoolDir)):
+                self.assertTrue(fileName.endswith(".seg"))
+                with open(os.path.join(spoolDir, fileName), 'rb') as fh:
+                    self.assertEqual(marshal.load(fh), filePath)
+                    while True:
+                        try:
+                            records.append(spool.decode(marshal.load(fh)))
+                        except EOFError:
+                            break
+        finally:
+            shutil.rmtree(spoolDir)
+        self.assertEqual(
+            records, [x for x in expected if isinstance(x[1], dict)])
+    
     def test_call_oldFormat_bot(self):
         return self._checkParsing(
             "access.log.1", 'botMatcher', accepted=63, blocked=2, ignored=1)
@@ -155,6 +409,190 @@ class TestProcessReader(TestCase):
 
     
 
+class ShardQueue(NullQueue):
+    """
+    A queue that looks like it has two workers, so logfiles get
+    sharded, and fails to parse any shard but the first one.
+    """
+    def __len__(self):
+        return 2
+
+    def call(self, f, *args, **kw):
+        if len(args) > 1 and args[1]:
+            return defer.fail(RuntimeError("Shard failed"))
+        return NullQueue.call(self, f, *args, **kw)
+
+
+class TestReader_dryRun(TestCase):
+    def setUp(self):
+        self.dirPath = tempfile.mkdtemp()
+        proto = '{} - - [20/Feb/2015:12:{:02d}:{:02d} +0000] ' +\
+                '"GET {} HTTP/1.1" 200 1234 "-" "Browser/1.0"\n'
+        with open(os.path.join(self.dirPath, "access.log"), 'w') as fh:
+            fh.write("# foo.com\n")
+            for k in xrange(300):
+                url = "/scripts/takeover.php" if k == 150 \
+                      else "/{:d}.html".format(k)
+                fh.write(proto.format(
+                    "10.0.0.{:d}".format(k % 5), k // 60, k % 60, url))
+        self.r = self.reader()
+
+    def reader(self, **kw):
+        r = logread.Reader(
+            {"BotMatcher": RULES_BOT}, None, dryRun=True, cores=1, **kw)
+        r.myDir = self.dirPath
+        return r
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        yield self.r.shutdown()
+        shutil.rmtree(self.dirPath)
+
+    @defer.inlineCallbacks
+    def test_run(self):
+        rejectedIPs = yield self.r.run(["access.log"])
+        self.assertEqual(rejectedIPs, {"10.0.0.0": True})
+        stats = self.r.stats
+        self.assertEqual(stats.get('lines', "access.log"), 301)
+        # Lines from the blocked IP address after it got blocked are
+        # skipped, the ones before it accepted
+        self.assertEqual(stats.get('parsed', "access.log"), 270)
+        self.assertEqual(stats.get('blocked', "access.log"), 1)
+        self.assertEqual(stats.get('added'), 0)
+        self.assertGreater(stats.get('wall', "access.log"), 0)
+
+    @defer.inlineCallbacks
+    def test_run_window(self):
+        def timeSpan(pr, filePath):
+            calls.append(filePath)
+            return f(pr, filePath)
+
+        calls = []
+        f = logread.ProcessReader.timeSpan
+        self.patch(logread.ProcessReader, 'timeSpan', timeSpan)
+        # Without a time window, the file isn't read for its time span
+        yield self.r.run(["access.log"])
+        self.assertEqual(calls, [])
+        self.assertEqual(self.r.stats.get('lines', "access.log"), 301)
+        # With one, it is, and skipped for being outside the window
+        yield self.r.shutdown()
+        self.r = self.reader(since=dt(2015, 2, 21))
+        yield self.r.run(["access.log"])
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(self.r.stats.get('lines', "access.log"), 0)
+        
+    @defer.inlineCallbacks
+    def test_run_watermark(self):
+        def setWatermark(*args):
+            calls.append(args)
+            return defer.succeed(None)
+
+        calls = []
+        self.r.rk.setWatermark = setWatermark
+        yield self.r.run(["access.log"])
+        # The watermark is the latest record that the worker found
+        self.assertEqual(calls, [("access.log", dt(2015, 2, 20, 12, 4, 59))])
+    
+    @defer.inlineCallbacks
+    def test_follow_appendedDuringDispatch(self):
+        @defer.inlineCallbacks
+        def linesParsed(N):
+            for k in xrange(100):
+                if self.r.stats.get('lines', "access.log") >= N:
+                    break
+                yield self.r.deferToDelay(0.05)
+            defer.returnValue(self.r.stats.get('lines', "access.log"))
+        
+        filePath = os.path.join(self.dirPath, "access.log")
+        proto = '10.0.0.1 - - [20/Feb/2015:12:05:{:02d} +0000] ' +\
+                '"GET /{:d}.html HTTP/1.1" 200 1234 "-" "Browser/1.0"\n'
+        # The logfile gets found, and then a line and part of another
+        # one get appended to it before it's dispatched for parsing
+        self.r.fileStats["access.log"] = os.stat(filePath)
+        with open(filePath, 'a') as fh:
+            fh.write(proto.format(0, 300) + proto.format(1, 301)[:20])
+        yield self.r.run(["access.log"])
+        self.assertEqual(self.r.stats.get('lines', "access.log"), 301)
+        self.r.followInterval = 0.05
+        self.r.follow(["access.log"])
+        # Following picks up the appended line, just once
+        N = yield linesParsed(302)
+        self.assertEqual(N, 302)
+        # The partial line gets parsed once it's complete
+        with open(filePath, 'a') as fh:
+            fh.write(proto.format(1, 301)[20:])
+        N = yield linesParsed(303)
+        self.assertEqual(N, 303)
+        yield self.r.deferToDelay(0.2)
+        self.assertEqual(self.r.stats.get('lines', "access.log"), 303)
+        self.assertEqual(self.r.stats.get('parsed', "access.log"), 272)
+    
+    def test_fileNames(self):
+        logFile = Discovery()([os.path.join(self.dirPath, "access.log")])[0]
+        self.assertEqual(
+            self.r.fileNames([u"access.log.1", logFile]),
+            [u"access.log.1", "access.log"])
+        self.assertEqual(self.r.filePaths, {"access.log": logFile.path})
+    
+    @defer.inlineCallbacks
+    def test_run_discovered(self):
+        os.mkdir(os.path.join(self.dirPath, "www"))
+        os.rename(
+            os.path.join(self.dirPath, "access.log"),
+            os.path.join(self.dirPath, "www", "access.log"))
+        logFiles = Discovery(recursive=True)([self.dirPath])
+        rejectedIPs = yield self.r.run(logFiles)
+        self.assertEqual(rejectedIPs, {"10.0.0.0": True})
+        self.assertEqual(self.r.stats.get('lines', "www/access.log"), 301)
+        self.assertEqual(
+            self.r.fileStats["www/access.log"], logFiles[0].stat)
+
+    @defer.inlineCallbacks
+    def test_run_spooled(self):
+        def drain(filePath):
+            d = defer.Deferred()
+            drains.append(d)
+            return d
+
+        drains = []
+        fileNames = ["access.log"]
+        for k in (1, 2):
+            fileNames.append("access.log.{:d}".format(k))
+            shutil.copy(
+                os.path.join(self.dirPath, "access.log"),
+                os.path.join(self.dirPath, fileNames[-1]))
+        self.r = self.reader(spoolDir=os.path.join(self.dirPath, "spool"))
+        self.r.spool.drain = drain
+        d = self.r.run(fileNames)
+        # Files waiting on the spool don't take up any of the two
+        # parsing slots
+        yield Delay().untilEvent(lambda: len(drains) == 3)
+        self.assertFalse(d.called)
+        for k, dDrain in enumerate(drains):
+            dDrain.callback(k)
+        yield d
+        for fileName in fileNames:
+            self.assertGreater(self.r.stats.get('wall', fileName), 0)
+    
+    @defer.inlineCallbacks
+    def test_run_shardFails(self):
+        def fileInfo(*args):
+            calls.append(args)
+            return defer.succeed(None)
+
+        calls = []
+        self.r.getQueue = ShardQueue
+        self.r.shardSize = 1000
+        self.r.rk.fileInfo = fileInfo
+        self.r.rk.setWatermark = fileInfo
+        self.patch(logread, 'oops', lambda x: calls.append(x))
+        yield self.r.run(["access.log"])
+        # The failure is reported and nothing about the file is stored
+        self.assertEqual(len(calls), 1)
+        self.assertIsInstance(calls[0], failure.Failure)
+        self.assertEqual(self.r.consumers, [])
+        
+        
 class TestReader(TestCase):
     verbose = False
 
@@ -180,6 +618,43 @@ class TestReader(TestCase):
     
     def test_dispatch(self):
         pass
+
+    def test_source(self):
+        for fileName in (
+                "access.log", "access.log.1", "access.log.12.gz",
+                "access.log-20180102", "access.log-20180102.gz"):
+            self.assertEqual(self.r.source(fileName), "access.log")
+        self.assertEqual(
+            self.r.source("logs/foo.com.log.gz"), "logs/foo.com.log")
+
+    def test_skipBefore(self):
+        self.r.watermarks = {'access.log': dt(2015, 2, 20, 12, 5)}
+        self.assertNone(self.r.skipBefore("access.log.1"))
+        self.r.margin = 90
+        self.assertEqual(
+            self.r.skipBefore("access.log.1"), "2015-02-20 12:03:30")
+        self.assertNone(self.r.skipBefore("other.log"))
+        # The since datetime is used when it's later
+        self.r.since = dt(2015, 2, 20, 12, 3)
+        self.assertEqual(
+            self.r.skipBefore("access.log.1"), "2015-02-20 12:03:30")
+        self.assertEqual(
+            self.r.skipBefore("other.log"), "2015-02-20 12:03:00")
+
+    def test_window(self):
+        span = [dt(2015, 2, 20, 12), dt(2015, 2, 20, 13)]
+        self.assertTrue(self.r.inWindow(*span))
+        self.assertNone(self.r.stopAfter())
+        self.r.since = dt(2015, 2, 20, 13, 1)
+        self.assertFalse(self.r.inWindow(*span))
+        self.r.since = dt(2015, 2, 20, 12, 30)
+        self.assertTrue(self.r.inWindow(*span))
+        self.r.until = dt(2015, 2, 20, 11, 59)
+        self.assertFalse(self.r.inWindow(*span))
+        self.r.since = None
+        self.r.until = dt(2015, 2, 20, 12, 0)
+        self.assertTrue(self.r.inWindow(*span))
+        self.assertEqual(self.r.stopAfter(), "2015-02-20 12:00:00")
        
     @defer.inlineCallbacks
     def test_run(self):
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# logalyzer:
+# Parses your bloated HTTP access logs to extract the info you want
+# about hits to your webserver from (hopefully) real people instead of
+# just the endless hackers and bots. Stores the info in a relational
+# database where you can access it using all the power of SQL.
+#
+# Copyright (C) 2015, 2017, 2018 by Edwin A. Suominen,
+# http://edsuom.com/logalyzer
+#
+# See edsuom.com for API documentation as well as information about
+# Ed's background and other projects, software and otherwise.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the
+# License. You may obtain a copy of the License at
+# 
+#   http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an "AS
+# IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+
+
+import os, os.path, shutil, tempfile, json
+
+from twisted.internet import defer
+
+from testbase import TestCase
+from stats import Stats
+from metrics import Metrics, throughputReport
+import records, spool
+from test_spool import writeSegments
+
+
+class TestMetrics(TestCase):
+    def setUp(self):
+        self.dirPath = tempfile.mkdtemp()
+        self.stats = Stats()
+        self.stats.gauge('inFlight', lambda: 12)
+        self.stats.gauge('dbLatency', lambda: 0.02)
+        for name, N in (
+                ('bytes', 4000), ('parsed', 30),
+                ('added', 25), ('duplicates', 5),
+                ('ignored', 4), ('blocked', 2),
+                ('purged', 7), ('purges', 2), ('purgeSeconds', 0.5)):
+            self.stats.bump(name, N, fileName="access.log")
+        for name, N in (('lines', 40), ('seconds', 0.004)):
+            self.stats.bump(name, N, fileName="access.log", worker=1234)
+        self.stats.sizer(lambda: {'dtk': 100, 'rejectedIPs': 2})
+        self.stats.setSizes(1234, {'redirects': 3})
+
+    def tearDown(self):
+        shutil.rmtree(self.dirPath)
+
+    def metrics(self, fileName):
+        return Metrics(os.path.join(self.dirPath, fileName), self.stats)
+        
+    def test_record(self):
+        m = self.metrics("metrics.json")
+        record = m.record(m.t0 + 5)
+        self.assertEqual(record['elapsed'], 5)
+        self.assertEqual(record['files'], {"access.log": {
+            'bytes': 4000, 'lines': 40, 'accepted': 30, 'ignored': 4,
+            'blocked': 2, 'inserts': 25, 'duplicates': 5,
+            'purges': 2, 'purged': 7}})
+        self.assertEqual(record['totals'], record['files']["access.log"])
+        self.assertEqual(
+            record['workers'], {'1234': {
+                'lines': 40, 'bytes': 0, 'seconds': 0.004}})
+        latency = record['latency']
+        self.assertAlmostEqual(latency['parse'], 0.0001)
+        self.assertAlmostEqual(latency['purge'], 0.25)
+        self.assertEqual(latency['db'], 0.02)
+        self.assertEqual(record['gauges'], {
+            'db_in_flight': 12, 'producer_pauses': None, 'rss_bytes': None})
+        self.assertEqual(record['memory'], {
+            'sizes': {'dtk': 100, 'rejectedIPs': 2, 'redirects': 3}})
+
+    def test_json(self):
+        m = self.metrics("metrics.json")
+        m.write()
+        self.stats.bump('lines', 10, fileName="access.log")
+        m.stop()
+        with open(m.filePath) as fh:
+            records = [json.loads(x) for x in fh]
+        self.assertEqual(len(records), 2)
+        self.assertEqual(
+            [x['files']["access.log"]['lines'] for x in records], [40, 50])
+
+    def test_prom(self):
+        m = self.metrics("logalyzer.prom")
+        m.write()
+        m.write()
+        self.assertEqual(os.listdir(self.dirPath), ["logalyzer.prom"])
+        with open(m.filePath) as fh:
+            lines = [x.strip() for x in fh]
+        for line in (
+                '# TYPE logalyzer_lines_total counter',
+                'logalyzer_lines_total{file="access.log"} 40',
+                'logalyzer_duplicates_total{file="access.log"} 5',
+                'logalyzer_worker_lines_total{pid="1234"} 40',
+                'logalyzer_latency_seconds{stage="db"} 0.02',
+                'logalyzer_db_in_flight 12',
+                'logalyzer_items{structure="dtk"} 100',
+                'logalyzer_items{structure="redirects"} 3'):
+            self.assertIn(line, lines)
+        # No value for a gauge that doesn't exist
+        self.assertNotIn('logalyzer_rss_bytes', "".join(
+            [x for x in lines if not x.startswith('#')]))
+
+    @defer.inlineCallbacks
+    def test_record_spooled(self):
+        spoolDir = os.path.join(self.dirPath, "spool")
+        rk = records.RecordKeeper("sqlite://", 1, [], stats=self.stats)
+        sl = spool.SpoolLoader(spoolDir, rk)
+        yield rk.startup()
+        try:
+            for fileName in ("access.log.1", "access.log.2"):
+                filePath = os.path.join(self.dirPath, fileName)
+                sl.fileNames[filePath] = fileName
+                writeSegments(spoolDir, filePath)
+                yield sl.drain(filePath)
+        finally:
+            yield sl.shutdown()
+            yield rk.shutdown()
+        files = self.metrics("metrics.json").record()['files']
+        # The same records from the second file were all duplicates
+        for fileName, N_added in (("access.log.1", 3), ("access.log.2", 0)):
+            counts = files[fileName]
+            self.assertEqual(counts['accepted'], 3)
+            self.assertEqual(counts['inserts'], N_added)
+            self.assertEqual(counts['duplicates'], 3 - N_added)
+        
+    def test_label(self):
+        self.assertEqual(
+            Metrics.label('file', 'a"b\\c'), '{file="a\\"b\\\\c"}')
+
+    def test_throughputReport(self):
+        self.stats.bump('wall', 0.5, fileName="access.log")
+        self.stats.bump('lines', 10, fileName="access.log.1")
+        lines = throughputReport(self.stats, 2.0)
+        self.assertEqual(len(lines), 5)
+        self.assertEqual(lines[0].split()[:3], ["File", "Lines", "Accepted"])
+        self.assertEqual(
+            lines[1].split(), ["access.log", "40", "30", "4", "2", "0.50", "80"])
+        self.assertEqual(lines[2].split()[-1], "-")
+        self.assertEqual(lines[3].split()[:2], ["Total", "50"])
+        self.assertEqual(lines[3].split()[-1], "25")
+        self.assertEqual(
+            lines[4], "Workers parsed 12500 lines per CPU second")
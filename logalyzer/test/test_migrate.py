@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# logalyzer:
+# Parses your bloated HTTP access logs to extract the info you want
+# about hits to your webserver from (hopefully) real people instead of
+# just the endless hackers and bots. Stores the info in a relational
+# database where you can access it using all the power of SQL.
+#
+# Copyright (C) 2015, 2017, 2018 by Edwin A. Suominen,
+# http://edsuom.com/logalyzer
+#
+# See edsuom.com for API documentation as well as information about
+# Ed's background and other projects, software and otherwise.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the
+# License. You may obtain a copy of the License at
+# 
+#   http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an "AS
+# IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+
+import os.path
+
+from twisted.internet import defer
+
+from testbase import ip1, ip2, RECORDS, TestCase, tempFiles, deleteIfExists
+import database, migrate
+
+
+class TestMigrate(TestCase):
+    verbose = False
+    
+    @defer.inlineCallbacks
+    def setUp(self):
+        filePath, = tempFiles(os.path.abspath("migrate.db"))
+        deleteIfExists(filePath)
+        self.url = "sqlite:///{}".format(filePath)
+        t = database.Transactor(self.url)
+        yield t.waitUntilRunning()
+        for dt, theseRecords in RECORDS.iteritems():
+            for thisRecord in theseRecords:
+                yield t.setRecord(dt, thisRecord)
+        self.rows = yield t.sql("SELECT * FROM entries ORDER BY id")
+        yield t.shutdown()
+
+    def tearDown(self):
+        if hasattr(self, 't'):
+            return self.t.shutdown()
+    
+    @defer.inlineCallbacks
+    def test_migrate(self):
+        N = migrate.migrate(self.url, N_batch=2, verbose=self.isVerbose())
+        self.assertEqual(N, 3)
+        # Again, nothing to do
+        N = migrate.migrate(self.url, verbose=self.isVerbose())
+        self.assertEqual(N, 0)
+        self.t = database.Transactor(self.url)
+        yield self.t.waitUntilRunning()
+        self.assertTrue(self.t.compact)
+        # The view looks just like the old table
+        rows = yield self.t.sql("SELECT * FROM entries ORDER BY id")
+        self.assertEqual(len(rows), 3)
+        for k, row in enumerate(rows):
+            self.assertEqual(list(row), list(self.rows[k]))
+        N = yield self.t.hitsForIP(ip1)
+        self.assertEqual(N, 2)
+        # Duplicates are still detected
+        for dt, theseRecords in RECORDS.iteritems():
+            for thisRecord in theseRecords:
+                yield self.t.preload()
+                wasAdded = yield self.t.setRecord(dt, thisRecord)
+                self.assertFalse(wasAdded)
+        N = yield self.t.purgeIP(ip1)
+        self.assertEqual(N, 2)
+        N = yield self.t.hitsForIP(ip2)
+        self.assertEqual(N, 1)
+
+    def test_migrate_interrupted(self):
+        engine = database.SA.create_engine(self.url)
+        engine.execute("CREATE TABLE entries_c (id INTEGER PRIMARY KEY)")
+        engine.dispose()
+        N = migrate.migrate(self.url, verbose=self.isVerbose())
+        self.assertEqual(N, 3)
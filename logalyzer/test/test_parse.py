@@ -163,7 +163,26 @@ class TestParser(TestCase):
             dtp = self.p(NASTY_SHIT.strip())[2]
             self.assertEqual(dtp, dt(2015, 02, 26, 20, 0, 24))
 
+    def test_timestampKey(self):
+        fmt = "%Y-%m-%d %H:%M:%S"
+        for text in (NASTY_SHIT, OLD_STYLE, NEW_STYLE, NEWER_STYLE):
+            text = text.strip()
+            self.assertEqual(
+                self.p.timestampKey(text), self.p(text)[2].strftime(fmt))
+        self.assertEqual(
+            self.p.timestampKey(
+                '1.2.3.4 foo.com - [2/Jan/2015:21:17:16 +0000] "GET /"'),
+            "2015-01-02 21:17:16")
+        self.assertNone(self.p.timestampKey("xxxx"))
+        self.assertNone(self.p.timestampKey("[bogus]"))
+        self.assertNone(self.p.timestampKey(
+            '1.2.3.4 - - [xx/Feb/2015:12:00:00 +0000] "GET / HTTP/1.1"'))
+    
     def test_call_bogus(self):
         self.assertNone(self.p("xxxx"))
+        # An IP address with an octet over 255 isn't one
+        self.assertNone(self.p(
+            '300.1.1.1 - - [20/Feb/2015:12:00:00 +0000] "GET / HTTP/1.1" '+\
+            '200 1234 "-" "Browser/1.0"'))
         self.assertNone(self.p(TWISTED_MSG.strip()))
         self.assertNone(self.p(ANOTHER_TWISTED_MSG.strip()))
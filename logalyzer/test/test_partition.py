@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# logalyzer:
+# Parses your bloated HTTP access logs to extract the info you want
+# about hits to your webserver from (hopefully) real people instead of
+# just the endless hackers and bots. Stores the info in a relational
+# database where you can access it using all the power of SQL.
+#
+# Copyright (C) 2015, 2017, 2018 by Edwin A. Suominen,
+# http://edsuom.com/logalyzer
+#
+# See edsuom.com for API documentation as well as information about
+# Ed's background and other projects, software and otherwise.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the
+# License. You may obtain a copy of the License at
+# 
+#   http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an "AS
+# IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+
+import os.path
+
+from twisted.internet import defer
+
+from testbase import ip1, ip2, RECORDS, TestCase, tempFiles
+import partition, records
+
+
+class TestPartitioning(TestCase):
+    def test_partitionOf(self):
+        counts = [0, 0, 0]
+        for k in xrange(300):
+            ip = "10.1.{:d}.{:d}".format(k // 256, k % 256)
+            kp = partition.partitionOf(ip, 3)
+            self.assertEqual(kp, partition.partitionOf(ip, 3))
+            counts[kp] += 1
+        for N in counts:
+            self.assertGreater(N, 50)
+
+
+class TestPartitions(TestCase):
+    verbose = False
+    
+    def setUp(self):
+        filePath, = tempFiles(os.path.abspath("partition.db"))
+        self.rk = records.RecordKeeper(
+            "sqlite:///{}".format(filePath), 1, [], writers=2)
+        self.t = self.rk.t
+        return self.rk.startup()
+
+    def tearDown(self):
+        return self.rk.shutdown()
+
+    @defer.inlineCallbacks
+    def test_addRecord_purgeIP(self):
+        self.assertIsInstance(self.t, partition.Partitions)
+        for dt, theseRecords in RECORDS.iteritems():
+            for thisRecord in theseRecords:
+                wasAdded = yield self.rk.addRecord(dt, thisRecord)
+                self.assertTrue(wasAdded)
+                # A duplicate isn't added
+                wasAdded = yield self.rk.addRecord(dt, thisRecord)
+                self.assertFalse(wasAdded)
+        for ip, N_expected in ((ip1, 2), (ip2, 1)):
+            N = yield self.t.hitsForIP(ip)
+            self.assertEqual(N, N_expected)
+        yield self.rk.purgeIP(ip1, False)
+        N = yield self.t.hitsForIP(ip1)
+        self.assertEqual(N, 0)
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# logalyzer:
+# Parses your bloated HTTP access logs to extract the info you want
+# about hits to your webserver from (hopefully) real people instead of
+# just the endless hackers and bots. Stores the info in a relational
+# database where you can access it using all the power of SQL.
+#
+# Copyright (C) 2015, 2017, 2018 by Edwin A. Suominen,
+# http://edsuom.com/logalyzer
+#
+# See edsuom.com for API documentation as well as information about
+# Ed's background and other projects, software and otherwise.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the
+# License. You may obtain a copy of the License at
+# 
+#   http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an "AS
+# IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+
+
+import os, os.path, shutil, tempfile, threading, pstats
+
+from testbase import TestCase
+import parse, sift, profiling
+
+
+class TestProfiling(TestCase):
+    def setUp(self):
+        self.dirPath = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dirPath)
+
+    def work(self):
+        p = parse.LineParser()
+        m = sift.NetMatcher(["10.0.0.0/8"])
+        for k in xrange(100):
+            m("192.168.0.{:d}".format(k))
+        
+    def test_profiler(self):
+        pr = profiling.Profiler(os.path.join(self.dirPath, "prof"))
+        pr.start()
+        t = threading.Thread(target=self.work)
+        t.start()
+        t.join()
+        filePath = pr.stop()
+        self.assertEqual(
+            os.path.basename(filePath), "main-{:d}.pstats".format(os.getpid()))
+        # The work done in the thread was profiled: 100 calls and the
+        # startup call from the constructor
+        ps = pstats.Stats(filePath)
+        c = profiling.Component("NetMatcher", sift.NetMatcher)
+        N, ct, tt = c.times(ps.stats)
+        self.assertEqual(N, 101)
+        self.assertGreater(ct, 0)
+
+    def test_worker(self):
+        profiling.profileWorker()
+        self.work()
+        profiling.dumpWorker(self.dirPath)
+        profiling._workerProfile.disable()
+        profiling._workerProfile = None
+        self.assertEqual(
+            os.listdir(self.dirPath), ["worker-{:d}.pstats".format(os.getpid())])
+
+    def test_component(self):
+        c = profiling.Component("NetMatcher", sift.NetMatcher)
+        code = sift.NetMatcher.__call__.im_func.func_code
+        func = (code.co_filename, code.co_firstlineno, code.co_name)
+        self.assertIn(func, c)
+        code = sift.IPMatcher.__call__.im_func.func_code
+        self.assertNotIn(
+            (code.co_filename, code.co_firstlineno, code.co_name), c)
+        # Called from within the class, so not counted again in the
+        # calls or cumulative time
+        inner = ("foo.py", 2, 'inner')
+        c.funcs.add(inner)
+        stats = {
+            func: (10, 10, 0.5, 2.0, {('foo.py', 1, 'foo'): None}),
+            inner: (5, 5, 0.25, 1.0, {func: None})}
+        self.assertEqual(c.times(stats), (10, 2.0, 0.75))
+
+    def test_summarize(self):
+        pr = profiling.Profiler(self.dirPath)
+        pr.start()
+        self.work()
+        pr.stop()
+        with open(profiling.summarize(self.dirPath)) as fh:
+            lines = fh.readlines()
+        self.assertTrue(lines[0].startswith("Where the time went in 1 "))
+        names = [x.split()[0] for x in lines[3:11]]
+        self.assertEqual(names[:2], ["ProcessReader", "LineParser"])
+        self.assertIn("NetMatcher", names)
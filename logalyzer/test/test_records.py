@@ -27,10 +27,134 @@
 
 from twisted.internet import defer
 
-from testbase import ip1, ip2, RECORDS, TestCase
+from testbase import ip1, ip2, dt1, dt2, dt3, RECORDS, TestCase
 import records
 
 
+class MockProducer(object):
+    def __init__(self):
+        self.isPaused = False
+    def pauseProducing(self):
+        self.isPaused = True
+    def resumeProducing(self):
+        self.isPaused = False
+
+
+class TestFlowControl(TestCase):
+    def setUp(self):
+        self.fc = records.FlowControl(maxMemory=0)
+
+    def _write(self, N, latency=0.0):
+        t0List = [self.fc.sent() - latency for k in xrange(N)]
+        for t0 in t0List:
+            self.fc.done(t0)
+        
+    def test_grows(self):
+        window = self.fc.window
+        self._write(1000)
+        self.assertGreater(self.fc.window, window + 10)
+        self.assertEqual(self.fc.N_inFlight, 0)
+        self.assertEqual(self.fc.metrics()['cuts'], 0)
+
+    def test_shrinks(self):
+        self._write(1000)
+        window = self.fc.window
+        self._write(1000, latency=2*self.fc.maxLatency)
+        self.assertLess(self.fc.window, window)
+        metrics = self.fc.metrics()
+        self.assertGreater(metrics['cuts'], 0)
+        # Not cut more than once per window
+        self.assertLess(metrics['cuts'], 1000 / self.fc.minWindow)
+        self.assertGreaterEqual(self.fc.window, self.fc.minWindow)
+
+    def test_memory(self):
+        self.fc.maxMemory = 1
+        window = self.fc.window
+        self._write(1000)
+        self.assertLess(self.fc.window, window)
+
+    def test_memory_unknown(self):
+        self.patch(records, 'rss', lambda: None)
+        self.assertEqual(records.FlowControl().maxMemory, None)
+        self.patch(records, 'rss', lambda: 2**20)
+        self.assertGreater(records.FlowControl().maxMemory, 0)
+        
+    def test_pause_resume(self):
+        producer = MockProducer()
+        t0List = []
+        while not self.fc.isFull():
+            t0List.append(self.fc.sent())
+        self.fc.pause(producer)
+        self.fc.pause(producer)
+        self.assertTrue(producer.isPaused)
+        self.assertEqual(self.fc.N_paused, 1)
+        for t0 in t0List:
+            self.fc.done(t0)
+        self.assertFalse(producer.isPaused)
+        self.assertEqual(self.fc.metrics()['resumed'], 1)
+    
+    
+class TestProcessConsumer(TestCase):
+    def setUp(self):
+        self.rk = records.RecordKeeper(None, 1, [])
+        self.consumer = self.rk.consumerFactory("access.log")
+        self.producer = MockProducer()
+        self.consumer.producer = self.producer
+
+    def tearDown(self):
+        return self.rk.shutdown()
+    
+    def test_write_last(self):
+        counts = {'pid': 1, 'lines': 1, 'bytes': 1, 'seconds': 0.0,
+                  'caches': {}}
+        for k, dtLast in enumerate((None, dt1, dt3, dt2)):
+            counts['last'] = dtLast
+            self.consumer.write(counts)
+            self.assertEqual(self.consumer.dtLast, [None, dt1, dt3, dt3][k])
+            
+    @defer.inlineCallbacks
+    def test_write_duplicates(self):
+        def addRecord(dt, record):
+            return defer.succeed(record['ip'] == ip1)
+
+        self.rk.addRecord = addRecord
+        for dt, theseRecords in RECORDS.iteritems():
+            for thisRecord in theseRecords:
+                self.consumer.write((dt, thisRecord))
+        yield self.consumer.dt.deferToAll()
+        counts = self.rk.stats.snapshot()['files']["access.log"]
+        self.assertEqual(counts['parsed'], 3)
+        self.assertEqual(counts['added'], 2)
+        self.assertEqual(counts['duplicates'], 1)
+        
+    @defer.inlineCallbacks
+    def test_write_fails(self):
+        def addRecord(*args):
+            d = defer.Deferred()
+            dList.append(d)
+            return d
+        
+        dList, failures = [], []
+        self.patch(records, 'oops', failures.append)
+        self.rk.addRecord = addRecord
+        fc = self.rk.fc
+        N = int(fc.window) + 5
+        for k in xrange(N):
+            dt, theseRecords = RECORDS.items()[k % 2]
+            self.consumer.write((dt, theseRecords[0]))
+        self.assertTrue(self.producer.isPaused)
+        for d in dList:
+            d.errback(RuntimeError("DB error"))
+        yield self.consumer.dt.deferToAll()
+        # The failed writes don't keep taking up the window, so the
+        # producer is resumed
+        self.assertEqual(len(failures), N)
+        self.assertEqual(fc.N_inFlight, 0)
+        self.assertEqual(fc.N_paused, 1)
+        self.assertFalse(self.producer.isPaused)
+        self.assertEqual(self.consumer.N_parsed, 0)
+
+    
 class TestRecordKeeper(TestCase):
     verbose = True
     
@@ -56,14 +180,20 @@ class TestRecordKeeper(TestCase):
                 yield self.rk.addRecord(dt, thisRecord)
         # IPM before purge
         self.assertTrue(self.t.ipm(ip1))
+        N_before = yield self.t.hitsForIP(ip1)
         # Purge an IP address. In the test, we wait for the purge, but
         # not in real life.
-        yield self.rk.purgeIP(ip1, False)
+        yield self.rk.purgeIP(ip1, False, fileName="access.log")
         # IPM after purge
         self.assertFalse(self.t.ipm(ip1), ip1)
         # Make sure it's not in the DB anymore, either
         N = yield self.t.hitsForIP(ip1)
         self.assertEqual(N, 0)
+        # The purge got counted
+        stats = self.rk.stats
+        self.assertEqual(stats.get('purges', "access.log"), 1)
+        self.assertEqual(stats.get('purged', "access.log"), N_before)
+        self.assertGreater(stats.get('purgeSeconds'), 0)
         
     @defer.inlineCallbacks
     def test_addRecord(self):
@@ -76,3 +206,29 @@ class TestRecordKeeper(TestCase):
             N = yield self.t.hitsForIP(ip)
             self.assertEqual(N, N_expected[k])
             self.assertTrue(self.t.ipm(ip))
+
+
+class TestNullTransactor(TestCase):
+    def setUp(self):
+        self.rk = records.RecordKeeper(None, 1, [])
+        return self.rk.startup()
+
+    def tearDown(self):
+        return self.rk.shutdown()
+
+    def test_noDatabase(self):
+        self.assertIsInstance(self.rk.t, records.NullTransactor)
+        
+    @defer.inlineCallbacks
+    def test_records(self):
+        for dt, theseRecords in RECORDS.iteritems():
+            for thisRecord in theseRecords:
+                wasAdded = yield self.rk.addRecord(dt, thisRecord)
+                self.assertFalse(wasAdded)
+        yield self.rk.purgeIP(ip1, True, fileName="access.log")
+        self.assertEqual(self.rk.getNewBlockedIPs(), [ip1])
+        self.assertEqual(self.rk.stats.get('purged'), 0)
+        result = yield self.rk.fileInfo("access.log")
+        self.assertNone(result)
+        watermarks = yield self.rk.getWatermarks()
+        self.assertEqual(watermarks, {})
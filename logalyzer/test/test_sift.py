@@ -7,7 +7,7 @@ Copyright (C) 2014-2015 Tellectual LLC
 
 """
 
-import os.path, random
+import os.path, random, pickle
 from time import time
 
 import ipcalc
@@ -38,6 +38,20 @@ class TestIPMatcher(tb.TestCase):
         for thisIP, expectMatch in cases:
             self.assertEqual(self.m(thisIP), expectMatch, thisIP)
 
+    def test_addIP_invalid(self):
+        m = sift.IPMatcher(["300.1.1.1", "1.2.3", "1.2.3.4"])
+        self.assertEqual(len(m), 1)
+        self.assertTrue(m("1.2.3.4"))
+        
+    def test_accounting(self):
+        self.m.account()
+        self.m("118.194.247.128")
+        self.m("118.194.247.128")
+        self.m("109.207.200.0")
+        self.assertEqual(
+            self.m.ruleCounts(), {"118.194.247.128": (2, 2, 0.0)})
+        self.assertEqual(self.m.ruleCounts(), {})
+        
     def test_performance_noCache(self):
         def timeit(f, *args):
             t0 = time()
@@ -103,6 +117,29 @@ class TestNetMatcher(tb.TestCase):
             ("109.227.67.33",   True))
         for thisIP, expectMatch in cases:
             self.assertEqual(self.m(thisIP), expectMatch, thisIP)
+
+    def test_noRules(self):
+        m = sift.NetMatcher([])
+        self.assertIs(m.IP, None)
+        self.assertFalse(m("109.207.201.10"))
+
+    def test_pickled(self):
+        m = pickle.loads(pickle.dumps(self.m))
+        self.assertTrue(m("109.207.201.10"))
+        self.assertFalse(m("109.206.250.240"))
+    
+    def test_accounting(self):
+        self.m.account()
+        self.assertTrue(self.m("109.207.201.10"))
+        self.assertFalse(self.m("109.206.250.240"))
+        # Cached, so no rules get evaluated
+        self.assertTrue(self.m("109.207.201.10"))
+        counts = self.m.ruleCounts()
+        self.assertEqual(len(counts), len(self.m.networks))
+        self.assertEqual(counts["109.207.200.0/21"][:2], (1, 2))
+        for hits, evals, seconds in counts.itervalues():
+            self.assertEqual(evals, 2)
+            self.assertGreaterEqual(seconds, 0.0)
         
 
 class ReMatcherTestMixin:
@@ -136,6 +173,22 @@ class ReMatcherTestMixin:
             for string in self.positives:
                 self.checkWithRandomIP(string, True)
 
+    def test_accounting(self):
+        self.m.account()
+        for k, string in enumerate(self.negatives + self.positives):
+            ip = "10.0.0.{:d}".format(k)
+            self.assertEqual(
+                self.m(ip, string), string in self.positives, string)
+        counts = self.m.ruleCounts()
+        N = len(self.negatives) + len(self.positives)
+        self.assertEqual(set(counts.keys()), set(self.m.rules))
+        self.assertEqual(set([x[1] for x in counts.values()]), set([N]))
+        # Every positive is matched by at least one rule, and no
+        # negative by any
+        self.assertGreaterEqual(
+            sum([x[0] for x in counts.values()]), len(self.positives))
+        self.assertEqual(self.m.ruleCounts(), {})
+
 
 class TestUAMatcher(ReMatcherTestMixin, tb.TestCase):
     rulesName = 'RULES_UA'
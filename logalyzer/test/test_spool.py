@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# logalyzer:
+# Parses your bloated HTTP access logs to extract the info you want
+# about hits to your webserver from (hopefully) real people instead of
+# just the endless hackers and bots. Stores the info in a relational
+# database where you can access it using all the power of SQL.
+#
+# Copyright (C) 2015, 2017, 2018 by Edwin A. Suominen,
+# http://edsuom.com/logalyzer
+#
+# See edsuom.com for API documentation as well as information about
+# Ed's background and other projects, software and otherwise.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the
+# License. You may obtain a copy of the License at
+# 
+#   http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an "AS
+# IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+
+import os, os.path, shutil
+
+from twisted.internet import defer
+
+from testbase import ip1, ip2, RECORDS, TestCase
+import spool, records
+
+
+def writeSegments(spoolDir, filePath, N=None):
+    sw = spool.SegmentWriter(spoolDir, filePath)
+    if N: sw.N = N
+    for dt, theseRecords in RECORDS.iteritems():
+        for thisRecord in theseRecords:
+            sw.write(dt, thisRecord)
+    sw.close()
+    
+
+class TestSegments(TestCase):
+    def setUp(self):
+        self.spoolDir = os.path.abspath("spool")
+        os.mkdir(self.spoolDir)
+
+    def tearDown(self):
+        shutil.rmtree(self.spoolDir)
+
+    def test_encode_decode(self):
+        for dt, theseRecords in RECORDS.iteritems():
+            for thisRecord in theseRecords:
+                stuff = spool.encode(dt, thisRecord)
+                self.assertEqual(spool.decode(stuff), (dt, thisRecord))
+
+    def test_write(self):
+        writeSegments(self.spoolDir, "access.log", N=2)
+        fileNames = os.listdir(self.spoolDir)
+        self.assertEqual(len(fileNames), 2)
+        for fileName in fileNames:
+            self.assertTrue(fileName.endswith(".seg"))
+
+
+class TestSpoolLoader(TestCase):
+    def setUp(self):
+        self.spoolDir = os.path.abspath("spool")
+        self.rk = records.RecordKeeper("sqlite://", 1, [])
+        self.t = self.rk.t
+        self.sl = spool.SpoolLoader(self.spoolDir, self.rk)
+        return self.rk.startup()
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        yield self.sl.shutdown()
+        yield self.rk.shutdown()
+        shutil.rmtree(self.spoolDir)
+
+    @defer.inlineCallbacks
+    def test_drain(self):
+        writeSegments(self.spoolDir, "access.log", N=2)
+        writeSegments(self.spoolDir, "access.log.1")
+        N = yield self.sl.drain("access.log")
+        self.assertEqual(N, 3)
+        self.assertEqual(os.listdir(self.spoolDir), [])
+        # The other file's records got loaded, too
+        N = yield self.sl.drain("access.log.1")
+        self.assertEqual(N, 3)
+        # Duplicates weren't added
+        for ip, N_expected in ((ip1, 2), (ip2, 1)):
+            N = yield self.t.hitsForIP(ip)
+            self.assertEqual(N, N_expected)
+
+    @defer.inlineCallbacks
+    def test_drain_rejected(self):
+        yield self.rk.purgeIP(ip1, False)
+        writeSegments(self.spoolDir, "access.log")
+        N = yield self.sl.drain("access.log")
+        self.assertEqual(N, 3)
+        N = yield self.t.hitsForIP(ip1)
+        self.assertEqual(N, 0)
+        N = yield self.t.hitsForIP(ip2)
+        self.assertEqual(N, 1)
+
+    @defer.inlineCallbacks
+    def test_startup(self):
+        writeSegments(self.spoolDir, "access.log", N=2)
+        partPath = os.path.join(self.spoolDir, "1-2-000003.part")
+        with open(partPath, 'wb') as fh:
+            fh.write("xxx")
+        self.sl.startup()
+        self.assertFalse(os.path.exists(partPath))
+        # The segments left by the interrupted run get loaded, but
+        # don't count for this one
+        writeSegments(self.spoolDir, "access.log")
+        N = yield self.sl.drain("access.log")
+        self.assertEqual(N, 3)
+        self.assertEqual(os.listdir(self.spoolDir), [])
+        N = yield self.t.hitsForIP(ip1)
+        self.assertEqual(N, 2)
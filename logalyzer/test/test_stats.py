@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# logalyzer:
+# Parses your bloated HTTP access logs to extract the info you want
+# about hits to your webserver from (hopefully) real people instead of
+# just the endless hackers and bots. Stores the info in a relational
+# database where you can access it using all the power of SQL.
+#
+# Copyright (C) 2015, 2017, 2018 by Edwin A. Suominen,
+# http://edsuom.com/logalyzer
+#
+# See edsuom.com for API documentation as well as information about
+# Ed's background and other projects, software and otherwise.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the
+# License. You may obtain a copy of the License at
+# 
+#   http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an "AS
+# IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+
+
+from testbase import TestCase
+from stats import Stats
+
+
+class TestStats(TestCase):
+    def test_bump(self):
+        s = Stats()
+        self.assertEqual(s.get('parsed'), 0)
+        s.bump('parsed')
+        s.bump('parsed', 2, fileName="access.log")
+        s.bump('added', fileName="access.log.1")
+        self.assertEqual(s.get('parsed'), 3)
+        self.assertEqual(s.get('parsed', "access.log"), 2)
+        self.assertEqual(s.get('parsed', "access.log.1"), 0)
+        self.assertEqual(s.get('added', "other.log"), 0)
+
+    def test_snapshot(self):
+        s = Stats()
+        s.bump('parsed', fileName="access.log")
+        snapshot = s.snapshot()
+        s.bump('parsed', fileName="access.log")
+        self.assertEqual(snapshot, {
+            'counts': {'parsed': 1}, 'files': {"access.log": {'parsed': 1}},
+            'workers': {}, 'gauges': {}})
+
+    def test_workers(self):
+        s = Stats()
+        s.bump('lines', 100, worker=1234)
+        s.bump('lines', 50, worker=1235)
+        s.bump('lines', 10, worker=1234)
+        self.assertEqual(s.get('lines'), 160)
+        self.assertEqual(s.workers, {1234: {'lines': 110}, 1235: {'lines': 50}})
+        self.assertEqual(s.files, {})
+
+    def test_gauge(self):
+        s = Stats()
+        depth = [3]
+        s.gauge('inFlight', lambda: depth[0])
+        self.assertEqual(s.read('inFlight'), 3)
+        self.assertEqual(s.read('bogus'), None)
+        snapshot = s.snapshot()
+        depth[0] = 7
+        self.assertEqual(snapshot['gauges'], {'inFlight': 3})
+        self.assertEqual(s.snapshot()['gauges'], {'inFlight': 7})
+
+    def test_sizes(self):
+        s = Stats()
+        self.assertEqual(s.sizes(), {})
+        rejectedIPs = {'1.2.3.4': True}
+        s.sizer(lambda: {'rejectedIPs': len(rejectedIPs), 'dtk': 10})
+        s.setSizes(1234, {'redirects': 2, 'cache.uaMatcher': 40})
+        s.setSizes(1235, {'redirects': 1})
+        s.setSizes(1234, {'redirects': 3})
+        rejectedIPs['5.6.7.8'] = False
+        self.assertEqual(s.sizes(), {
+            'rejectedIPs': 2, 'dtk': 10, 'redirects': 4})
+
+    def test_tally(self):
+        s = Stats()
+        s.tally('uaMatcher', {"bot": (2, 10, 0.5), "crawl": (0, 10, 0.25)})
+        s.tally('uaMatcher', {"bot": (1, 5, 0.25)})
+        s.tally('netMatcher', {})
+        self.assertEqual(s.rules, {
+            'uaMatcher': {"bot": [3, 15, 0.75], "crawl": [0, 10, 0.25]},
+            'netMatcher': {}})
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# logalyzer:
+# Parses your bloated HTTP access logs to extract the info you want
+# about hits to your webserver from (hopefully) real people instead of
+# just the endless hackers and bots. Stores the info in a relational
+# database where you can access it using all the power of SQL.
+#
+# Copyright (C) 2015, 2017, 2018 by Edwin A. Suominen,
+# http://edsuom.com/logalyzer
+#
+# See edsuom.com for API documentation as well as information about
+# Ed's background and other projects, software and otherwise.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the
+# License. You may obtain a copy of the License at
+# 
+#   http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an "AS
+# IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+
+
+import os.path
+from datetime import date, datetime
+
+from twisted.internet import defer
+
+from testbase import TestCase, tempFiles, deleteIfExists
+from util import DatabaseError
+import database, uniques
+from test_hll import ips
+
+
+def records():
+    """
+    Returns a list of (dt, record) tuples: 50 IP addresses visiting
+    foo.com on two days and another 20 visiting only bar.com on one
+    day, and one IP address visiting /about on foo.com.
+    """
+    def record(ip, vhost, url="/"):
+        return {'vhost': vhost, 'ip': ip, 'http': 200, 'was_rd': False,
+                'url': url, 'ref': "-", 'ua': "-"}
+    
+    result = []
+    for k, ip in enumerate(ips(0, 50)):
+        for day in (1, 2):
+            dt = datetime(2018, 5, day, 10, 0, k)
+            result.append((dt, record(ip, "foo.com")))
+    for k, ip in enumerate(ips(50, 20)):
+        result.append((datetime(2018, 5, 2, 11, 0, k), record(ip, "bar.com")))
+    result.append(
+        (datetime(2018, 5, 2, 12), record(ips(0, 1)[0], "foo.com", "/about")))
+    return result
+
+
+class TestUniques(TestCase):
+    verbose = False
+    sketches = True
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        filePath, = tempFiles(os.path.abspath("uniques.db"))
+        deleteIfExists(filePath)
+        self.url = "sqlite:///{}".format(filePath)
+        self.t = database.Transactor(self.url, sketches=self.sketches)
+        yield self.t.waitUntilRunning()
+        yield self.t.setRecords(records())
+
+    def tearDown(self):
+        return self.t.shutdown()
+
+    def assertAbout(self, hll, N):
+        self.assertLess(abs(hll.count() - N), 2)
+    
+    def checkCounts(self, u):
+        days, total = u()
+        self.assertEqual(
+            sorted(days.keys()), [date(2018, 5, 1), date(2018, 5, 2)])
+        self.assertAbout(days[date(2018, 5, 1)], 50)
+        self.assertAbout(days[date(2018, 5, 2)], 70)
+        self.assertAbout(total, 70)
+        days, total = u(vhost="foo.com")
+        self.assertAbout(total, 50)
+        days, total = u(vhost="foo.com", url="/about")
+        self.assertAbout(total, 1)
+        days, total = u(since=date(2018, 5, 2))
+        self.assertEqual(days.keys(), [date(2018, 5, 2)])
+        days, total = u(vhost="bar.com", until=date(2018, 5, 1))
+        self.assertAbout(total, 0)
+        
+    def test_counts(self):
+        self.checkCounts(uniques.Uniques(self.url))
+
+    def test_unknownValue(self):
+        u = uniques.Uniques(self.url)
+        self.assertRaises(DatabaseError, u, vhost="baz.com")
+        
+    @defer.inlineCallbacks
+    def test_purgeIP(self):
+        N = yield self.t.purgeIP(ips(0, 1)[0], ignoreIPM=True)
+        self.assertEqual(N, 3)
+        u = uniques.Uniques(self.url)
+        days, total = u(vhost="foo.com")
+        self.assertAbout(total, 49)
+        days, total = u(vhost="foo.com", url="/about")
+        self.assertAbout(total, 0)
+        days, total = u(vhost="bar.com")
+        self.assertAbout(total, 20)
+
+
+class TestUniquesBackfill(TestUniques):
+    sketches = False
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        yield TestUniques.setUp(self)
+        self.assertRaises(DatabaseError, uniques.Uniques, self.url)
+        yield self.t.shutdown()
+        self.t = database.Transactor(self.url)
+        yield self.t.waitUntilRunning()
+        self.assertFalse(self.t.sketches)
+        yield self.t.shutdown()
+        self.t = database.Transactor(self.url, sketches=True)
+        yield self.t.waitUntilRunning()
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# logalyzer:
+# Parses your bloated HTTP access logs to extract the info you want
+# about hits to your webserver from (hopefully) real people instead of
+# just the endless hackers and bots. Stores the info in a relational
+# database where you can access it using all the power of SQL.
+#
+# Copyright (C) 2015, 2017, 2018 by Edwin A. Suominen,
+# http://edsuom.com/logalyzer
+#
+# See edsuom.com for API documentation as well as information about
+# Ed's background and other projects, software and otherwise.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the
+# License. You may obtain a copy of the License at
+# 
+#   http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an "AS
+# IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+
+
+import os, os.path, shutil, tempfile
+
+from testbase import TestCase
+import writer
+
+
+class TestCIDRBlocks(TestCase):
+    def test_single(self):
+        self.assertEqual(
+            writer.cidrBlocks(["10.0.0.1", "10.0.0.1"]), ["10.0.0.1"])
+
+    def test_aggregate(self):
+        ipList = ["10.0.0.{:d}".format(k) for k in xrange(256)]
+        self.assertEqual(writer.cidrBlocks(ipList), ["10.0.0.0/24"])
+        ipList = ["10.0.0.{:d}".format(k) for k in xrange(1, 7)]
+        self.assertEqual(
+            writer.cidrBlocks(ipList),
+            ["10.0.0.1", "10.0.0.2/31", "10.0.0.4/31", "10.0.0.6"])
+        ipList = ["10.0.1.{:d}".format(k) for k in xrange(256)] +\
+                 ["10.0.0.{:d}".format(k) for k in xrange(256)] +\
+                 ["9.255.255.255"]
+        self.assertEqual(
+            writer.cidrBlocks(ipList), ["9.255.255.255", "10.0.0.0/23"])
+
+    def test_widen(self):
+        ipList = ["10.0.0.1", "10.0.0.99", "10.0.0.200", "10.0.1.5"]
+        self.assertEqual(
+            writer.cidrBlocks(ipList, 3), ["10.0.0.0/24", "10.0.1.5"])
+        self.assertEqual(
+            writer.cidrBlocks(ipList + ["10.0.1.6"], 2), ["10.0.0.0/23"])
+
+    def test_everything(self):
+        self.assertEqual(writer.cidrBlocks(["0.0.0.0"], 1), ["0.0.0.0/24"])
+
+
+class TestIPWriter(TestCase):
+    def setUp(self):
+        self.dirPath = tempfile.mkdtemp()
+        self.filePath = os.path.join(self.dirPath, "blocked")
+        self.rejectedIPs = {
+            "10.0.0.2": True, "10.0.0.3": True,
+            "10.0.0.10": True, "1.2.3.4": True, "5.6.7.8": False}
+
+    def tearDown(self):
+        shutil.rmtree(self.dirPath)
+
+    def lines(self):
+        with open(self.filePath) as fh:
+            return fh.read().splitlines()
+
+    def test_badFormat(self):
+        self.assertRaises(ValueError, writer.IPWriter, 'foo')
+        
+    def test_plain(self):
+        w = writer.IPWriter()
+        w.writeIPs(self.rejectedIPs, self.filePath)
+        self.assertEqual(
+            self.lines(), ["1.2.3.4", "10.0.0.2", "10.0.0.3", "10.0.0.10"])
+        w.appendIPs(["10.0.0.1", "9.9.9.9"], self.filePath)
+        self.assertEqual(self.lines()[-2:], ["9.9.9.9", "10.0.0.1"])
+
+    def test_cidr(self):
+        writer.IPWriter('cidr').writeIPs(self.rejectedIPs, self.filePath)
+        self.assertEqual(
+            self.lines(), ["1.2.3.4", "10.0.0.2/31", "10.0.0.10"])
+
+    def test_ipset(self):
+        w = writer.IPWriter('ipset', widen=2)
+        w.writeIPs(self.rejectedIPs, self.filePath)
+        self.assertEqual(self.lines(), [
+            "create logalyzer hash:net family inet -exist",
+            "flush logalyzer",
+            "add logalyzer 1.2.3.4 -exist",
+            "add logalyzer 10.0.0.0/24 -exist"])
+        w.appendIPs(["9.9.9.9"], self.filePath)
+        self.assertEqual(self.lines()[-2:], [
+            "create logalyzer hash:net family inet -exist",
+            "add logalyzer 9.9.9.9 -exist"])
+
+    def test_nft(self):
+        w = writer.IPWriter('nft')
+        w.N_elements = 2
+        w.writeIPs(self.rejectedIPs, self.filePath)
+        self.assertEqual(self.lines(), [
+            "flush set inet filter logalyzer",
+            "add element inet filter logalyzer { 1.2.3.4, 10.0.0.2/31 }",
+            "add element inet filter logalyzer { 10.0.0.10 }"])
+
+    def test_diff(self):
+        w = writer.IPWriter('cidr', diff=True)
+        w.writeIPs(self.rejectedIPs, self.filePath)
+        self.assertEqual(
+            self.lines(), ["+1.2.3.4", "+10.0.0.2/31", "+10.0.0.10"])
+        del self.rejectedIPs["1.2.3.4"]
+        self.rejectedIPs["10.0.0.11"] = True
+        w.writeIPs(self.rejectedIPs, self.filePath)
+        self.assertEqual(
+            self.lines(), ["-1.2.3.4", "-10.0.0.10", "+10.0.0.10/31"])
+        w.writeIPs(self.rejectedIPs, self.filePath)
+        self.assertEqual(self.lines(), [])
+        w = writer.IPWriter('ipset', diff=True)
+        self.rejectedIPs["1.2.3.4"] = True
+        w.writeIPs(self.rejectedIPs, self.filePath)
+        self.assertEqual(self.lines(), [
+            "create logalyzer hash:net family inet -exist",
+            "add logalyzer 1.2.3.4 -exist"])
@@ -31,6 +31,7 @@ Utility functions, base classes, and the L{Args} class.
 """
 
 import re, os, os.path
+from datetime import datetime, timedelta
 from collections import deque
 from contextlib import contextmanager
 
@@ -72,6 +73,9 @@ def rdb(sep, *args):
         parts.append(r'(\d{{{:d}}})'.format(numDigits))
     return sep.join(parts)
 
+# A dotted-quad IP address, with no octet over 255
+IP_PATTERN = r'\.'.join([r'(?:25[0-5]|2[0-4]\d|1?\d?\d)']*4)
+
 def rc(*parts):
     """
     Compiles a regular expression from whitespace-separated parts.
@@ -80,30 +84,54 @@ def rc(*parts):
     return re.compile(rexp)
 
 
-def profile(f, *args, **kw):
-    def done(result):
-        with open('theseus.out', 'wb') as fh:
-            t.write_data(fh)
-        t.uninstall()
-        pr.disable()
-        import pstats
-        with open('profile.out', 'wb') as fh:
-            ps = pstats.Stats(pr, stream=fh).sort_stats('cumulative')
-            ps.print_stats()
-        return result
-    
-    def substituteFunction(*args, **kw):
-        d = f(*args, **kw)
-        d.addCallback(done)
-        return d
+def parseTime(text, now=None):
+    """
+    Returns a C{datetime} object for the supplied string, which can be
+    a date ("YYYY-MM-DD"), a date and time ("YYYY-MM-DD HH:MM:SS"),
+    or a number of days, hours, or minutes ago ("7d", "12h", "30m").
+    Returns C{None} if the string is empty, and raises a
+    C{ValueError} if it's none of those.
+    """
+    if not text:
+        return
+    text = text.strip()
+    match = re.match(r'(\d+)([dhm])$', text)
+    if match:
+        N = int(match.group(1))
+        units = {'d': 'days', 'h': 'hours', 'm': 'minutes'}[match.group(2)]
+        if now is None:
+            now = datetime.now()
+        return now - timedelta(**{units: N})
+    for fmt in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d"):
+        try:
+            return datetime.strptime(text, fmt)
+        except ValueError:
+            pass
+    raise ValueError(sub("Can't make a date and time out of '{}'", text))
+
+def rss():
+    """
+    Returns the current resident memory of this process in bytes, or
+    C{None} if that can't be determined, as on systems without
+    I{/proc}. (The peak is available from C{getrusage} on those, but
+    it never goes down.)
+    """
+    try:
+        with open("/proc/self/statm") as fh:
+            pages = int(fh.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE')
+    except:
+        pass
 
-    from cProfile import Profile
-    pr = Profile()
-    pr.enable()
-    from theseus import Tracer
-    t = Tracer(); t.install()
-    substituteFunction.func_name = f.func_name
-    return substituteFunction
+def physicalMemory():
+    """
+    Returns the number of bytes of physical memory, or C{None} if
+    that can't be determined.
+    """
+    try:
+        return os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except:
+        pass
 
 
 class DatabaseError(Exception):
@@ -115,10 +143,22 @@ class DatabaseError(Exception):
 class CacheManager(object):
     """
     Let me manage a cache or two for you.
+
+    @ivar hits: A list of the number of times each cache was checked
+      and found to have the value.
+    @ivar checks: A list of the number of times each cache was checked.
     """
     def __init__(self, N=40):
         self.N = N
         self.names = []
+        self.hits = []
+        self.checks = []
+
+    def __len__(self):
+        """
+        Returns the total number of values held in all my caches.
+        """
+        return sum([len(x) for x in getattr(self, 'caches', [])])
     
     def new(self, name=None):
         """
@@ -129,6 +169,8 @@ class CacheManager(object):
             self.caches = []
         thisCache = deque()
         self.caches.append(thisCache)
+        self.hits.append(0)
+        self.checks.append(0)
         k = len(self.caches) - 1
         if name is None:
             name = str(k)
@@ -162,7 +204,21 @@ class CacheManager(object):
         False if not.
         """
         k = self._checkIndex(k)
-        return bool(self.caches[k].count(x))
+        self.checks[k] += 1
+        if self.caches[k].count(x):
+            self.hits[k] += 1
+            return True
+        return False
+
+    def counts(self):
+        """
+        Returns a 2-tuple with the total number of cache hits and the
+        number of times my first cache was checked. If every lookup
+        checks that one first, as with the matchers in L{sift}, that's
+        the number of lookups and the first element is how many of
+        them were answered by one of my caches.
+        """
+        return sum(self.hits), self.checks[0] if self.checks else 0
 
     def set(self, k, x):
         """
@@ -384,46 +440,6 @@ class Base(object):
         path = os.path.abspath(os.path.join(self.myDir, fileName))
         self.checkPath(path)
         return path
-
-    _checkLeakStuff = []
-    def cleak(self, f, *args, **kw):
-        """
-        For debugging memory leaks. Calls the deferred-returning function
-        f (with any args, kw), recording changes made to the heap
-        during the call. Prints a warning-level message about the heap
-        every call, and stops with the debugger after 'stopInterval'
-        calls, if defined.
-
-        Returns a deferred that fires with the call result, which
-        should make this indistinguishable from the original call.
-        """
-        def done(result):
-            k = self._checkLeakStuff[0]
-            if not hasattr(self, 'msgInterval') or k % self.msgInterval == 0:
-                hpd = self._checkLeakStuff[1].heap()
-                print "\n"
-                self.msgWarning("Heap after {:d} intervals:\n{}", k, hpd)
-                self.msgWarning("Heap (byrcs):\n{}", hpd.byrcs)
-                # Particular focus
-                for kk in xrange(2):
-                    self.msgWarning(
-                        "Heap (byrcs[{:d}].byvia):\n{}",
-                        kk, hpd.byrcs[kk].byvia)
-            if hasattr(self, 'stopInterval') and k >= self.stopInterval:
-                import pdb
-                pdb.set_trace()
-            return result
-        
-        if not self._checkLeakStuff:
-            from guppy import hpy
-            self._checkLeakStuff.extend([0, hpy()])
-            self._checkLeakStuff[1].setrelheap()
-        self._checkLeakStuff[0] += 1
-        return f(*args, **kw).addCallback(done)
-
-    def gleak(self, f, *args, **kw):
-        import gc
-        gc.set_debug(gc.DEBUG_LEAK)
     
 
 class Args(object):
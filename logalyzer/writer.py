@@ -28,40 +28,181 @@
 
 """
 Writing of IP addresses.
+
+Blocking tens of thousands of IP addresses one firewall rule at a
+time is slow to load and slow to look up. Instead, the addresses can
+be written as the fewest CIDR blocks covering them, optionally
+widened to whole /24 networks, and as commands that load them into
+an I{ipset} or I{nftables} set. Only what's changed since the last
+time can be written, too.
 """
 
+import os.path
+
 from util import Base
+from database import ipToInt, intToIP
+
+
+def cidrBlocks(ipList, widen=None):
+    """
+    Returns a list of the fewest CIDR blocks that cover the IP addresses
+    in the supplied list, in numerical order, as strings like
+    "10.1.2.0/23". A block of just one address is written as the
+    address by itself.
+
+    With I{widen} set to an integer, any /24 network with at least
+    that many of the addresses gets covered entirely.
+    """
+    N_list = sorted(set([ipToInt(ip) for ip in ipList]))
+    ranges = []
+    if widen:
+        counts = {}
+        for N in N_list:
+            counts[N >> 8] = counts.get(N >> 8, 0) + 1
+        nets = set([x for x in counts if counts[x] >= widen])
+        ranges.extend([[x << 8, (x << 8) + 255] for x in nets])
+        N_list = [N for N in N_list if N >> 8 not in nets]
+    ranges.extend([[N, N] for N in N_list])
+    ranges.sort()
+    # Merge adjacent ranges
+    merged = []
+    for first, last in ranges:
+        if merged and first <= merged[-1][1] + 1:
+            merged[-1][1] = max([merged[-1][1], last])
+        else: merged.append([first, last])
+    # Split each merged range into the biggest aligned blocks that fit
+    blocks = []
+    for first, last in merged:
+        while first <= last:
+            size = first & -first if first else 1 << 32
+            while size > last - first + 1:
+                size >>= 1
+            prefix = 33 - size.bit_length()
+            if prefix == 32:
+                blocks.append(intToIP(first))
+            else: blocks.append("{}/{:d}".format(intToIP(first), prefix))
+            first += size
+    return blocks
 
 
 class IPWriter(Base):
     """
-    I write IP addresses to files.
+    I write IP addresses to files, in one of my I{formats} that you can
+    specify with I{fmt}:
+
+      - C{plain}: One address per line, in numerical order.
+
+      - C{cidr}: The fewest CIDR blocks covering the addresses (see
+        L{cidrBlocks}), one per line.
+
+      - C{ipset}: The CIDR blocks as commands for C{ipset restore},
+        adding them to a I{hash:net} set named I{setName}.
+
+      - C{nft}: The CIDR blocks as commands for C{nft -f}, adding them
+        to the set named I{setName} in the nftables I{table}. The set
+        must already be there, with the I{interval} flag.
+
+    For all but the I{plain} format, you can have any /24 network
+    with at least I{widen} blocked addresses blocked entirely.
+
+    With I{diff} set C{True}, only what's been added and removed
+    since the last time the file was written gets written. For the
+    I{plain} and I{cidr} formats, each line is prefixed with "+" or
+    "-". What was written the last time is kept in a file alongside,
+    with ".last" appended to its name.
     """
-    def ipToLong(self, ip):
+    formats = ('plain', 'cidr', 'ipset', 'nft')
+    # Elements per nftables command
+    N_elements = 1000
+    
+    def __init__(
+            self, fmt='plain', widen=None, diff=False,
+            setName="logalyzer", table="inet filter"):
+        if fmt not in self.formats:
+            raise ValueError(
+                "Unknown format '{}' for IP addresses".format(fmt))
+        self.fmt = fmt
+        self.widen = widen
+        self.diff = diff
+        self.setName = setName
+        self.table = table
+    
+    def entries(self, ipList):
         """
-        Converts a dotted-quad IP address string to a long int. Adapted
-        from ipcalc.IP
+        Returns a list of the entries to be written for the IP addresses
+        in the supplied list, which are the addresses themselves for
+        my I{plain} format or CIDR blocks for the others.
         """
-        q = ip.split('.')
-        q.reverse()
-        if len(q) > 4:
-            raise ValueError(
-                '%s: IPv4 address invalid: more than 4 bytes' % dq)
-        for x in q:
-            if not 0 <= int(x) <= 255:
-                raise ValueError(
-                    '%s: IPv4 address has invalid byte value' % dq)
-        while len(q) < 4:
-            q.insert(1, '0')
-        return sum(long(byte) << 8 * index for index, byte in enumerate(q))
+        if self.fmt == 'plain':
+            return sorted(set(ipList), key=ipToInt)
+        return cidrBlocks(ipList, self.widen)
+    
+    def lines(self, added, removed=[], incremental=False):
+        """
+        Returns a list of lines in my format for adding the entries in
+        the list I{added} and removing those in the list I{removed},
+        removals first.
+
+        Unless I'm writing differences or you set I{incremental}
+        C{True}, the lines for an I{ipset} or I{nft} set empty it
+        first.
+        """
+        incremental = incremental or self.diff
+        if self.fmt in ('plain', 'cidr'):
+            if not self.diff:
+                return list(added)
+            return ["-"+x for x in removed] + ["+"+x for x in added]
+        lines = []
+        if self.fmt == 'ipset':
+            lines.append(
+                "create {} hash:net family inet -exist".format(self.setName))
+            if not incremental:
+                lines.append("flush {}".format(self.setName))
+            for verb, entries in (('del', removed), ('add', added)):
+                for x in entries:
+                    lines.append("{} {} {} -exist".format(
+                        verb, self.setName, x))
+            return lines
+        if not incremental:
+            lines.append("flush set {} {}".format(self.table, self.setName))
+        for verb, entries in (('delete', removed), ('add', added)):
+            for k in xrange(0, len(entries), self.N_elements):
+                lines.append("{} element {} {} {{ {} }}".format(
+                    verb, self.table, self.setName,
+                    ", ".join(entries[k:k+self.N_elements])))
+        return lines
     
     def writeIPs(self, rejectedIPs, filePath):
         """
         Writes the blocked IPs in the supplied dict of ip addresses, in
-        numerical order, to the specified filePath.
+        numerical order and in my format, to the specified filePath.
         """
-        ipList = sorted(rejectedIPs.keys(), key=self.ipToLong)
+        entries = self.entries([x for x in rejectedIPs if rejectedIPs[x]])
+        removed = []
+        if self.diff:
+            lastPath = filePath + ".last"
+            previous = []
+            if os.path.exists(lastPath):
+                with open(lastPath) as fh:
+                    previous = [x.strip() for x in fh if x.strip()]
+            current = set(entries)
+            removed = [x for x in previous if x not in current]
+            previous = set(previous)
+            added = [x for x in entries if x not in previous]
+            with open(lastPath, 'w') as fh:
+                for x in entries:
+                    fh.write(x + '\n')
+        else: added = entries
         with open(filePath, 'w') as fh:
-            for ip in ipList:
-                if rejectedIPs[ip]:
-                    fh.write(ip + '\n')
+            for line in self.lines(added, removed):
+                fh.write(line + '\n')
+
+    def appendIPs(self, ipList, filePath):
+        """
+        Appends the IPs in the supplied list, in numerical order and in
+        my format, to the specified filePath.
+        """
+        ipList = sorted(ipList, key=ipToInt)
+        with open(filePath, 'a') as fh:
+            for line in self.lines(ipList, incremental=True):
+                fh.write(line + '\n')
@@ -57,7 +57,7 @@ kw = {'version':           "0.4",
       
       'install_requires':  required,
       'packages':          [
-          'logalyzer', 'logalyzer.test',
+          'logalyzer', 'logalyzer.bench', 'logalyzer.test',
       ],
       'package_data':        {
           'logalyzer': ['rules/*'],
@@ -65,6 +65,9 @@ kw = {'version':           "0.4",
       'entry_points':      {
           'console_scripts': [
               'la = logalyzer.main:run',
+              'la-compact = logalyzer.migrate:run',
+              'la-uniques = logalyzer.uniques:run',
+              'la-bench = logalyzer.bench.stages:run',
           ],
       },
       'test_suite':        "logalyzer.test",
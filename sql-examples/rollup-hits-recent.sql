@@ -0,0 +1,11 @@
+/* Daily hits on each virtual host for the last month, from the
+   rollup_hits table that gets maintained when you run with -r. Much
+   faster than counting up rows in entries.
+*/
+SELECT r.day DAY, vhost.value VHOST, sum(r.hits) N
+FROM rollup_hits r INNER JOIN vhost ON vhost.id = r.id_vhost
+WHERE datediff(now(), r.day) < 31
+ AND r.http between 200 and 300
+GROUP BY DAY, VHOST
+ORDER BY DAY DESC, N DESC;
+
@@ -0,0 +1,9 @@
+/* Unique visitors to each virtual host per month, from the
+   rollup_visitors table that gets maintained when you run with -r.
+*/
+SELECT year(r.day) YR, month(r.day) MO, vhost.value VHOST,
+ count(distinct r.ip) N
+FROM rollup_visitors r INNER JOIN vhost ON vhost.id = r.id_vhost
+GROUP BY YR, MO, VHOST
+ORDER BY YR DESC, MO DESC, N DESC;
+
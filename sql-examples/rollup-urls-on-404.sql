@@ -0,0 +1,10 @@
+/* Most requested non-existent URLs over the last month, from the
+   rollup_hits table that gets maintained when you run with -r.
+*/
+SELECT sum(r.hits) N, url.value URL
+FROM rollup_hits r INNER JOIN url ON url.id = r.id_url
+WHERE r.http = 404 AND datediff(now(), r.day) < 31
+GROUP BY URL
+HAVING N > 1
+ORDER BY N DESC, URL
+